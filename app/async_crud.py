@@ -0,0 +1,48 @@
+# Async counterparts of the read functions of app/crud.py, used by the read routes of the API on the async engine
+# Writes stay in app/crud.py, on the sync engine shared with Celery
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud import export_query, history_page, history_page_query
+from app.database import ApiKey, Site, StatusType, Webhook
+from app.rollups import site_stats, site_stats_query, stats_range
+
+# Function to retrieve a site from the database by its ID
+async def get_site(db: AsyncSession, site_id: int):
+    return await db.scalar(select(Site).where(Site.id == site_id))
+
+# Function to retrieve all sites from the database
+async def get_all_sites(db: AsyncSession):
+    return (await db.scalars(select(Site))).all()
+
+# Function to retrieve one page of the status history of a site, newest first (see crud.history_page_query)
+async def get_history_page(db: AsyncSession, site: Site, limit: int, cursor: str | None = None, since: datetime | None = None, until: datetime | None = None, status: StatusType | None = None):
+    entries = (await db.scalars(history_page_query(site.id, limit, cursor, since, until, status))).all()
+    return history_page(entries, limit)
+
+# Function to stream the status history of some sites, oldest first (see crud.stream_history)
+async def stream_history(db: AsyncSession, site_ids: list[int] | None = None, since: datetime | None = None, until: datetime | None = None, yield_per: int = 1000):
+    async for row in await db.stream(export_query(site_ids, since, until).execution_options(yield_per=yield_per)):
+        yield row
+
+# Function to summarise the rollups of a site over a time range (see rollups.get_site_stats)
+async def get_site_stats(db: AsyncSession, site_id: int, since: datetime | None = None, until: datetime | None = None, granularity: str | None = None):
+    since, until, granularity = stats_range(since, until, granularity)
+    rows = (await db.scalars(site_stats_query(site_id, since, until, granularity))).all()
+    return site_stats(site_id, since, until, granularity, rows)
+
+# Function to retrieve all webhooks from the database
+async def get_all_webhooks(db: AsyncSession):
+    return (await db.scalars(select(Webhook))).all()
+
+# Function to retrieve all webhooks associated with a specific site ID
+async def get_webhooks(db: AsyncSession, site_id: int):
+    return (await db.scalars(select(Webhook).where(Webhook.site_id == site_id))).all()
+
+# Function to retrieve all API keys, revoked ones included
+async def get_all_api_keys(db: AsyncSession):
+    return (await db.scalars(select(ApiKey))).all()
+
+# Function to retrieve an API key by the hash of the key
+async def get_api_key_by_hash(db: AsyncSession, key_hash: str):
+    return await db.scalar(select(ApiKey).where(ApiKey.key_hash == key_hash))
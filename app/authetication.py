@@ -1,25 +1,159 @@
 # app/auth_simple.py
 import os
+import time
+import hashlib
 import secrets
-from fastapi import Security, HTTPException, status
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+import redis
+from fastapi import Depends, Request, Security, HTTPException, status
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, SecurityScopes
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.async_crud import get_api_key_by_hash
+from app.database import get_async_db
 
 VALID_USERNAME = os.getenv("VALID_USERNAME")
 VALID_PASSWORD = os.getenv("VALID_PASSWORD")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", "1024")) # Verified keys kept in memory, least recently used ones are dropped first
+API_KEY_CACHE_TTL_SECONDS = float(os.getenv("API_KEY_CACHE_TTL_SECONDS", "60")) # Longest time a cached key is trusted without the database
 
-basic_auth = HTTPBasic() # Create an instance of HTTPBasic authentication scheme from FastAPI
-
-# Asynchronous function to verify HTTP Basic Authentication credentials
-# For every request we need only an username and password in the header
-async def verify_credentials(credentials: HTTPBasicCredentials = Security(basic_auth)):
-    correct_username = secrets.compare_digest(credentials.username, VALID_USERNAME)
-    correct_password = secrets.compare_digest(credentials.password, VALID_PASSWORD)
-
-    # Check if both username and password are correct
-    if not (correct_username and correct_password):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Basic"},
-        )
-    return True
\ No newline at end of file
+API_KEY_PREFIX = "wm_"
+REVOCATIONS_CHANNEL = "api_keys:revoked" # Redis channel telling every API process to drop a revoked key from its cache
+
+logger = logging.getLogger(__name__)
+
+basic_auth = HTTPBasic(auto_error=False) # Create an instance of HTTPBasic authentication scheme from FastAPI, API keys are tried when it is absent
+
+# Function to generate a new API key, returns the key, the prefix shown in listings and the hash stored in the database
+def new_api_key():
+    key = API_KEY_PREFIX + secrets.token_urlsafe(32)
+    return key, key[:len(API_KEY_PREFIX) + 6], hash_api_key(key)
+
+# Keys are long and random, a single SHA-256 is enough to make the stored hash useless and costs about a microsecond
+def hash_api_key(key: str):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+# What a verified key is allowed to do, None for an unknown or revoked key
+@dataclass
+class CachedKey:
+    scopes: frozenset[str] | None
+    expires: float
+
+# In-process TTL and LRU cache of verified API keys, keyed by key hash
+# Revocations are broadcast over redis pub/sub to every API process, the TTL bounds staleness if a message is missed
+class ApiKeyCache:
+    def __init__(self, size: int = API_KEY_CACHE_SIZE, ttl: float = API_KEY_CACHE_TTL_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, CachedKey] = OrderedDict()
+        self._lock = threading.Lock() # The revocation listener thread writes too
+        self._listener: threading.Thread | None = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key_hash: str):
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None or entry.expires < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key_hash)
+            self.hits += 1
+            return entry
+
+    def set(self, key_hash: str, scopes: frozenset[str] | None):
+        with self._lock:
+            self._entries[key_hash] = CachedKey(scopes, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key_hash)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key_hash: str):
+        with self._lock:
+            self._entries.pop(key_hash, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Listen for revocations made by other processes, started once on first use
+    def listen(self, redis_url: str = REDIS_URL):
+        if self._listener is not None:
+            return
+        self._listener = threading.Thread(target=self._listen, args=(redis_url,), name="api-key-revocations", daemon=True)
+        self._listener.start()
+
+    def _listen(self, redis_url: str):
+        while True:
+            try:
+                pubsub = redis.StrictRedis.from_url(redis_url).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(REVOCATIONS_CHANNEL)
+                for message in pubsub.listen():
+                    self.invalidate(message["data"].decode())
+            except redis.RedisError as e:
+                logger.warning(f"API key revocation listener disconnected, cached keys expire after {self.ttl}s : {e}")
+                self.clear() # Revocations may have been missed while disconnected
+                time.sleep(5)
+
+api_key_cache = ApiKeyCache()
+redis_client = redis.StrictRedis.from_url(REDIS_URL) # Publishes revocations, its connection pool is reused by every call
+
+# Function to revoke a key in every API process, the caller has already revoked it in the database
+def broadcast_revocation(key_hash: str):
+    api_key_cache.invalidate(key_hash)
+    try:
+        redis_client.publish(REVOCATIONS_CHANNEL, key_hash)
+    except redis.RedisError as e:
+        logger.warning(f"Could not broadcast API key revocation, other processes drop it within {API_KEY_CACHE_TTL_SECONDS}s : {e}")
+
+# Function to get the scopes of an API key, from the cache or else the database
+async def api_key_scopes(db: AsyncSession, key: str):
+    api_key_cache.listen()
+    key_hash = hash_api_key(key)
+    entry = api_key_cache.get(key_hash)
+    if entry is not None:
+        return entry.scopes
+    api_key = await get_api_key_by_hash(db, key_hash)
+    scopes = frozenset(api_key.scopes.split(",")) if api_key and api_key.revoked_at is None else None
+    api_key_cache.set(key_hash, scopes) # Unknown keys are cached too, so guessing does not reach the database every time
+    return scopes
+
+# Function to read an API key from 'Authorization: Bearer <key>' or 'X-API-Key: <key>'
+def api_key_from_request(request: Request):
+    authorization = request.headers.get("Authorization", "")
+    scheme, _, value = authorization.partition(" ")
+    if scheme.lower() == "bearer" and value:
+        return value.strip()
+    return request.headers.get("X-API-Key")
+
+def unauthorized(detail: str):
+    return HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=detail, headers={"WWW-Authenticate": "Basic"})
+
+# Asynchronous function to verify HTTP Basic Authentication credentials or an API key
+# The session is only opened when an uncached API key has to be looked up
+# HTTP Basic credentials are allowed everything, an API key only its scopes
+# Routes may require scopes with Security(verify_credentials, scopes=[...]), otherwise reads need 'read' and everything else 'write'
+async def verify_credentials(request: Request, security_scopes: SecurityScopes, credentials: HTTPBasicCredentials | None = Security(basic_auth), db: AsyncSession = Depends(get_async_db)):
+    if credentials is not None:
+        correct_username = secrets.compare_digest(credentials.username, VALID_USERNAME)
+        correct_password = secrets.compare_digest(credentials.password, VALID_PASSWORD)
+
+        # Check if both username and password are correct
+        if not (correct_username and correct_password):
+            raise unauthorized("Incorrect username or password")
+        return True
+
+    key = api_key_from_request(request)
+    if not key:
+        raise unauthorized("Not authenticated")
+    scopes = await api_key_scopes(db, key)
+    if scopes is None:
+        raise unauthorized("Invalid or revoked API key")
+
+    required = security_scopes.scopes or ["read" if request.method in ("GET", "HEAD") else "write"]
+    if "admin" not in scopes and not set(required) <= scopes:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"API key lacks scope: {', '.join(sorted(set(required) - scopes))}")
+    return True
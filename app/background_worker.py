@@ -1,61 +1,172 @@
 import os
+import time
+import atexit
+import logging
+from functools import partial
 from dotenv import load_dotenv
+import redis
 import requests
-from celery import Celery
+from celery.signals import celeryd_after_setup, worker_process_shutdown, worker_ready, worker_shutdown
+from celery.worker.control import inspect_command
+from app.celery_app import REDIS_URL, celery
 from app.notification import notify_status_change
 from datetime import datetime, timezone
 from sqlalchemy.orm import Session
-from app.crud import get_last_history_state, get_site, get_webhooks
-from app.database import SiteStatusHistory, StatusType, SessionLocal
+from app.compaction import compact_history
+from app.crud import get_last_state, get_site, get_sites_by_ids, get_webhooks, get_webhooks_for_sites
+from app.database import ProbeMode, Site, SiteStatusHistory, StatusType, SessionLocal, Webhook, engine, pool_stats
+from app.dns_cache import dns_cache
+from app.history_writer import HistoryWriter
+from app.http_pool import HTTP_TIMING_BREAKDOWN, RequestTiming, connect_only, encode_timings, get_session, measure_timing
+from app.metrics import CHECK_LAG_SECONDS, observe_check, pool_collector, start_worker_exporter
+from app.probe_engine import DEFAULT_SPEC, HEAD_NOT_ALLOWED, KeywordScanner, ProbeResponse, ProbeSpec, probe_passed, probe_sites
+from app.rollups import RollupWriter
+from app.sharding import SHARD_NODE_NAME, SHARDING_ENABLED, leave, shard_queue, start_heartbeat
+from app.state_cache import LastState, remember_state, state_cache
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type, RetryError
 
 load_dotenv()
 
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 DEFAULT_TIMEOUT_SECONDS = int(os.getenv("DEFAULT_TIMEOUT_SECONDS", "10"))
 
+OUTCOMES_KEY = "scheduler:outcomes" # Redis list of check outcomes the scheduler adapts the next check times to
+OUTCOMES_MAX_LENGTH = 100000 # Outcomes kept at most while no scheduler drains them
+
+logger = logging.getLogger(__name__)
+
 # Retry attempted in case of error initially, before concluding that the site is really down
+# Each attempt appends its own timing to 'attempts', the wait between attempts is in none of them
 @retry(stop=stop_after_attempt(2), wait=wait_fixed(2), retry=retry_if_exception_type(requests.RequestException), reraise=True)
-def get_website_response(url, timeout):
-    return requests.get(url, timeout=timeout)
+# Each probe mode only costs what it needs, as in the async probe engine
+def get_website_response(url, timeout, attempts: list[RequestTiming] | None = None, spec: ProbeSpec = DEFAULT_SPEC):
+    with measure_timing() as timing:
+        if attempts is not None:
+            attempts.append(timing)
+        session = get_session() # Pooled keep-alive session, shared by all checks of this worker
+        if spec.mode == ProbeMode.TCP:
+            connect_only(url, timeout)
+            return ProbeResponse(None)
+        if spec.mode == ProbeMode.GET:
+            return ProbeResponse(session.get(url, timeout=timeout).status_code)
+        if spec.mode == ProbeMode.HEAD:
+            response = session.head(url, timeout=timeout, allow_redirects=True) # Redirects followed like GET does
+            if response.status_code not in HEAD_NOT_ALLOWED:
+                return ProbeResponse(response.status_code)
+        with session.get(url, timeout=timeout, stream=True) as response: # Closing it unread drops the connection instead of downloading the body
+            if spec.mode != ProbeMode.BODY:
+                return ProbeResponse(response.status_code)
+            scanner = KeywordScanner(spec.keyword, spec.max_body_bytes)
+            for chunk in response.iter_content(chunk_size=8192):
+                if scanner.feed(chunk):
+                    break
+            return ProbeResponse(response.status_code, scanner.found)
 
-celery = Celery("tasks", broker=REDIS_URL, broker_connection_retry_on_startup=True)
+# Write-behind buffer for history rows of the non optimised mode, one per worker process
+history_writer = HistoryWriter()
+atexit.register(history_writer.close)
 
-@celery.task
-def check_website_status(site_id: int, database_optisation: bool = True):
-    db: Session = SessionLocal()
-    site = get_site(db, site_id)
-    
-    if not site:
-        return
+# Client the batch task reports check outcomes to the scheduler with
+outcomes_redis = redis.StrictRedis.from_url(REDIS_URL)
+
+# Uptime and latency rollups, every check is folded in whatever the database optimisation mode
+rollup_writer = RollupWriter()
+atexit.register(rollup_writer.close)
+
+# Flush buffered history rows and rollups before the worker goes away
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def flush_history_writer(**kwargs):
+    history_writer.close()
+    rollup_writer.close()
+
+# Flush latency and queue depth of the write-behind buffer, celery -A app.background_worker inspect history_writer_stats
+@inspect_command()
+def history_writer_stats(state):
+    return history_writer.stats()
+
+# Counters of the rollup buffer, celery -A app.background_worker inspect rollup_writer_stats
+@inspect_command()
+def rollup_writer_stats(state):
+    return rollup_writer.stats()
+
+# Connection pool of the worker process, size DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW for the greenlets using the database at once
+# celery -A app.background_worker inspect db_pool_stats
+@inspect_command()
+def db_pool_stats(state):
+    return pool_stats(engine)
+
+pool_collector.track("sync", partial(pool_stats, engine))
+
+# Hits, misses and fallbacks of the DNS cache shared by the checks of the worker process, celery -A app.background_worker inspect dns_cache_stats
+@inspect_command()
+def dns_cache_stats(state):
+    return dns_cache.stats()
+
+# Prometheus exporter of the worker, on WORKER_METRICS_PORT, started in the main process where the gevent pool runs the tasks
+@worker_ready.connect
+def export_metrics(**kwargs):
+    start_worker_exporter()
+
+# Sharding, each node consumes its own probes.<node> queue besides the default one and announces itself with a heartbeat
+# The scheduler routes the checks of a site to the queue of the node owning it on the hash ring (see app/sharding.py)
+shard_member = False
+shard_heartbeat = None
+
+@celeryd_after_setup.connect
+def consume_shard_queue(sender, instance, **kwargs):
+    global shard_member
+    queues = instance.app.amqp.queues
+    if SHARDING_ENABLED and (not queues.consume_from or instance.app.conf.task_default_queue in queues.consume_from): # Notification only workers stay out of the ring
+        queues.select_add(shard_queue(SHARD_NODE_NAME))
+        shard_member = True
+
+@worker_ready.connect
+def join_shard_ring(**kwargs):
+    global shard_heartbeat
+    if shard_member:
+        shard_heartbeat = start_heartbeat(redis.StrictRedis.from_url(REDIS_URL))
+        logger.info(f"Joined the shard ring as {SHARD_NODE_NAME}, consuming {shard_queue(SHARD_NODE_NAME)}")
+
+@worker_shutdown.connect
+def leave_shard_ring(**kwargs):
+    if shard_heartbeat is not None:
+        shard_heartbeat.set()
+        leave(redis.StrictRedis.from_url(REDIS_URL)) # Sites move to the other nodes at once
+
+# Function to copy what notifications need out of the session, as they may be sent after the session is closed
+def detached_copy(site: Site, webhooks: list[Webhook]):
+    return Site(id=site.id, url=site.url, name=site.name), [Webhook(site_id=webhook.site_id, discord_webhook_url=webhook.discord_webhook_url) for webhook in webhooks]
+
+# Function run once a buffered history row is committed, it becomes the cached last state of its site and a status change is notified
+def history_written(entry: SiteStatusHistory, notify=None):
+    remember_state(entry)
+    if notify is not None:
+        notify()
+
+# Function to store the result of one status check, and notify if the status changed
+# Returns the previous status of the site, None when it has none
+def record_status(db: Session, site: Site, webhooks: list[Webhook], new_status: StatusType, response_time: int | None, start_time: datetime, database_optisation: bool, timings: str | None = None):
+    rollup_writer.add(site.id, new_status, response_time, start_time) # Rollups count every check, even when the history only keeps changes
 
-    webhooks = get_webhooks(db, site_id)
-    
-    start_time = datetime.now(timezone.utc)
-    
-    # Get the status information by HTTP request, on any error we just catch it
-    try:
-        response = get_website_response(site.url, timeout=DEFAULT_TIMEOUT_SECONDS)
-        response_time = (datetime.now(timezone.utc) - start_time).microseconds // 1000
-        new_status = StatusType.UP if response.status_code == site.expected_status_code else StatusType.DOWN
-    except requests.RequestException:
-        response_time = None
-        new_status = StatusType.DOWN
-        
     # Database optimisation.
     # If true, we do not store every check in database, potentially wasting and slowing the database
     # Only differing status is stored.
     if database_optisation:
-        last_entry = get_last_history_state(db, site)
+        last_entry = get_last_state(db, site) # Served by the redis state cache, the history table is only read on a cache miss
 
         if last_entry and last_entry.status != new_status:
-            history_entry = SiteStatusHistory(site_id=site.id, status=new_status, response_time_ms=response_time, last_checked=start_time, last_status_change=last_entry.last_checked)
+            history_entry = SiteStatusHistory(site_id=site.id, status=new_status, response_time_ms=response_time, probe_timings=timings, last_checked=start_time, last_status_change=last_entry.last_checked)
+            new_state = LastState.from_entry(history_entry) # Taken before the commit expires the entry
             db.add(history_entry)
             db.commit()
+            state_cache.set(site.id, new_state)
             notify_status_change(site, webhooks, history_entry)
+        return last_entry.status if last_entry else None
     # If we do need this then store each status check as normal
+    # Rows go through the write-behind buffer, which writes them in bulk
     else:
-        last_entry = get_last_history_state(db, site)
+        pending_entry = history_writer.last_pending(site.id) # A buffered row is newer than anything in the database or the cache
+        last_entry = LastState.from_entry(pending_entry) if pending_entry else get_last_state(db, site)
         
         # The logic here is that if previous check is similar status then previous_status_change is previous_status_change of previous
         # If not same then previous_status_change is the status time of previous check
@@ -64,15 +175,100 @@ def check_website_status(site_id: int, database_optisation: bool = True):
         else:
             previous_status_change = last_entry.last_status_change
             
-        history_entry = SiteStatusHistory(site_id=site.id, status=new_status, response_time_ms=response_time, last_checked=start_time, last_status_change=previous_status_change)
-        db.add(history_entry)
-        db.commit()
+        history_entry = SiteStatusHistory(site_id=site.id, status=new_status, response_time_ms=response_time, probe_timings=timings, last_checked=start_time, last_status_change=previous_status_change)
         
-        # Still notification will be sent only on differing status change
+        # The row becomes the cached last state only once it is written, the writer may still drop it
+        # Still notification will be sent only on differing status change, and only once the row is written
+        notify = None
         if last_entry and last_entry.status != new_status:
-            notify_status_change(site, webhooks, history_entry)
+            notify = partial(notify_status_change, *detached_copy(site, webhooks), history_entry)
+        history_writer.add(history_entry, partial(history_written, history_entry, notify))
+        return last_entry.status if last_entry else None
 
-    # Reschedule the task to run again after the site's check interval
-    check_website_status.apply_async((site.id, database_optisation), countdown=site.check_interval_seconds)
+# Function to tell the scheduler about the checks that move the next check of their site: DOWN results and status changes
+# Steady UP results keep the regular interval and are not sent, 'outcomes' holds (site_id, new status, previous status)
+def report_outcomes(redis_client: redis.StrictRedis, outcomes: list[tuple[int, StatusType, StatusType | None]]):
+    events = []
+    for site_id, new_status, previous_status in outcomes:
+        changed = previous_status not in (None, StatusType.INITIAL, new_status) # The first check of a site is no transition
+        if changed or new_status == StatusType.DOWN:
+            events.append(f"{site_id}:{new_status.value}:{int(changed)}")
+    if not events:
+        return
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.rpush(OUTCOMES_KEY, *events)
+            pipe.ltrim(OUTCOMES_KEY, -OUTCOMES_MAX_LENGTH, -1)
+            pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not report {len(events)} check outcomes, their sites keep their regular interval : {e}") # The checks themselves are recorded
 
-    db.close()
\ No newline at end of file
+@celery.task
+def check_website_status(site_id: int, database_optisation: bool = True):
+    db: Session = SessionLocal()
+    try: # The session is closed on every path, an early return or an exception must not keep its connection
+        site = get_site(db, site_id)
+        
+        if not site:
+            return
+
+        webhooks = get_webhooks(db, site_id)
+        db.close() # Hand the connection back while the site is probed, the loaded site and webhooks stay readable
+        
+        start_time = datetime.now(timezone.utc)
+        attempts: list[RequestTiming] = []
+        
+        # Get the status information by HTTP request, on any error we just catch it
+        try:
+            response = get_website_response(site.url, timeout=DEFAULT_TIMEOUT_SECONDS, attempts=attempts, spec=ProbeSpec.of(site))
+            response_time = attempts[-1].response_time_ms # Last attempt only, on perf_counter, whole seconds included
+            new_status = StatusType.UP if probe_passed(response, site.expected_status_code) else StatusType.DOWN
+            if HTTP_TIMING_BREAKDOWN:
+                logger.info(f"Checked {site.url}: {attempts[-1]}")
+        except requests.RequestException:
+            response = None
+            response_time = None
+            new_status = StatusType.DOWN
+        observe_check(new_status.value, attempts, response is not None)
+            
+        record_status(db, site, webhooks, new_status, response_time, start_time, database_optisation, encode_timings(attempts))
+
+        # No rescheduling here, the next check is dispatched by the scheduler process (app/scheduler.py)
+    finally:
+        db.close()
+
+# Checks a whole batch of sites in one task, all probes of the batch run concurrently on the asyncio probe engine
+# Batches are dispatched by the scheduler process (app/scheduler.py), which also owns the timing of the next check
+# 'scheduled_at' is the intended check time of the earliest due site of the batch, in epoch seconds, the lag to it is observed in CHECK_LAG_SECONDS
+@celery.task
+def check_website_batch(site_ids: list[int], database_optisation: bool = True, scheduled_at: float | None = None):
+    db: Session = SessionLocal()
+    try:
+        sites = get_sites_by_ids(db, site_ids) # Removed sites simply drop out of the batch
+        if not sites:
+            return
+
+        webhooks = get_webhooks_for_sites(db, [site.id for site in sites])
+        db.close() # Hand the connection back while the batch is probed, the loaded sites and webhooks stay readable
+        if scheduled_at is not None:
+            CHECK_LAG_SECONDS.observe(max(0.0, time.time() - scheduled_at))
+        statuses = state_cache.get_statuses([site.id for site in sites]) # Sites already DOWN get a single attempt
+        results = probe_sites([(site.id, site.url, ProbeSpec.of(site, retry=statuses.get(site.id) != StatusType.DOWN)) for site in sites])
+
+        outcomes = []
+        for site, result in zip(sites, results):
+            if HTTP_TIMING_BREAKDOWN and result.timing is not None:
+                logger.info(f"Checked {site.url}: {result.timing}")
+            new_status = StatusType.UP if probe_passed(result.response, site.expected_status_code) else StatusType.DOWN
+            observe_check(new_status.value, result.attempts, result.response is not None)
+            previous_status = record_status(db, site, webhooks[site.id], new_status, result.response_time_ms, result.started_at, database_optisation, encode_timings(result.attempts))
+            outcomes.append((site.id, new_status, previous_status))
+        report_outcomes(outcomes_redis, outcomes)
+    finally:
+        db.close()
+
+# Trims the raw history to the retention window of each site, dispatched periodically by the scheduler process
+# 'backfill' rolls expired rows into hour and day buckets first, only meaningful when every check is stored (no database optimisation)
+@celery.task
+def compact_site_history(dry_run: bool = False, backfill: bool = True):
+    return compact_history(dry_run=dry_run, backfill=backfill)
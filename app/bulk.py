@@ -0,0 +1,36 @@
+import os
+import json
+from pydantic import BaseModel, ValidationError
+
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "10000")) # Rows accepted by one bulk request
+
+# Function to read the rows of a bulk upload, either a JSON array or NDJSON (one JSON object per line)
+# Returns the rows with their position in the upload, and the errors of NDJSON lines that are not JSON
+def parse_rows(body: bytes, content_type: str):
+    rows, errors = [], []
+    if "ndjson" in content_type:
+        lines = [line for line in body.splitlines() if line.strip()] # Blank lines, such as a trailing one, are not rows
+        for index, line in enumerate(lines):
+            try:
+                rows.append((index, json.loads(line)))
+            except ValueError as e:
+                errors.append({"index": index, "detail": f"Invalid JSON: {e}"})
+    else:
+        data = json.loads(body)
+        if not isinstance(data, list):
+            raise ValueError("Expected a JSON array or NDJSON")
+        rows = list(enumerate(data))
+    if len(rows) + len(errors) > BULK_MAX_ROWS:
+        raise ValueError(f"At most {BULK_MAX_ROWS} rows per request")
+    return rows, errors
+
+# Function to validate parsed rows against a request model, returns the valid ones and an error for each other
+def validate_rows(rows: list[tuple[int, object]], model: type[BaseModel]):
+    valid, errors = [], []
+    for index, row in rows:
+        try:
+            valid.append((index, model.model_validate(row)))
+        except ValidationError as e:
+            error = e.errors()[0]
+            errors.append({"index": index, "detail": f"{'.'.join(str(part) for part in error['loc']) or 'row'}: {error['msg']}"})
+    return valid, errors
@@ -0,0 +1,12 @@
+import os
+from dotenv import load_dotenv
+from celery import Celery
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+NOTIFICATION_QUEUE = "notifications" # Webhook sends get their own queue and worker, so probes never wait on Discord
+
+# The celery app shared by every task module, kept apart so that modules defining tasks do not import each other
+celery = Celery("tasks", broker=REDIS_URL, broker_connection_retry_on_startup=True)
+celery.conf.task_routes = {"app.notification.flush_webhook": {"queue": NOTIFICATION_QUEUE}}
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import logging
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import and_, delete, func, select
+from sqlalchemy.orm import Session
+from app.database import SessionLocal, Site, SiteStatusHistory, SiteStatusRollup, StatusType, as_naive_utc
+from app.rollups import RollupDelta, bucket_start
+
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "30")) # Days of raw history kept for sites without their own retention_days
+ROLLUP_MINUTE_RETENTION_DAYS = int(os.getenv("ROLLUP_MINUTE_RETENTION_DAYS", "7")) # Minute buckets are as many as raw rows, older ones are served by hours and days
+COMPACTION_BATCH_SIZE = int(os.getenv("COMPACTION_BATCH_SIZE", "1000")) # Rows deleted per transaction
+COMPACTION_PAUSE_SECONDS = float(os.getenv("COMPACTION_PAUSE_SECONDS", "0.05")) # Pause between two delete transactions, so the workers get the write lock in between
+
+COARSE_GRANULARITIES = ("hour", "day") # What expired raw rows are rolled into
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# What one compaction run did, or would do in dry-run mode
+@dataclass
+class CompactionReport:
+    dry_run: bool
+    sites: int = 0
+    history_rows_deleted: int = 0
+    rollup_buckets_backfilled: int = 0
+    minute_buckets_deleted: int = 0
+
+# Function to delete the rows matching a condition in batches of COMPACTION_BATCH_SIZE, each in its own short transaction
+# In dry-run mode the rows are only counted
+def delete_in_batches(db: Session, model, condition, dry_run: bool):
+    if dry_run:
+        return db.scalar(select(func.count()).select_from(model).where(condition))
+    deleted = 0
+    while True:
+        ids = db.scalars(select(model.id).where(condition).order_by(model.id).limit(COMPACTION_BATCH_SIZE)).all()
+        if not ids:
+            return deleted
+        db.execute(delete(model).where(model.id.in_(ids)))
+        db.commit()
+        deleted += len(ids)
+        time.sleep(COMPACTION_PAUSE_SECONDS)
+
+# Function to fold the raw rows of a site older than 'cutoff' into hour and day buckets, before they are deleted
+# Only buckets with no rollup yet are written, the ones filled live by the workers already count these checks
+def backfill_rollups(db: Session, site_id: int, cutoff: datetime, dry_run: bool):
+    deltas: dict[tuple[str, datetime], RollupDelta] = {}
+    rows = db.execute(
+        select(SiteStatusHistory.status, SiteStatusHistory.response_time_ms, SiteStatusHistory.last_checked)
+        .where(SiteStatusHistory.site_id == site_id, SiteStatusHistory.last_checked < cutoff, SiteStatusHistory.status.in_([StatusType.UP, StatusType.DOWN]))
+        .execution_options(yield_per=COMPACTION_BATCH_SIZE)
+    )
+    for status, response_time_ms, last_checked in rows:
+        for granularity in COARSE_GRANULARITIES:
+            deltas.setdefault((granularity, bucket_start(last_checked, granularity)), RollupDelta()).add(status, response_time_ms)
+    if not deltas:
+        return 0
+
+    existing = set(db.execute(
+        select(SiteStatusRollup.granularity, SiteStatusRollup.bucket_start)
+        .where(SiteStatusRollup.site_id == site_id, SiteStatusRollup.granularity.in_(COARSE_GRANULARITIES), SiteStatusRollup.bucket_start < cutoff)
+    ).tuples())
+    missing = {key: delta for key, delta in deltas.items() if key not in existing}
+    if not dry_run and missing:
+        for (granularity, start), delta in missing.items():
+            row = SiteStatusRollup(site_id=site_id, granularity=granularity, bucket_start=start, up_count=0, down_count=0, response_time_count=0, response_time_sum=0, latency_histogram="")
+            delta.apply_to(row)
+            db.add(row)
+        db.commit()
+    return len(missing)
+
+# Function to compact the raw history of every site down to its retention window
+# The cutoff is rounded down to a day boundary, so the buckets backfilled from expired rows are always complete
+# The newest row of a site is always kept, it holds the last known state the next check is compared with
+def compact_history(session_factory=SessionLocal, dry_run: bool = False, backfill: bool = True, now: datetime | None = None):
+    now = now or datetime.now(timezone.utc)
+    report = CompactionReport(dry_run=dry_run)
+    db = session_factory()
+    try:
+        sites = db.query(Site.id, Site.retention_days).all()
+        for site_id, retention_days in sites:
+            cutoff = bucket_start(now - timedelta(days=retention_days or HISTORY_RETENTION_DAYS), "day")
+            newest_id = db.scalar(select(SiteStatusHistory.id).where(SiteStatusHistory.site_id == site_id).order_by(SiteStatusHistory.last_checked.desc(), SiteStatusHistory.id.desc()).limit(1))
+            if newest_id is None:
+                continue
+            if backfill:
+                report.rollup_buckets_backfilled += backfill_rollups(db, site_id, cutoff, dry_run)
+            expired = and_(SiteStatusHistory.site_id == site_id, SiteStatusHistory.last_checked < cutoff, SiteStatusHistory.id != newest_id)
+            report.history_rows_deleted += delete_in_batches(db, SiteStatusHistory, expired, dry_run)
+        report.sites = len(sites)
+
+        minute_cutoff = as_naive_utc(now - timedelta(days=ROLLUP_MINUTE_RETENTION_DAYS))
+        expired_minutes = and_(SiteStatusRollup.granularity == "minute", SiteStatusRollup.bucket_start < minute_cutoff)
+        report.minute_buckets_deleted = delete_in_batches(db, SiteStatusRollup, expired_minutes, dry_run)
+    finally:
+        db.close()
+
+    logger.info(f"{'Dry run, would reclaim' if dry_run else 'Compacted'}: {report}")
+    return asdict(report)
+
+if __name__ == "__main__": # Compacting by hand, python -m app.compaction [--dry-run] [--no-backfill]
+    compact_history(dry_run="--dry-run" in sys.argv, backfill="--no-backfill" not in sys.argv)
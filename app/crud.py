@@ -1,16 +1,34 @@
+import base64
 from datetime import datetime, timezone
 from urllib.parse import urlparse
+from sqlalchemy import and_, delete, insert, or_, select
 from sqlalchemy.orm import Session
-from app.database import Site, SiteStatusHistory, StatusType, Webhook
+from app.database import ApiKey, Site, SiteStatusHistory, SiteStatusRollup, StatusType, Webhook, as_naive_utc
 from app.models import SiteCreate, WebhookCreate
 from app.notification import notify_status_change
+from app.response_cache import SITES, WEBHOOKS, invalidate_responses
+from app.state_cache import LastState, forget_state, remember_state, state_cache
+
+# Function to map a SiteCreate onto the columns of the sites table
+def site_values(site_data: SiteCreate):
+    return {
+        "url": str(site_data.url),
+        "name": site_data.name,
+        "check_interval_seconds": site_data.check_interval_seconds,
+        "expected_status_code": site_data.expected_status_code,
+        "retention_days": site_data.retention_days,
+        "probe_mode": site_data.probe_mode,
+        "probe_keyword": site_data.probe_keyword,
+        "probe_max_body_bytes": site_data.probe_max_body_bytes,
+    }
 
 # Function to add a new site to the database
 def add_site(db: Session, site_data: SiteCreate):
-    site = Site(url=str(site_data.url), name=site_data.name, check_interval_seconds=site_data.check_interval_seconds, expected_status_code=site_data.expected_status_code) # Create a Site object from the provided site_data
+    site = Site(**site_values(site_data)) # Create a Site object from the provided site_data
     db.add(site)
     db.commit()
     db.refresh(site)
+    invalidate_responses(SITES) # The cached GET /sites listing is stale
     return site
 
 # Function to create the initial status history entry for a newly added site
@@ -21,6 +39,7 @@ def initial_history(db: Session, site: Site):
     webhooks = get_webhooks(db, site.id) # Retrieve all webhooks associated with this site
     notify_status_change(site, webhooks, initial_history) # Trigger the discord notification for the initial site status
     db.commit()
+    remember_state(initial_history) # Seed the last state cache, so the first check does not query the history
 
 # Function to remove a site from the database by its ID
 def remove_site(db: Session, site_id: int):
@@ -29,6 +48,8 @@ def remove_site(db: Session, site_id: int):
         end_history(db, site) # Create an "END" history entry before removing the site
         db.delete(site)
         db.commit()
+        forget_state(site_id) # Invalidate the cached last state
+        invalidate_responses(SITES)
     return site
 
 # Function to create an "END" status history entry for a site, typically before site removal
@@ -40,6 +61,59 @@ def end_history(db: Session, site: Site):
     notify_status_change(site, webhooks, end_history) # Trigger the discord notification for the initial site status
     db.commit()
     
+# Function to add many sites in one transaction, with bulk inserts for the sites and their initial history
+# URLs already monitored or repeated in the upload are reported as errors, with the position of their row
+def add_sites_bulk(db: Session, sites_data: list[tuple[int, SiteCreate]]):
+    urls = [str(site_data.url) for _, site_data in sites_data]
+    taken = set(db.scalars(select(Site.url).where(Site.url.in_(urls)))) if urls else set()
+    rows, errors = [], []
+    for (index, site_data), url in zip(sites_data, urls):
+        if url in taken:
+            errors.append({"index": index, "detail": f"URL already monitored: {url}"})
+            continue
+        taken.add(url) # Later rows with the same URL are duplicates
+        rows.append(site_values(site_data))
+    if not rows:
+        return [], errors
+
+    site_ids = db.scalars(insert(Site).returning(Site.id, sort_by_parameter_order=True), rows).all()
+    current_time = datetime.now(timezone.utc)
+    db.execute(insert(SiteStatusHistory), [{"site_id": site_id, "status": StatusType.INITIAL, "last_checked": current_time, "last_status_change": current_time} for site_id in site_ids])
+    db.commit()
+    invalidate_responses(SITES)
+
+    sites = get_sites_by_ids(db, site_ids)
+    entries = {site.id: SiteStatusHistory(site_id=site.id, status=StatusType.INITIAL, last_checked=current_time, last_status_change=current_time) for site in sites}
+    state_cache.set_many({site_id: LastState.from_entry(entry) for site_id, entry in entries.items()}) # Seed the last state cache in one round-trip
+    webhooks = get_webhooks_for_sites(db, site_ids) # Webhooks may have been registered before their site
+    for site in sites:
+        if webhooks[site.id]:
+            notify_status_change(site, webhooks[site.id], entries[site.id])
+    return sites, errors
+
+# Function to remove many sites in one transaction, returns the removed sites and the IDs that were not found
+def remove_sites_bulk(db: Session, site_ids: list[int]):
+    sites = get_sites_by_ids(db, site_ids)
+    found_ids = {site.id for site in sites}
+    missing = [site_id for site_id in dict.fromkeys(site_ids) if site_id not in found_ids]
+    if not sites:
+        return [], missing
+
+    webhooks = get_webhooks_for_sites(db, list(found_ids))
+    db.expunge_all() # Detached, so the loaded sites and webhooks stay readable once their rows are gone
+    for model in (SiteStatusHistory, SiteStatusRollup): # Bulk deletes skip the ORM cascade
+        db.execute(delete(model).where(model.site_id.in_(found_ids)))
+    db.execute(delete(Site).where(Site.id.in_(found_ids)))
+    db.commit()
+    state_cache.delete_many(list(found_ids)) # Invalidate the cached last states
+    invalidate_responses(SITES)
+
+    current_time = datetime.now(timezone.utc)
+    for site in sites:
+        if webhooks[site.id]:
+            notify_status_change(site, webhooks[site.id], SiteStatusHistory(site_id=site.id, status=StatusType.END, last_checked=current_time, last_status_change=current_time))
+    return sites, missing
+
 # Function to retrieve a site from the database by its ID
 def get_site(db: Session, site_id: int):
     return db.query(Site).filter(Site.id == site_id).first()
@@ -48,13 +122,81 @@ def get_site(db: Session, site_id: int):
 def get_all_sites(db: Session):
     return db.query(Site).all()
 
+# Function to retrieve several sites at once by their IDs, missing IDs are simply absent
+def get_sites_by_ids(db: Session, site_ids: list[int]):
+    return db.query(Site).filter(Site.id.in_(site_ids)).all()
+
 # Function to retrieve the status history for a specific site
 def get_history(db: Session, site: Site):
-    return db.query(SiteStatusHistory).filter(SiteStatusHistory.site_id == site.id).order_by(SiteStatusHistory.last_checked.desc()).all()
+    return db.query(SiteStatusHistory).filter(SiteStatusHistory.site_id == site.id).order_by(SiteStatusHistory.last_checked.desc(), SiteStatusHistory.id.desc()).all()
+
+# Function to encode the position after a history entry as an opaque cursor
+def encode_cursor(entry: SiteStatusHistory):
+    return base64.urlsafe_b64encode(f"{entry.last_checked.isoformat()}|{entry.id}".encode()).decode()
+
+# Function to decode a cursor back into (last_checked, id), raises ValueError on anything malformed
+def decode_cursor(cursor: str):
+    try:
+        last_checked, entry_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(last_checked), int(entry_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+# Function to build the query of one page of the status history of a site, newest first, shared with app/async_crud.py
+# Keyset pagination on (last_checked, id): each page starts right after the cursor, so deep pages cost the same as the first one
+def history_page_query(site_id: int, limit: int, cursor: str | None = None, since: datetime | None = None, until: datetime | None = None, status: StatusType | None = None):
+    query = select(SiteStatusHistory).where(SiteStatusHistory.site_id == site_id)
+    if since is not None:
+        query = query.where(SiteStatusHistory.last_checked >= as_naive_utc(since))
+    if until is not None:
+        query = query.where(SiteStatusHistory.last_checked < as_naive_utc(until))
+    if status is not None:
+        query = query.where(SiteStatusHistory.status == status)
+    if cursor is not None:
+        last_checked, entry_id = decode_cursor(cursor)
+        query = query.where(or_(SiteStatusHistory.last_checked < last_checked, and_(SiteStatusHistory.last_checked == last_checked, SiteStatusHistory.id < entry_id)))
+    return query.order_by(SiteStatusHistory.last_checked.desc(), SiteStatusHistory.id.desc()).limit(limit + 1) # One extra row tells whether a next page exists
+
+# Function to split the rows of history_page_query into the page and the cursor of the next page
+def history_page(entries: list[SiteStatusHistory], limit: int):
+    next_cursor = encode_cursor(entries[limit - 1]) if len(entries) > limit else None
+    return entries[:limit], next_cursor
+
+# Function to retrieve one page of the status history of a site, newest first
+def get_history_page(db: Session, site: Site, limit: int, cursor: str | None = None, since: datetime | None = None, until: datetime | None = None, status: StatusType | None = None):
+    entries = db.scalars(history_page_query(site.id, limit, cursor, since, until, status)).all()
+    return history_page(entries, limit)
+
+# Function to stream the status history of some sites (all sites when site_ids is empty), oldest first
+# Rows are plain tuples fetched yield_per at a time through a server-side cursor, so memory does not grow with the export
+def stream_history(db: Session, site_ids: list[int] | None = None, since: datetime | None = None, until: datetime | None = None, yield_per: int = 1000):
+    yield from db.execute(export_query(site_ids, since, until).execution_options(stream_results=True, yield_per=yield_per))
+
+# Function to build the query of the history rows to export, oldest first, shared by the sync and async (app/async_crud.py) streams
+def export_query(site_ids: list[int] | None = None, since: datetime | None = None, until: datetime | None = None):
+    query = select(SiteStatusHistory.site_id, SiteStatusHistory.status, SiteStatusHistory.response_time_ms, SiteStatusHistory.last_checked, SiteStatusHistory.last_status_change)
+    if site_ids:
+        query = query.where(SiteStatusHistory.site_id.in_(site_ids))
+    if since is not None:
+        query = query.where(SiteStatusHistory.last_checked >= as_naive_utc(since))
+    if until is not None:
+        query = query.where(SiteStatusHistory.last_checked < as_naive_utc(until))
+    return query.order_by(SiteStatusHistory.last_checked, SiteStatusHistory.id)
 
 # Function to retrieve the most recent status history entry for a specific site
 def get_last_history_state(db: Session, site: Site):
-    return db.query(SiteStatusHistory).filter(SiteStatusHistory.site_id == site.id).order_by(SiteStatusHistory.last_checked.desc()).first()
+    return db.query(SiteStatusHistory).filter(SiteStatusHistory.site_id == site.id).order_by(SiteStatusHistory.last_checked.desc(), SiteStatusHistory.id.desc()).first()
+
+# Function to retrieve the last state of a site, from the redis cache when possible, else from the database (and then cached)
+def get_last_state(db: Session, site: Site):
+    state = state_cache.get(site.id)
+    if state is None:
+        entry = get_last_history_state(db, site)
+        if entry is None:
+            return None
+        state = LastState.from_entry(entry)
+        state_cache.set(site.id, state)
+    return state
 
 # Function to create a new webhook in the database
 def create_webhook(db: Session, webhook_data: WebhookCreate):
@@ -62,6 +204,7 @@ def create_webhook(db: Session, webhook_data: WebhookCreate):
     db.add(webhook)
     db.commit()
     db.refresh(webhook)
+    invalidate_responses(WEBHOOKS) # The cached GET /webhooks listing is stale
     return webhook
 
 # Function to retrieve all webhooks from the database
@@ -72,10 +215,74 @@ def get_all_webhooks(db: Session):
 def get_webhooks(db: Session, site_id: int):
     return db.query(Webhook).filter(Webhook.site_id == site_id).all()
 
+# Function to retrieve the webhooks of several sites at once, grouped by site ID
+def get_webhooks_for_sites(db: Session, site_ids: list[int]):
+    webhooks: dict[int, list[Webhook]] = {site_id: [] for site_id in site_ids}
+    for webhook in db.query(Webhook).filter(Webhook.site_id.in_(site_ids)).all():
+        webhooks[webhook.site_id].append(webhook)
+    return webhooks
+
+# Function to add many webhooks in one transaction, webhook URLs already registered or repeated in the upload are reported as errors
+def create_webhooks_bulk(db: Session, webhooks_data: list[tuple[int, WebhookCreate]]):
+    urls = [webhook_data.discord_webhook_url for _, webhook_data in webhooks_data]
+    taken = set(db.scalars(select(Webhook.discord_webhook_url).where(Webhook.discord_webhook_url.in_(urls)))) if urls else set()
+    rows, errors = [], []
+    for index, webhook_data in webhooks_data:
+        if webhook_data.discord_webhook_url in taken:
+            errors.append({"index": index, "detail": f"Webhook already registered: {webhook_data.discord_webhook_url}"})
+            continue
+        taken.add(webhook_data.discord_webhook_url)
+        rows.append({"site_id": webhook_data.site_id, "discord_webhook_url": webhook_data.discord_webhook_url})
+    if not rows:
+        return [], errors
+
+    webhook_ids = db.scalars(insert(Webhook).returning(Webhook.id, sort_by_parameter_order=True), rows).all()
+    db.commit()
+    invalidate_responses(WEBHOOKS)
+    return db.query(Webhook).filter(Webhook.id.in_(webhook_ids)).all(), errors
+
+# Function to remove many webhooks in one transaction, returns the removed webhooks and the IDs that were not found
+def remove_webhooks_bulk(db: Session, webhook_ids: list[int]):
+    webhooks = db.query(Webhook).filter(Webhook.id.in_(webhook_ids)).all()
+    found_ids = {webhook.id for webhook in webhooks}
+    missing = [webhook_id for webhook_id in dict.fromkeys(webhook_ids) if webhook_id not in found_ids]
+    if webhooks:
+        db.expunge_all() # Detached, so the loaded webhooks stay readable once their rows are gone
+        db.execute(delete(Webhook).where(Webhook.id.in_(found_ids)))
+        db.commit()
+        invalidate_responses(WEBHOOKS)
+    return webhooks, missing
+
 # Function to remove a webhook from the database by its ID
 def remove_webhook(db: Session, webhook_id: int): # Query the database to find the webhook with the given ID
     webhook = db.query(Webhook).filter(Webhook.id == webhook_id).first()
     if webhook:
         db.delete(webhook)
         db.commit()
-    return webhook
\ No newline at end of file
+        invalidate_responses(WEBHOOKS)
+    return webhook
+
+# Function to store a new API key, only its hash and prefix are kept
+def create_api_key(db: Session, name: str, scopes: list[str], prefix: str, key_hash: str):
+    api_key = ApiKey(name=name, scopes=",".join(scopes), prefix=prefix, key_hash=key_hash, created_at=datetime.now(timezone.utc))
+    db.add(api_key)
+    db.commit()
+    db.refresh(api_key)
+    return api_key
+
+# Function to retrieve all API keys, revoked ones included
+def get_all_api_keys(db: Session):
+    return db.query(ApiKey).all()
+
+# Function to retrieve an API key by the hash of the key
+def get_api_key_by_hash(db: Session, key_hash: str):
+    return db.query(ApiKey).filter(ApiKey.key_hash == key_hash).first()
+
+# Function to revoke an API key by its ID, the row is kept
+def revoke_api_key(db: Session, api_key_id: int):
+    api_key = db.query(ApiKey).filter(ApiKey.id == api_key_id).first()
+    if api_key and api_key.revoked_at is None:
+        api_key.revoked_at = datetime.now(timezone.utc)
+        db.commit()
+        db.refresh(api_key)
+    return api_key
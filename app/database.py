@@ -1,16 +1,188 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, Enum
+import time
+import logging
+import threading
+from sqlalchemy import event, create_engine, Column, Integer, String, ForeignKey, DateTime, Enum, Index, UniqueConstraint
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 import enum
 from datetime import datetime, timezone
+from app.metrics import DB_COMMIT_SECONDS
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./web_monitor.db")
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# The async driver of each sync URL scheme, aiosqlite for SQLite and asyncpg for Postgres
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg", "postgresql+psycopg2": "postgresql+asyncpg"}
+
+# Function to derive the URL of the async engine from the sync one, same database through its async driver
+def async_database_url(url: str):
+    scheme, separator, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}{separator}{rest}"
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", async_database_url(DATABASE_URL))
+
+# SQLite production profile, for the API and the workers writing to the same SQLite file
+SQLITE_PRODUCTION = os.getenv("SQLITE_PRODUCTION", "0") == "1" # WAL, tuned pragmas and one writer at a time per process
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL") # With WAL, NORMAL only fsyncs at checkpoints, a power loss may drop the last commits but never corrupts
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536")) # Page cache per connection
+SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256")) # Reads through memory mapping instead of read() calls
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")) # How long a writer waits for the lock held by another process before 'database is locked'
+
+# Connection pool of each engine, per process, size it for the threads or greenlets using the database at once
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5")) # Connections kept open
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10")) # Extra connections opened under load, closed once given back
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30")) # How long a session waits for a free connection before failing
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "-1")) # Connections older than this are replaced on checkout, -1 never
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1" # Test each connection on checkout and replace it when dead, for database servers
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+WRITER_LOCK_KEY = "sqlite_writer_lock" # Set in the info of a connection while it holds the writer lock
+
+logger = logging.getLogger(__name__)
+
+# Records how long checkouts wait for a connection, on top of the counts the pool already keeps
+# The wait includes opening a new connection when the pool may still overflow
+class PoolWaitMixin:
+    checkouts = 0
+    wait_seconds_total = 0.0
+    wait_seconds_max = 0.0
+    timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+class InstrumentedQueuePool(PoolWaitMixin, QueuePool):
+    pass
+
+class InstrumentedAsyncQueuePool(PoolWaitMixin, AsyncAdaptedQueuePool):
+    pass
+
+# Function to get the pool arguments of create_engine, in-memory SQLite keeps its own pool as every connection is a separate database
+def pool_options(url: str, poolclass):
+    if url.startswith("sqlite") and (":memory:" in url or url.rstrip("/").endswith(":")):
+        return {}
+    return {"poolclass": poolclass, "pool_size": DB_POOL_SIZE, "max_overflow": DB_POOL_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT_SECONDS, "pool_recycle": DB_POOL_RECYCLE_SECONDS, "pool_pre_ping": DB_POOL_PRE_PING}
+
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, **pool_options(DATABASE_URL, InstrumentedQueuePool))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine used by the read routes of the API (see app/async_crud.py), Celery and everything else stay on the sync one
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL, InstrumentedAsyncQueuePool))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False) # Loaded objects stay readable without a lazy load, which async sessions cannot do
+
 Base = declarative_base()
 
+sqlite_writer_lock = threading.Lock() # A gevent lock in gevent workers, they are monkey patched before this is imported
+
+# Function to get the pragmas of the SQLite production profile, run on every new connection
+def sqlite_pragmas():
+    return [
+        "PRAGMA journal_mode=WAL", # Readers no longer block the writer, nor the writer readers
+        f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}",
+        f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size={SQLITE_MMAP_SIZE_MB * 1024 * 1024}",
+        f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+
+# Function to put an engine on the SQLite production profile
+# With a writer lock, write transactions of the process run one at a time: the lock is taken by the first write statement and released after commit or rollback
+# The driver only begins a transaction at that first write, reads before it run on their own, so waiting for the lock never leaves a stale snapshot behind
+# Writers of other processes still meet on the SQLite lock, and wait for it up to SQLITE_BUSY_TIMEOUT_MS
+def configure_sqlite(engine, writer_lock=sqlite_writer_lock):
+    sync_engine = getattr(engine, "sync_engine", engine) # Events of an async engine are registered on its sync engine
+
+    @event.listens_for(sync_engine, "connect")
+    def set_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+
+    if writer_lock is None:
+        return
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def take_writer_lock(connection, cursor, statement, parameters, context, executemany):
+        if WRITER_LOCK_KEY in connection.info or not statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+            return
+        if writer_lock.acquire(timeout=SQLITE_BUSY_TIMEOUT_MS / 1000):
+            connection.info[WRITER_LOCK_KEY] = True
+        else: # Never wait forever, for instance on a second session of the same thread, SQLite's own locking takes over
+            logger.warning(f"SQLite writer lock not acquired within {SQLITE_BUSY_TIMEOUT_MS}ms, writing without it")
+
+    def release_writer_lock(info: dict):
+        if info.pop(WRITER_LOCK_KEY, None):
+            writer_lock.release()
+
+    def pooled_info(dbapi_connection):
+        try:
+            return dbapi_connection.info
+        except (AttributeError, NotImplementedError): # Connections outside the pool, such as the one the dialect is set up on
+            return {}
+
+    # Released once the driver has committed, not on the 'commit' event which comes before, so the next writer never finds the SQLite lock still held
+    dialect = sync_engine.dialect
+    do_commit, do_rollback = dialect.do_commit, dialect.do_rollback
+
+    def commit(dbapi_connection):
+        try:
+            do_commit(dbapi_connection)
+        finally:
+            release_writer_lock(pooled_info(dbapi_connection))
+
+    def rollback(dbapi_connection):
+        try:
+            do_rollback(dbapi_connection)
+        finally:
+            release_writer_lock(pooled_info(dbapi_connection))
+
+    dialect.do_commit, dialect.do_rollback = commit, rollback # Pool resets also roll back through the dialect
+    event.listen(sync_engine, "invalidate", lambda dbapi_connection, connection_record, exception: release_writer_lock(connection_record.info)) # Connections dropped mid-transaction
+
+if SQLITE_PRODUCTION and engine.dialect.name == "sqlite":
+    configure_sqlite(engine)
+    configure_sqlite(async_engine, writer_lock=None) # Only reads go through it, and a blocking lock has no place on the event loop
+
+# Function to observe the driver's commit time of an engine in DB_COMMIT_SECONDS, every CRUD function and history flush commits through it
+def instrument_commits(engine, name: str):
+    dialect = getattr(engine, "sync_engine", engine).dialect
+    do_commit = dialect.do_commit
+    histogram = DB_COMMIT_SECONDS.labels(name)
+
+    def commit(dbapi_connection):
+        start = time.perf_counter()
+        try:
+            do_commit(dbapi_connection)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    dialect.do_commit = commit
+
+instrument_commits(engine, "sync")
+instrument_commits(async_engine, "async")
+
+# SQLite hands back naive datetimes, we always store UTC so they are made aware again before comparing them
+def as_utc(value: datetime):
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+# Timestamps are stored as naive UTC, so aware values coming from the API are converted before filtering on them
+def as_naive_utc(value: datetime):
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo is not None else value
+
 # Defining an Enum for website status types
 class StatusType(str, enum.Enum):
     INITIAL = "INITIAL" # When a site is added
@@ -18,6 +190,14 @@ class StatusType(str, enum.Enum):
     DOWN = "DOWN" # When the site check is failure
     END = "END" # When a site is removed
 
+# Defining an Enum for how a site is checked, each mode only costs what it needs
+class ProbeMode(str, enum.Enum):
+    GET = "GET" # Full GET, the whole body is downloaded
+    HEAD = "HEAD" # HEAD, falls back to a streamed GET when the server does not allow HEAD
+    STREAM = "STREAM" # GET closed as soon as the status line and headers arrived
+    BODY = "BODY" # GET whose body is read until the keyword is found, at most probe_max_body_bytes
+    TCP = "TCP" # Connect only, with the TLS handshake for https, any status code is fine
+
 # Represents each individual site
 class Site(Base):
     __tablename__ = "sites"
@@ -27,9 +207,14 @@ class Site(Base):
     name = Column(String, nullable=True)
     check_interval_seconds = Column(Integer, default=300) # default 5 min
     expected_status_code = Column(Integer, default=200)
+    retention_days = Column(Integer, nullable=True) # Days of raw history kept, empty means HISTORY_RETENTION_DAYS
+    probe_mode = Column(Enum(ProbeMode), nullable=False, default=ProbeMode.GET)
+    probe_keyword = Column(String, nullable=True) # Text the body must contain, BODY mode only
+    probe_max_body_bytes = Column(Integer, nullable=True) # Body read at most in BODY mode, empty means PROBE_MAX_BODY_BYTES
     
     # Foreign key, so that on delete the history is deleted automatically
     status_history = relationship("SiteStatusHistory", back_populates="site", cascade="all, delete")   
+    rollups = relationship("SiteStatusRollup", cascade="all, delete")
 
 # Represents each statuc check stored
 class SiteStatusHistory(Base):
@@ -39,23 +224,107 @@ class SiteStatusHistory(Base):
     site_id = Column(Integer, ForeignKey("sites.id", ondelete="CASCADE")) # Foreign key
     status = Column(Enum(StatusType), nullable=False)
     response_time_ms = Column(Integer, nullable=True)
+    probe_timings = Column(String, nullable=True) # DNS, connect, TLS, TTFB and total of each attempt, see encode_timings in app/http_pool.py
     last_checked = Column(DateTime, default=datetime.now(timezone.utc)) # Time when this check was made
     last_status_change = Column(DateTime, default=datetime.now(timezone.utc)) # Time when the last differing (in status) check was made
 
     # Again foreign key
     site = relationship("Site", back_populates="status_history")
+
+    # History is always read per site, newest first (id breaks ties between equal timestamps)
+    # Time range reads across all sites use the last_checked index
+    __table_args__ = (
+        Index("ix_site_status_history_site_id_last_checked", "site_id", last_checked.desc(), id.desc()),
+        Index("ix_site_status_history_last_checked", "last_checked"),
+    )
     
+# Pre-aggregated checks of a site over one time bucket (see app/rollups.py)
+# Each site has one row per bucket at every granularity: minute, hour and day
+class SiteStatusRollup(Base):
+    __tablename__ = "site_status_rollups"
+
+    id = Column(Integer, primary_key=True)
+    site_id = Column(Integer, ForeignKey("sites.id", ondelete="CASCADE"), nullable=False)
+    granularity = Column(String, nullable=False) # minute, hour or day
+    bucket_start = Column(DateTime, nullable=False) # Naive UTC, truncated to the granularity
+    up_count = Column(Integer, nullable=False, default=0)
+    down_count = Column(Integer, nullable=False, default=0)
+    response_time_count = Column(Integer, nullable=False, default=0) # Checks that got a response, failed requests have no response time
+    response_time_sum = Column(Integer, nullable=False, default=0)
+    response_time_min = Column(Integer, nullable=True)
+    response_time_max = Column(Integer, nullable=True)
+    latency_histogram = Column(String, nullable=False, default="") # Comma separated counts per LATENCY_BUCKETS_MS bound, the last one counts everything above
+
+    # Reads are always one site and granularity over a time range
+    __table_args__ = (
+        UniqueConstraint("site_id", "granularity", "bucket_start", name="uq_site_status_rollups_bucket"),
+    )
+
 # This just stores the webhooks for each site
 class Webhook(Base):
     __tablename__ = "webhooks"
 
     id = Column(Integer, primary_key=True, index=True)
-    site_id = Column(Integer, nullable=False) # No foreign key, so that we can fill any we wish by http request, without worrying over whether the site is presnt or not
+    site_id = Column(Integer, nullable=False, index=True) # No foreign key, so that we can fill any we wish by http request, without worrying over whether the site is presnt or not
     discord_webhook_url = Column(String, unique=True, nullable=False)
 
-# create all the tables
+# API keys for automation, only a SHA-256 hash of each key is stored (see app/authetication.py)
+class ApiKey(Base):
+    __tablename__ = "api_keys"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)
+    prefix = Column(String, nullable=False) # First characters of the key, to tell keys apart without storing them
+    key_hash = Column(String, unique=True, nullable=False)
+    scopes = Column(String, nullable=False) # Comma separated: read, write, admin
+    created_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime, nullable=True) # Revoked keys are kept, so their use can still be told apart from a wrong key
+
+# Records the schema migrations applied to this database (see app/migrations.py)
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, nullable=False)
+
+# Dependency function to get a database session
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Dependency function to get an async database session, so the route waits on the database without holding a threadpool thread
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Function to get the state of the connection pool of an engine
+def pool_stats(engine):
+    pool = getattr(engine, "sync_engine", engine).pool
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+    checkouts = getattr(pool, "checkouts", 0)
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_out": pool.checkedout(), # In use by a session right now
+        "checked_in": pool.checkedin(), # Open and idle
+        "overflow": max(pool.overflow(), 0), # Opened beyond the pool size, negative while the pool is not yet full
+        "checkouts": checkouts,
+        "wait_ms_avg": round(getattr(pool, "wait_seconds_total", 0.0) / checkouts * 1000, 3) if checkouts else 0.0,
+        "wait_ms_max": round(getattr(pool, "wait_seconds_max", 0.0) * 1000, 3),
+        "timeouts": getattr(pool, "timeouts", 0), # Checkouts that gave up after DB_POOL_TIMEOUT_SECONDS
+    }
+
+# create all the tables, then bring existing databases up to date
 def init_db():
     Base.metadata.create_all(bind=engine)
+    from app.migrations import apply_migrations # Imported here, migrations itself builds on these models
+    apply_migrations(engine)
     
 # drop all the tables
 def remove_db():
@@ -0,0 +1,160 @@
+import os
+import time
+import socket
+import asyncio
+import ipaddress
+import threading
+from collections import OrderedDict
+from functools import partial
+from dataclasses import dataclass
+
+DNS_CACHE_TTL_SECONDS = float(os.getenv("DNS_CACHE_TTL_SECONDS", "60")) # How long a resolved host is reused, the system resolver gives no TTL so keep it under the records' own, 0 disables the cache
+DNS_CACHE_STALE_SECONDS = float(os.getenv("DNS_CACHE_STALE_SECONDS", "300")) # How long past its TTL an entry is still used while the resolver fails temporarily
+DNS_CACHE_NEGATIVE_SECONDS = float(os.getenv("DNS_CACHE_NEGATIVE_SECONDS", "5")) # How long a host that does not exist is remembered
+DNS_CACHE_SIZE = int(os.getenv("DNS_CACHE_SIZE", "10000")) # Hosts kept, least recently used ones are dropped first
+
+# Addresses of a host, or the error telling it does not exist
+@dataclass
+class DnsEntry:
+    addresses: list[str] | None
+    error: socket.gaierror | None
+    expires: float
+
+# In-process TTL and LRU cache of resolved host names, shared by every check of a worker process, sync and async
+# A temporary resolver failure (EAI_AGAIN, ...) falls back on the expired entry for up to DNS_CACHE_STALE_SECONDS, so a DNS hiccup does not mark sites DOWN
+# Concurrent async lookups of the same host share one resolution
+class DnsCache:
+    def __init__(self, ttl: float = DNS_CACHE_TTL_SECONDS, stale: float = DNS_CACHE_STALE_SECONDS, negative: float = DNS_CACHE_NEGATIVE_SECONDS, size: int = DNS_CACHE_SIZE, resolver=None):
+        self.ttl = ttl
+        self.stale = stale
+        self.negative = negative
+        self.size = size
+        self.resolver = resolver # socket.getaddrinfo when None, looked up on each call so gevent's patched one is used
+        self._entries: OrderedDict[tuple[str, int], DnsEntry] = OrderedDict()
+        self._lock = threading.Lock() # Used from gevent greenlets and from the probe loop thread
+        self._inflight: dict[tuple[str, int], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.errors = 0
+
+    # Function to resolve a host to the addresses to connect to, in the order the resolver gave them, raises socket.gaierror
+    def resolve(self, host: str, family: int = socket.AF_UNSPEC):
+        if is_ip_address(host):
+            return [host]
+        key = (host, family)
+        entry = self._fresh(key)
+        if entry is not None:
+            return self._answer(entry)
+        self._count_miss()
+        try:
+            return self._store(key, self._lookup(host, family))
+        except socket.gaierror as e:
+            return self._failed(key, e)
+
+    # Same on the event loop, the blocking resolver runs in the loop's executor as loop.getaddrinfo does
+    async def resolve_async(self, host: str, family: int = socket.AF_UNSPEC):
+        if is_ip_address(host):
+            return [host]
+        key = (host, family)
+        entry = self._fresh(key)
+        if entry is not None:
+            return self._answer(entry)
+        loop = asyncio.get_running_loop()
+        future = self._inflight.get(key)
+        if future is None or future.get_loop() is not loop:
+            self._count_miss()
+            future = loop.run_in_executor(None, self._lookup, host, family)
+            self._inflight[key] = future
+            future.add_done_callback(partial(self._lookup_done, key))
+        else:
+            self._count_hit() # Joins the lookup already in flight
+        try:
+            addresses = await asyncio.shield(future) # A waiter timing out does not cancel the lookup the others wait for
+        except socket.gaierror as e:
+            return self._failed(key, e)
+        return self._store(key, addresses)
+
+    # A lookup started from another event loop may have replaced this one meanwhile, it stays in flight
+    def _lookup_done(self, key: tuple[str, int], future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+    def _lookup(self, host: str, family: int):
+        addresses = []
+        for *_, sockaddr in (self.resolver or socket.getaddrinfo)(host, None, family, socket.SOCK_STREAM):
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses
+
+    def _fresh(self, key: tuple[str, int]):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires < time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # Misses are lookups sent to the resolver, waiters sharing one count as hits
+    def _count_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def _count_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def _answer(self, entry: DnsEntry):
+        if entry.addresses is None:
+            raise entry.error
+        return entry.addresses
+
+    def _store(self, key: tuple[str, int], addresses: list[str] | None, error: socket.gaierror | None = None):
+        ttl = self.ttl if error is None else self.negative
+        if ttl > 0:
+            with self._lock:
+                self._entries[key] = DnsEntry(addresses, error, time.monotonic() + ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return addresses
+
+    # A host that does not exist is remembered for a short while, other failures are temporary and fall back on the expired entry
+    def _failed(self, key: tuple[str, int], error: socket.gaierror):
+        if error.errno == socket.EAI_NONAME:
+            self._store(key, None, error)
+            raise error
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.addresses is not None and entry.expires + self.stale >= time.monotonic():
+                self.stale_hits += 1
+                return entry.addresses
+            self.errors += 1
+        raise error
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else None,
+                "stale_hits": self.stale_hits,
+                "errors": self.errors,
+            }
+
+dns_cache = DnsCache()
+
+# Literal addresses need no resolution, and would only fill the cache
+def is_ip_address(host: str):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
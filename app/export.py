@@ -0,0 +1,40 @@
+import io
+import csv
+import json
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.async_crud import stream_history
+
+EXPORT_FIELDS = ["site_id", "status", "response_time_ms", "last_checked", "last_status_change"]
+EXPORT_CHUNK_ROWS = 1000 # Rows serialized together into one chunk of the response
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Function to turn one history row into the values written out
+def export_values(row):
+    site_id, status, response_time_ms, last_checked, last_status_change = row
+    return [site_id, status.value, response_time_ms, last_checked.isoformat(), last_status_change.isoformat()]
+
+# Function to serialize a list of rows in the requested format
+def serialize_rows(rows: list, export_format: str):
+    if export_format == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue()
+    return "".join(json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n" for row in rows)
+
+# Generator of the export body, written chunk by chunk as rows arrive from the database
+# It owns the session, which is closed once the last chunk is sent (or the client goes away)
+async def export_history(db: AsyncSession, site_ids: list[int], since: datetime | None, until: datetime | None, export_format: str):
+    try:
+        if export_format == "csv":
+            yield ",".join(EXPORT_FIELDS) + "\n"
+        rows = []
+        async for row in stream_history(db, site_ids, since, until, yield_per=EXPORT_CHUNK_ROWS):
+            rows.append(export_values(row))
+            if len(rows) == EXPORT_CHUNK_ROWS:
+                yield serialize_rows(rows, export_format)
+                rows = []
+        if rows:
+            yield serialize_rows(rows, export_format)
+    finally:
+        await db.close()
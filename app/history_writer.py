@@ -0,0 +1,189 @@
+import os
+import time
+import logging
+import threading
+from typing import Callable
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from app.database import SessionLocal, SiteStatusHistory
+from app.metrics import HISTORY_ROWS_DROPPED
+
+HISTORY_FLUSH_SIZE = int(os.getenv("HISTORY_FLUSH_SIZE", "500")) # Buffered rows that trigger a flush
+HISTORY_FLUSH_SECONDS = float(os.getenv("HISTORY_FLUSH_SECONDS", "1")) # Longest time a row waits in the buffer
+HISTORY_BUFFER_MAX_ROWS = int(os.getenv("HISTORY_BUFFER_MAX_ROWS", "100000")) # Rows kept at most while the database cannot be written, the oldest are dropped first
+
+logger = logging.getLogger(__name__)
+
+# Write-behind buffer for SiteStatusHistory rows
+# Rows are collected in memory and written with one bulk INSERT (executemany) once HISTORY_FLUSH_SIZE rows are buffered
+# or HISTORY_FLUSH_SECONDS have passed, so a worker pays one commit per batch instead of one per check
+# Callbacks given with a row, such as notifications, only run after the commit that wrote it
+# A batch the database rejects (IntegrityError, e.g. the site was deleted meanwhile) is written row by row and the rejected rows dropped,
+# on any other error the batch stays buffered for the next flush, up to max_rows
+class HistoryWriter:
+    def __init__(self, session_factory=SessionLocal, flush_size: int = HISTORY_FLUSH_SIZE, flush_seconds: float = HISTORY_FLUSH_SECONDS, max_rows: int = HISTORY_BUFFER_MAX_ROWS):
+        self.session_factory = session_factory
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.max_rows = max_rows
+        self._entries: list[tuple[SiteStatusHistory, Callable[[], None] | None]] = [] # Each row with its callback
+        self._latest: dict[int, SiteStatusHistory] = {} # Latest buffered entry of each site, seen by the next check before it is flushed
+        self._lock = threading.Lock() # Guards the buffer
+        self._flush_lock = threading.Lock() # One flush at a time, keeps rows of a site in order
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._thread_pid: int | None = None
+
+        # Counters
+        self.flushes = 0
+        self.flush_errors = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+        self.last_flush_seconds = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._entries)
+
+    # Queue an entry, 'on_written' is called once it is committed
+    def add(self, entry: SiteStatusHistory, on_written: Callable[[], None] | None = None):
+        self._ensure_thread()
+        with self._lock:
+            self._entries.append((entry, on_written))
+            self._latest[entry.site_id] = entry
+            self._trim()
+            full = len(self._entries) >= self.flush_size
+        if full:
+            self.flush()
+
+    # Latest buffered entry for the site, None when everything of it was already flushed
+    def last_pending(self, site_id: int):
+        return self._latest.get(site_id)
+
+    # Write everything buffered so far in one transaction, then run the callbacks of the written rows
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._entries = self._entries, []
+            if not pending:
+                return
+
+            start = time.perf_counter()
+            try:
+                written, left = self._write(pending)
+            except Exception as e:
+                logger.error(f"Error flushing {len(pending)} history rows, they stay buffered : {e}")
+                written, left = [], pending
+            if left:
+                self.flush_errors += 1
+                with self._lock: # Put them back in front, so that order is kept for the next attempt
+                    self._entries[:0] = left
+                    self._trim()
+            else:
+                elapsed = time.perf_counter() - start
+                self.flushes += 1
+                self.last_flush_seconds = elapsed
+                self.flush_seconds_total += elapsed
+                self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+            self.rows_written += len(written)
+
+            with self._lock:
+                for entry, _ in pending[:len(pending) - len(left)]:
+                    if self._latest.get(entry.site_id) is entry:
+                        del self._latest[entry.site_id] # Written or dropped, the database is up to date for this site again
+
+            # Still under the flush lock, so the callbacks of a site run in the order its rows were written
+            for _, callback in written:
+                if callback is None:
+                    continue
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Error in history write callback : {e}")
+
+    # Function to insert the rows in one transaction, or one transaction per row when the database rejects the batch, rejected rows are dropped
+    # Returns the written rows and the rows left to write, raises when the batch fails for another reason
+    def _write(self, pending: list[tuple[SiteStatusHistory, Callable[[], None] | None]]):
+        db = self.session_factory()
+        try:
+            try:
+                db.execute(insert(SiteStatusHistory), [history_row(entry) for entry, _ in pending])
+                db.commit()
+                return pending, []
+            except IntegrityError as e:
+                db.rollback()
+                logger.warning(f"History batch of {len(pending)} rows rejected, writing it row by row : {e}")
+            except Exception:
+                db.rollback()
+                raise
+
+            written = []
+            for index, (entry, callback) in enumerate(pending):
+                try:
+                    db.execute(insert(SiteStatusHistory), [history_row(entry)])
+                    db.commit()
+                except IntegrityError as e:
+                    db.rollback()
+                    self._drop(1, "rejected")
+                    logger.error(f"Dropped the history row of site {entry.site_id}, rejected by the database : {e}")
+                    continue
+                except Exception as e:
+                    db.rollback()
+                    logger.error(f"Error writing history rows one by one, {len(pending) - index} stay buffered : {e}")
+                    return written, pending[index:]
+                written.append((entry, callback))
+            return written, []
+        finally:
+            db.close()
+
+    # Drop the oldest rows beyond max_rows, with their callbacks, called with the lock held
+    def _trim(self):
+        excess = len(self._entries) - self.max_rows
+        if excess <= 0:
+            return
+        for entry, _ in self._entries[:excess]:
+            if self._latest.get(entry.site_id) is entry:
+                del self._latest[entry.site_id]
+        del self._entries[:excess]
+        self._drop(excess, "overflow")
+        logger.error(f"History buffer full, dropped its {excess} oldest rows")
+
+    def _drop(self, count: int, reason: str):
+        self.rows_dropped += count
+        HISTORY_ROWS_DROPPED.labels(reason).inc(count)
+
+    # Counters for flush latency and queue depth
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "rows_written": self.rows_written,
+            "rows_dropped": self.rows_dropped,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 3),
+            "avg_flush_ms": round(self.flush_seconds_total / self.flushes * 1000, 3) if self.flushes else 0.0,
+            "max_flush_ms": round(self.flush_seconds_max * 1000, 3),
+        }
+
+    # Background flusher for the time threshold, started lazily and once per process
+    def _ensure_thread(self):
+        if self._thread is None or self._thread_pid != os.getpid():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    # Stop the flusher and write whatever is left, called on worker shutdown
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+# Columns of a buffered entry, as given to the bulk insert
+def history_row(entry: SiteStatusHistory):
+    return {"site_id": entry.site_id, "status": entry.status, "response_time_ms": entry.response_time_ms, "probe_timings": entry.probe_timings, "last_checked": entry.last_checked, "last_status_change": entry.last_status_change}
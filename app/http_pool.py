@@ -0,0 +1,329 @@
+import os
+import ssl
+import time
+import socket
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from urllib.parse import urlparse
+import httpx
+import httpcore
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, HTTPError as Urllib3Error, NameResolutionError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+from app.dns_cache import dns_cache
+
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "100")) # Number of hosts whose connection pools are kept alive
+HTTP_POOL_SIZE_PER_HOST = int(os.getenv("HTTP_POOL_SIZE_PER_HOST", "10")) # Keep-alive connections kept per host
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "30")) # Idle time before a pooled connection is closed
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", os.getenv("PROBE_MAX_CONCURRENCY", "1000"))) # Connections open at once for the async client
+HTTP_TIMING_BREAKDOWN = os.getenv("HTTP_TIMING_BREAKDOWN", "0") == "1" # Log the DNS, connect, TLS and time to first byte breakdown of every check
+
+TIMING_FIELDS = ("dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "total_ms")
+
+# DNS, connect, TLS, time to first byte and total time of one request attempt, in milliseconds, from time.perf_counter
+# dns_ms, connect_ms and tls_ms stay None when a pooled keep-alive connection was reused
+@dataclass
+class RequestTiming:
+    dns_ms: float | None = None
+    connect_ms: float | None = None
+    tls_ms: float | None = None
+    ttfb_ms: float | None = None
+    total_ms: float | None = None
+
+    @property
+    def reused(self):
+        return self.connect_ms is None
+
+    # Whole milliseconds, as stored in SiteStatusHistory.response_time_ms
+    @property
+    def response_time_ms(self):
+        return None if self.total_ms is None else round(self.total_ms)
+
+    def __str__(self):
+        def ms(value):
+            return "-" if value is None else f"{value:.1f}ms"
+        return f"dns={ms(self.dns_ms)} connect={ms(self.connect_ms)} tls={ms(self.tls_ms)} ttfb={ms(self.ttfb_ms)} total={ms(self.total_ms)} reused={self.reused}"
+
+# Function to pack the timings of every attempt of a check, stored in SiteStatusHistory.probe_timings
+# Attempts are separated by ';', each is 'dns,connect,tls,ttfb,total' in milliseconds with one decimal, empty when not measured
+def encode_timings(attempts: list[RequestTiming]):
+    if not attempts:
+        return None
+    return ";".join(",".join("" if value is None else f"{value:.1f}" for value in (getattr(timing, field) for field in TIMING_FIELDS)) for timing in attempts)
+
+# Function to unpack SiteStatusHistory.probe_timings, the reverse of encode_timings
+def decode_timings(encoded: str | None):
+    if not encoded:
+        return []
+    return [RequestTiming(*(float(value) if value else None for value in attempt.split(","))) for attempt in encoded.split(";")]
+
+# Timing of the request currently made by this thread/greenlet, None when nobody is measuring
+_current_timing: ContextVar[RequestTiming | None] = ContextVar("current_timing", default=None)
+
+# Context manager to measure the request made through the shared session inside its block, total_ms covers the whole block
+@contextmanager
+def measure_timing(timing: RequestTiming | None = None):
+    timing = timing if timing is not None else RequestTiming()
+    token = _current_timing.set(timing)
+    start = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        timing.total_ms = (time.perf_counter() - start) * 1000
+        _current_timing.reset(token)
+
+# urllib3 connection hooks filling the current RequestTiming, they cost a few perf_counter calls when nobody is measuring
+class _TimedConnectionMixin:
+    _request_started: float = 0.0
+    _connected_at: float = 0.0
+
+    # The name is resolved here, through the process DNS cache and timed apart from connect, then each address is tried in turn as urllib3 would
+    def _new_conn(self):
+        timing = _current_timing.get()
+        host = self._dns_host
+        start = time.perf_counter()
+        try:
+            addresses = dns_cache.resolve(host, allowed_gai_family())
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        resolved = time.perf_counter()
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address # TLS still verifies self.host
+                try:
+                    sock = super()._new_conn()
+                    break
+                except (NewConnectionError, ConnectTimeoutError):
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+        if timing is not None:
+            timing.dns_ms = (resolved - start) * 1000
+            timing.connect_ms = (time.perf_counter() - resolved) * 1000
+        return sock
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        self._connected_at = time.perf_counter()
+        timing = _current_timing.get()
+        if timing is not None and isinstance(self, HTTPSConnection) and timing.connect_ms is not None:
+            timing.tls_ms = (self._connected_at - start) * 1000 - (timing.dns_ms or 0) - timing.connect_ms
+
+    def request(self, *args, **kwargs):
+        self._request_started = time.perf_counter()
+        return super().request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        timing = _current_timing.get()
+        if timing is not None:
+            sent = max(self._request_started, self._connected_at) # Plain HTTP connects lazily inside request()
+            timing.ttfb_ms = (time.perf_counter() - sent) * 1000
+        return response
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+# requests adapter keeping HTTP_POOL_SIZE_PER_HOST keep-alive connections for each of HTTP_POOL_HOSTS hosts
+class PooledAdapter(HTTPAdapter):
+    def __init__(self):
+        super().__init__(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE_PER_HOST)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+_session: requests.Session | None = None
+_session_pid: int | None = None
+
+# Function to get the requests session shared by every check and webhook send of this worker process
+# Created lazily and per process, so that forked workers never share sockets
+def get_session():
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = PooledAdapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _session, _session_pid = session, os.getpid()
+    return _session
+
+# httpcore network backend resolving names through the process DNS cache, so that the current RequestTiming gets DNS and connect times apart
+# Each address is tried in turn, errors are mapped to the httpcore exceptions the wrapped backend would raise
+class TimedNetworkBackend(httpcore.AsyncNetworkBackend):
+    def __init__(self, backend: httpcore.AsyncNetworkBackend):
+        self.backend = backend
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        timing = _current_timing.get()
+        start = time.perf_counter()
+        try:
+            addresses = await asyncio.wait_for(dns_cache.resolve_async(host), timeout)
+        except asyncio.TimeoutError as e:
+            raise httpcore.ConnectTimeout(f"Resolving {host} timed out") from e
+        except socket.gaierror as e:
+            raise httpcore.ConnectError(str(e)) from e
+        resolved = time.perf_counter()
+        for i, address in enumerate(addresses):
+            try:
+                stream = await self.backend.connect_tcp(address, port, timeout, local_address, socket_options) # TLS still verifies the origin host
+                break
+            except (httpcore.ConnectError, httpcore.ConnectTimeout):
+                if i == len(addresses) - 1:
+                    raise
+        if timing is not None:
+            timing.dns_ms = (resolved - start) * 1000
+            timing.connect_ms = (time.perf_counter() - resolved) * 1000
+        return stream
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self.backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+# httpcore exceptions and the httpx ones they are raised as, subclasses first
+HTTPCORE_ERRORS = [
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.ProxyError, httpx.ProxyError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.ProtocolError, httpx.ProtocolError),
+]
+
+# Function to raise httpcore exceptions as their httpx counterparts, other exceptions go through unchanged
+@contextmanager
+def httpx_errors():
+    try:
+        yield
+    except Exception as e:
+        for httpcore_error, httpx_error in HTTPCORE_ERRORS:
+            if isinstance(e, httpcore_error):
+                raise httpx_error(str(e)) from e
+        raise
+
+# Body of a response of TimedTransport, raising httpx exceptions like the rest of the client
+class TimedResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def __aiter__(self):
+        with httpx_errors():
+            async for chunk in self.stream:
+                yield chunk
+
+    async def aclose(self):
+        if hasattr(self.stream, "aclose"):
+            with httpx_errors():
+                await self.stream.aclose()
+
+# httpx transport over an httpcore connection pool of our own, whose connections are opened through TimedNetworkBackend
+class TimedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, limits: httpx.Limits):
+        self.pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=TimedNetworkBackend(httpcore.AnyIOBackend()),
+        )
+
+    async def handle_async_request(self, request: httpx.Request):
+        url = httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host, port=request.url.port, target=request.url.raw_path)
+        core_request = httpcore.Request(method=request.method, url=url, headers=request.headers.raw, content=request.stream, extensions=request.extensions)
+        with httpx_errors():
+            response = await self.pool.handle_async_request(core_request)
+        return httpx.Response(status_code=response.status, headers=response.headers, stream=TimedResponseStream(response.stream), extensions=response.extensions)
+
+    async def aclose(self):
+        await self.pool.aclose()
+
+# Function to create the pooled async client, it must be created and used on a single event loop
+def create_async_client(timeout: float):
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_POOL_HOSTS * HTTP_POOL_SIZE_PER_HOST, keepalive_expiry=HTTP_KEEPALIVE_SECONDS)
+    return httpx.AsyncClient(timeout=timeout, transport=TimedTransport(limits), follow_redirects=True) # Redirects followed like requests does on the sync path
+
+# Function to build an httpx trace hook filling the TLS and time to first byte of the given RequestTiming, passed as extensions={"trace": ...}
+def trace_timing(timing: RequestTiming):
+    started: dict[str, float] = {}
+
+    async def trace(event_name: str, info: dict):
+        now = time.perf_counter()
+        step, _, phase = event_name.rpartition(".")
+        if phase == "started":
+            started[step] = now
+        elif phase == "complete":
+            if step == "connection.start_tls":
+                timing.tls_ms = (now - started[step]) * 1000
+            elif step.endswith(".receive_response_headers"):
+                sent = step.replace("receive_response_headers", "send_request_headers")
+                timing.ttfb_ms = (now - started.get(sent, now)) * 1000
+
+    return trace
+
+# Function to open and close a connection to the host of a URL, with the TLS handshake for https, the TCP probe mode
+# Goes through the timed connection classes, so the current RequestTiming gets DNS, connect and TLS
+def connect_only(url: str, timeout: float):
+    parsed = urlparse(url)
+    if parsed.scheme == "https":
+        connection = TimedHTTPSConnection(parsed.hostname, parsed.port or 443, timeout=timeout, ca_certs=DEFAULT_CA_BUNDLE_PATH) # Same CA bundle as requests
+    else:
+        connection = TimedHTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+    try:
+        connection.connect()
+    except (Urllib3Error, OSError) as e:
+        raise requests.ConnectionError(e) from e
+    finally:
+        connection.close()
+
+_tcp_backend = TimedNetworkBackend(httpcore.AnyIOBackend())
+_ssl_context: ssl.SSLContext | None = None
+
+# Same as connect_only, on the event loop, errors are raised as the httpx exceptions the other probes raise
+async def connect_only_async(url: str, timeout: float | None):
+    global _ssl_context
+    parsed = urlparse(url)
+    https = parsed.scheme == "https"
+    try:
+        stream = await _tcp_backend.connect_tcp(parsed.hostname, parsed.port or (443 if https else 80), timeout)
+        try:
+            if https:
+                if _ssl_context is None:
+                    _ssl_context = ssl.create_default_context(cafile=DEFAULT_CA_BUNDLE_PATH)
+                start = time.perf_counter()
+                stream = await stream.start_tls(_ssl_context, server_hostname=parsed.hostname, timeout=timeout)
+                timing = _current_timing.get()
+                if timing is not None:
+                    timing.tls_ms = (time.perf_counter() - start) * 1000
+        finally:
+            await stream.aclose()
+    except httpcore.TimeoutException as e:
+        raise httpx.ConnectTimeout(str(e)) from e
+    except (httpcore.NetworkError, OSError) as e:
+        raise httpx.ConnectError(str(e)) from e
@@ -0,0 +1,118 @@
+import os
+import logging
+from typing import Callable
+from prometheus_client import REGISTRY, Counter, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.exposition import choose_encoder
+from app.dns_cache import dns_cache
+from app.http_pool import RequestTiming
+
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9808")) # Port of the metrics exporter of each Celery worker, 0 disables it
+
+logger = logging.getLogger(__name__)
+
+# Prometheus metrics of the API and worker processes, each process exposes its own (GET /metrics on the API, WORKER_METRICS_PORT on workers)
+# Counters and histograms cost a lock and an addition per observation, labels only take a few fixed values so series stay bounded
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+
+CHECKS = Counter("webmonitor_checks", "Site checks made, by resulting status", ["status"])
+PROBE_SECONDS = Histogram("webmonitor_probe_seconds", "Total time of the last attempt of checks the site answered", buckets=LATENCY_BUCKETS)
+PROBE_PHASE_SECONDS = Histogram("webmonitor_probe_phase_seconds", "DNS, connect, TLS and time to first byte of checks the site answered, new connections only for the first three", ["phase"], buckets=LATENCY_BUCKETS)
+PROBE_BUDGET_WAIT_SECONDS = Counter("webmonitor_probe_budget_wait_seconds", "Time checks waited for their turn under PROBE_MAX_PER_SECOND")
+PROBE_RETRIES = Counter("webmonitor_probe_retries", "Check attempts retried after a failed first attempt")
+CHECK_LAG_SECONDS = Histogram("webmonitor_check_lag_seconds", "Time from the intended check time to the start of the probes, for the most late site of each batch", buckets=LAG_BUCKETS)
+HISTORY_ROWS_DROPPED = Counter("webmonitor_history_rows_dropped", "Buffered history rows dropped, rejected by the database or beyond HISTORY_BUFFER_MAX_ROWS", ["reason"])
+ROLLUP_BUCKETS_DROPPED = Counter("webmonitor_rollup_buckets_dropped", "Buffered rollup buckets dropped, rejected by the database or beyond ROLLUP_BUFFER_MAX_BUCKETS", ["reason"])
+DB_COMMIT_SECONDS = Histogram("webmonitor_db_commit_seconds", "Time the database driver took to commit", ["engine"], buckets=DB_BUCKETS)
+NOTIFICATIONS = Counter("webmonitor_notifications", "Status change notifications queued, one per webhook", ["status"])
+WEBHOOK_SEND_SECONDS = Histogram("webmonitor_webhook_send_seconds", "Time to send one message to a Discord webhook, by outcome (sent, rate_limited, failed)", ["outcome"], buckets=LATENCY_BUCKETS)
+HTTP_REQUEST_SECONDS = Histogram("webmonitor_http_request_seconds", "Time the API took to answer, by route template and status code", ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+RATE_LIMITED = Counter("webmonitor_rate_limited_requests", "Requests rejected with 429 by the rate limiter")
+RATE_LIMITER_ERRORS = Counter("webmonitor_rate_limiter_errors", "Requests let through without rate limiting because redis was unavailable")
+
+# Function to count one check and observe its timing breakdown, 'attempts' as filled by get_website_response(_async)
+# Latencies are only observed when the site answered, otherwise the total would only be the time to fail
+def observe_check(status: str, attempts: list[RequestTiming], answered: bool):
+    CHECKS.labels(status).inc()
+    if len(attempts) > 1:
+        PROBE_RETRIES.inc(len(attempts) - 1)
+    timing = attempts[-1] if attempts else None
+    if timing is None or not answered:
+        return
+    PROBE_SECONDS.observe(timing.total_ms / 1000)
+    for phase in ("dns", "connect", "tls", "ttfb"):
+        value = getattr(timing, f"{phase}_ms")
+        if value is not None:
+            PROBE_PHASE_SECONDS.labels(phase).observe(value / 1000)
+
+# Exposes pool_stats of the tracked database engines as gauges and counters, read at scrape time so checkouts cost nothing more
+class PoolCollector:
+    def __init__(self):
+        self.pools: dict[str, Callable[[], dict]] = {}
+
+    def track(self, name: str, stats: Callable[[], dict]):
+        self.pools[name] = stats
+
+    def describe(self): # Metric names are only known once a pool is tracked
+        return []
+
+    def collect(self):
+        gauges = {field: GaugeMetricFamily(f"webmonitor_db_pool_{field}", help, labels=["engine"]) for field, help in [
+            ("size", "Connections kept open by the pool"),
+            ("checked_out", "Connections in use"),
+            ("overflow", "Connections open beyond the pool size"),
+            ("wait_seconds_max", "Longest wait for a connection"),
+        ]}
+        counters = {field: CounterMetricFamily(f"webmonitor_db_pool_{field}", help, labels=["engine"]) for field, help in [
+            ("checkouts", "Connections handed out by the pool"),
+            ("timeouts", "Checkouts given up after DB_POOL_TIMEOUT_SECONDS"),
+        ]}
+        for name, stats in self.pools.items():
+            values = stats()
+            for field in ("size", "checked_out", "overflow"):
+                if values.get(field) is not None:
+                    gauges[field].add_metric([name], values[field])
+            if values.get("wait_ms_max") is not None:
+                gauges["wait_seconds_max"].add_metric([name], values["wait_ms_max"] / 1000)
+            for field in counters:
+                if values.get(field) is not None:
+                    counters[field].add_metric([name], values[field])
+        yield from gauges.values()
+        yield from counters.values()
+
+pool_collector = PoolCollector()
+REGISTRY.register(pool_collector)
+
+# Exposes the counters of the process DNS cache, read at scrape time
+class DnsCacheCollector:
+    def collect(self):
+        stats = dns_cache.stats()
+        yield GaugeMetricFamily("webmonitor_dns_cache_entries", "Host names held by the DNS cache", value=stats["entries"])
+        for field, help in [
+            ("hits", "Lookups answered by the DNS cache"),
+            ("misses", "Lookups sent to the resolver"),
+            ("stale_hits", "Lookups answered by an expired entry because the resolver failed temporarily"),
+            ("errors", "Lookups that failed with nothing to fall back on"),
+        ]:
+            yield CounterMetricFamily(f"webmonitor_dns_cache_{field}", help, value=stats[field])
+
+REGISTRY.register(DnsCacheCollector())
+
+# Function to render the metrics of this process, in the OpenMetrics format when the scraper asks for it, returns the body and its content type
+def render_metrics(accept: str | None):
+    encoder, content_type = choose_encoder(accept)
+    return encoder(REGISTRY), content_type
+
+# Function to start the metrics exporter of a worker process, a second worker on the same host only logs that the port is taken
+def start_worker_exporter(port: int = WORKER_METRICS_PORT):
+    if port <= 0:
+        return False
+    try:
+        start_http_server(port)
+    except OSError as e:
+        logger.warning(f"Worker metrics exporter not started on port {port} : {e}")
+        return False
+    logger.info(f"Worker metrics exported on port {port}")
+    return True
@@ -1,32 +1,129 @@
 # app/middleware.py
-from fastapi import FastAPI, Request, Response, HTTPException, status
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Callable
+from fastapi import status
+from starlette.datastructures import MutableHeaders
 from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 import redis
-import time
+import redis.asyncio
+from app.metrics import HTTP_REQUEST_SECONDS, RATE_LIMITED, RATE_LIMITER_ERRORS
+
+MAX_LEASES = 10000 # Past this number of local buckets, expired ones are dropped
+
+logger = logging.getLogger(__name__)
+
+# Sliding window counter, in one round-trip and atomically
+# Counts live in one key per fixed window, the previous window is weighted by how much of it still overlaps the sliding window
+# 'pending' are requests already let through by the local fast path, they are always counted, the new request only when it fits
+# Time comes from redis, so every API process agrees on the window boundaries
+SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local pending = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local index = math.floor(now / window)
+local current_key = KEYS[1] .. ':' .. index
+local previous = tonumber(redis.call('GET', KEYS[1] .. ':' .. (index - 1)) or '0')
+local current = tonumber(redis.call('GET', current_key) or '0')
+if pending > 0 then
+    current = redis.call('INCRBY', current_key, pending)
+    if current == pending then redis.call('EXPIRE', current_key, window * 2) end
+end
+local count = math.floor(previous * (1 - (now - index * window) / window)) + current
+local reset = math.ceil((index + 1) * window - now)
+if count >= limit then
+    return {0, count, reset}
+end
+current = redis.call('INCR', current_key)
+if current == 1 then redis.call('EXPIRE', current_key, window * 2) end
+return {1, count + 1, reset}
+"""
+
+# Requests a client may make in this process without asking redis, leased from its remaining quota
+@dataclass
+class LocalLease:
+    tokens: int = 0 # Requests still allowed locally
+    pending: int = 0 # Requests let through locally, reported to redis on the next round-trip
+    remaining: int = 0 # Remaining quota reported by redis when the lease was given
+    reset: int = 0
+    expires: float = 0.0
+
+# Function to wrap 'send' so that some headers are added to the response once it starts
+# Every other message, body chunks included, goes straight through, so streaming responses stay streamed
+def send_with_headers(send: Send, headers: Callable[[], dict[str, str]]):
+    async def wrapped(message: Message):
+        if message["type"] == "http.response.start":
+            MutableHeaders(scope=message).update(headers())
+        await send(message)
+    return wrapped
 
 # Define a custom middleware 'RateLimiterMiddleware' for Rate Limiting purposes
-class RateLimiterMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app: FastAPI, redis_url: str, limit: int, window: int):
-        super().__init__(app)
-        self.redis_client = redis.StrictRedis.from_url(redis_url) # Creating a Redis client using the provided Redis URL
+# Pure ASGI middleware, receive and send are passed through untouched apart from the rate limit headers
+# With 'local_fraction' > 0, clients well under their limit are let through from a local token bucket of limit * local_fraction requests,
+# refilled by each redis round-trip, so such clients need one round-trip per bucket instead of one per request
+class RateLimiterMiddleware:
+    def __init__(self, app: ASGIApp, redis_url: str, limit: int, window: int, local_fraction: float = 0.0):
+        self.app = app
+        self.redis_url = redis_url
         self.limit = limit # Setting the request limit for the rate limiter.
         self.window = window # Setting the time window (in seconds) for the rate limiter
+        self.local_tokens = int(limit * local_fraction) # Size of the local bucket, 0 disables the fast path
+        self.leases: dict[str, LocalLease] = {}
+        self._redis_client = None
+        self._script = None
+        self._loop = None
+
+    # The async client is bound to the event loop it was created on
+    def script(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._redis_client = redis.asyncio.StrictRedis.from_url(self.redis_url) # Creating a Redis client using the provided Redis URL
+            self._script = self._redis_client.register_script(SLIDING_WINDOW_SCRIPT) # Sent once, then called by its SHA
+            self._loop = loop
+        return self._script
+
+    # Function to decide on one request, returns whether it is allowed, the remaining quota and the seconds until the window resets
+    async def hit(self, client_ip: str):
+        lease = self.leases.get(client_ip)
+        now = time.monotonic()
+        if lease is not None and lease.tokens > 0 and now < lease.expires: # Fast path, no round-trip
+            lease.tokens -= 1
+            lease.pending += 1
+            return True, lease.remaining - lease.pending, lease.reset
+
+        self.leases.pop(client_ip, None) # Taken out before awaiting, so concurrent requests never report the same pending hits twice
+        pending = lease.pending if lease is not None else 0
+        allowed, count, reset = await self.script()(keys=[f"rate_limit:{client_ip}"], args=[self.limit, self.window, pending])
+        remaining = max(0, self.limit - count)
+        if self.local_tokens and remaining > 2 * self.local_tokens: # Only clients well under their limit get a lease
+            if len(self.leases) >= MAX_LEASES:
+                self.leases = {ip: lease for ip, lease in self.leases.items() if lease.expires > now}
+            self.leases[client_ip] = LocalLease(tokens=self.local_tokens, remaining=remaining, reset=reset, expires=now + min(reset, self.window))
+        return bool(allowed), remaining, reset
 
     # Handle each incoming request
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        client_ip = request.client.host # The client's IP address from the request
-        key = f"rate_limit:{client_ip}" # Constructing a unique key for Redis to store the request count for each client IP
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http": # Lifespan and websockets are not rate limited
+            await self.app(scope, receive, send)
+            return
+        client_ip = scope["client"][0] if scope.get("client") else "unknown" # The client's IP address from the request
 
-        now = int(time.time())
-        with self.redis_client.pipeline() as pipe:
-            pipe.incr(key)# Incrementing the request count for the client IP in Redis. If the key doesn't exist, it's initialized to 1.
-            pipe.expire(key, self.window) # Set an expiry time for key
-            count, _ = pipe.execute() # 'count' will be the incremented value
+        try:
+            allowed, remaining, reset_time = await self.hit(client_ip)
+        except redis.RedisError as e: # Fail open, an unavailable redis must not take the API down with it
+            logger.warning(f"Rate limiter unavailable : {e}")
+            RATE_LIMITER_ERRORS.inc()
+            await self.app(scope, receive, send)
+            return
 
         # Check if the request count for the client IP exceeds the defined limit.
-        if count > self.limit:
-            reset_time = self.window - (now % self.window)
+        if not allowed:
+            RATE_LIMITED.inc()
             headers = {
                 # Defining headers to be included in the rate limit exceeded response
                 "X-RateLimit-Limit": str(self.limit),
@@ -34,14 +131,54 @@ class RateLimiterMiddleware(BaseHTTPMiddleware):
                 "X-RateLimit-Reset": str(reset_time),
                 "Retry-After": str(reset_time)
             }
-            return JSONResponse(
+            response = JSONResponse(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                 content={"detail": "Rate limit exceeded"},
                 headers=headers
             )
+            await response(scope, receive, send)
+            return
+
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(remaining), # Add the remaining requests
+            "X-RateLimit-Reset": str(reset_time), # Add the reset time to the response headers
+        }
+        await self.app(scope, receive, send_with_headers(send, lambda: headers))
+
+# Adds the time the app took until the response started, in milliseconds, as X-Process-Time-Ms
+class TimingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        await self.app(scope, receive, send_with_headers(send, lambda: {"X-Process-Time-Ms": f"{(time.perf_counter() - start) * 1000:.2f}"}))
+
+# Observes the time the app took to answer each request in HTTP_REQUEST_SECONDS, until the last body chunk is sent
+# Requests are labelled by route template (/sites/{site_id}), so the number of series does not grow with IDs, unknown paths share one label
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status_code = 500 # Unless a response starts
+
+        async def wrapped(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
 
-        response = await call_next(request)
-        response.headers["X-RateLimit-Limit"] = str(self.limit)
-        response.headers["X-RateLimit-Remaining"] = str(max(0, self.limit - count)) # Add the remaining requests
-        response.headers["X-RateLimit-Reset"] = str(self.window - (now % self.window)) # Add the reset time to the response headers
-        return response
\ No newline at end of file
+        try:
+            await self.app(scope, receive, wrapped)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched") # Set by the router on the shared scope once a route matched
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, str(status_code)).observe(time.perf_counter() - start)
@@ -0,0 +1,78 @@
+import logging
+from datetime import datetime, timezone
+from sqlalchemy import inspect
+from sqlalchemy.types import SchemaType
+from sqlalchemy.engine import Connection, Engine
+from app.database import ProbeMode, SchemaMigration, Site, SiteStatusHistory, Webhook, engine, init_db
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Schema changes for databases created before a model changed, create_all only ever adds missing tables
+# Every migration runs once, in order, and must be safe on a database where create_all already did the work
+
+# Function to create an index of a model unless it already exists
+def create_index(connection: Connection, table, name: str):
+    index = next(index for index in table.indexes if index.name == name)
+    index.create(bind=connection, checkfirst=True)
+
+# Function to add a column of a model to an existing table unless it is already there, the column must be nullable or have a server default
+def add_column(connection: Connection, table, name: str):
+    if name in {column["name"] for column in inspect(connection).get_columns(table.name)}:
+        return
+    column = table.columns[name]
+    if isinstance(column.type, SchemaType):
+        column.type.create(connection, checkfirst=True) # Named types such as PostgreSQL enums must exist before a column uses them, a no-op elsewhere
+    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=connection.dialect)}")
+
+# 1 - History is read per site, newest first, this replaces a full scan plus sort by an index range scan
+def add_history_site_time_index(connection: Connection):
+    create_index(connection, SiteStatusHistory.__table__, "ix_site_status_history_site_id_last_checked")
+
+# 2 - Time range reads across all sites (exports, retention)
+def add_history_time_index(connection: Connection):
+    create_index(connection, SiteStatusHistory.__table__, "ix_site_status_history_last_checked")
+
+# 3 - Webhooks are looked up by site on every notification
+def add_webhook_site_index(connection: Connection):
+    create_index(connection, Webhook.__table__, "ix_webhooks_site_id")
+
+# 4 - Raw history retention of each site, empty means HISTORY_RETENTION_DAYS (see app/compaction.py)
+def add_site_retention_days(connection: Connection):
+    add_column(connection, Site.__table__, "retention_days")
+
+# 5 - Timing breakdown of the attempts of each check
+def add_history_probe_timings(connection: Connection):
+    add_column(connection, SiteStatusHistory.__table__, "probe_timings")
+
+# 6 - Probe mode of each site, sites already there keep the full GET
+def add_site_probe_mode(connection: Connection):
+    for name in ("probe_mode", "probe_keyword", "probe_max_body_bytes"):
+        add_column(connection, Site.__table__, name)
+    connection.execute(Site.__table__.update().where(Site.probe_mode.is_(None)).values(probe_mode=ProbeMode.GET)) # Added as nullable, SQLite cannot add a NOT NULL column without a default
+
+MIGRATIONS = [
+    (1, "composite index on site_status_history (site_id, last_checked DESC, id DESC)", add_history_site_time_index),
+    (2, "index on site_status_history (last_checked)", add_history_time_index),
+    (3, "index on webhooks (site_id)", add_webhook_site_index),
+    (4, "sites.retention_days", add_site_retention_days),
+    (5, "site_status_history.probe_timings", add_history_probe_timings),
+    (6, "sites.probe_mode, probe_keyword and probe_max_body_bytes", add_site_probe_mode),
+]
+
+# Function to apply every migration not yet recorded in schema_migrations, each one in its own transaction
+def apply_migrations(bind: Engine = engine):
+    SchemaMigration.__table__.create(bind=bind, checkfirst=True)
+    with bind.connect() as connection:
+        applied = {row.version for row in connection.execute(SchemaMigration.__table__.select())}
+
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with bind.begin() as connection:
+            migrate(connection)
+            connection.execute(SchemaMigration.__table__.insert().values(version=version, description=description, applied_at=datetime.now(timezone.utc)))
+        logger.info(f"Applied migration {version}: {description}")
+
+if __name__ == "__main__": # Migrating a database directly, python -m app.migrations
+    init_db() # Creates missing tables, then applies the migrations
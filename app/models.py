@@ -1,5 +1,7 @@
-from pydantic import BaseModel, HttpUrl
+from typing import Literal
+from pydantic import BaseModel, Field, HttpUrl, field_validator, model_validator
 from datetime import datetime
+from app.http_pool import decode_timings
 
 # These are the models used to encpsulate the data in HTTP cycle, not the way in which it is stored in database
 
@@ -9,6 +11,19 @@ class SiteCreate(BaseModel):
     name: str
     check_interval_seconds: int = 300
     expected_status_code: int = 200
+    retention_days: int | None = Field(None, ge=1) # Days of raw history kept, the server default when empty
+    probe_mode: Literal["GET", "HEAD", "STREAM", "BODY", "TCP"] = "GET" # How the site is checked, see ProbeMode
+    probe_keyword: str | None = Field(None, min_length=1) # Text the body must contain, BODY mode only
+    probe_max_body_bytes: int | None = Field(None, ge=1) # Body read at most in BODY mode, the server default when empty
+
+    # A keyword is only looked for in BODY mode, and BODY mode has nothing to do without one
+    @model_validator(mode="after")
+    def check_keyword(self):
+        if self.probe_mode == "BODY" and self.probe_keyword is None:
+            raise ValueError("probe_keyword is required with probe_mode BODY")
+        if self.probe_mode != "BODY" and (self.probe_keyword is not None or self.probe_max_body_bytes is not None):
+            raise ValueError("probe_keyword and probe_max_body_bytes need probe_mode BODY")
+        return self
 
 # For representing a website's details in API responses
 class SiteResponse(SiteCreate):
@@ -17,16 +32,66 @@ class SiteResponse(SiteCreate):
     class Config:
         from_attributes = True
 
+# For representing the timing of one attempt of a check, in milliseconds, None when not measured (e.g. a reused connection has no DNS or connect)
+class ProbeTimingResponse(BaseModel):
+    dns_ms: float | None
+    connect_ms: float | None
+    tls_ms: float | None
+    ttfb_ms: float | None
+    total_ms: float | None
+
+    class Config:
+        from_attributes = True
+
 # For representing a website's status history entry in API responses
 class SiteStatusHistoryResponse(BaseModel):
     status: str # UP, DOWN, INITIAL, END
-    response_time_ms: int | None
+    response_time_ms: int | None # Total time of the last attempt
+    probe_timings: list[ProbeTimingResponse] = [] # One per attempt, a failed first attempt is retried once
     last_checked: datetime
     last_status_change: datetime
 
+    # Stored packed in one column
+    @field_validator("probe_timings", mode="before")
+    @classmethod
+    def unpack_timings(cls, value):
+        return decode_timings(value) if value is None or isinstance(value, str) else value
+
     class Config:
         from_attributes = True
     
+# For representing one page of a website's status history, pass next_cursor as 'cursor' to get the following page
+class SiteStatusHistoryPage(BaseModel):
+    items: list[SiteStatusHistoryResponse]
+    next_cursor: str | None
+
+# For representing one rollup bucket of a website's stats
+class SiteStatsBucket(BaseModel):
+    bucket_start: datetime
+    up_count: int
+    down_count: int
+    avg_response_time_ms: float | None
+    min_response_time_ms: int | None
+    max_response_time_ms: int | None
+
+# For representing the uptime and latency of a website over a time range, percentiles are estimated from the latency histogram
+class SiteStatsResponse(BaseModel):
+    site_id: int
+    granularity: str # minute, hour or day
+    since: datetime
+    until: datetime
+    checks: int
+    up_count: int
+    down_count: int
+    uptime_percent: float | None
+    avg_response_time_ms: float | None
+    min_response_time_ms: int | None
+    max_response_time_ms: int | None
+    p50_response_time_ms: int | None
+    p95_response_time_ms: int | None
+    p99_response_time_ms: int | None
+    buckets: list[SiteStatsBucket]
+
 # For creating a new webhook   
 class WebhookCreate(BaseModel):
     site_id: int
@@ -39,6 +104,69 @@ class WebhookResponse(WebhookCreate):
     class Config:
         from_attributes = True
       
+# For reporting a row of a bulk upload that was not applied, 'index' is its position in the upload
+class BulkRowError(BaseModel):
+    index: int
+    detail: str
+
+# For the result of a bulk site upload
+class SiteBulkResponse(BaseModel):
+    created: list[SiteResponse]
+    errors: list[BulkRowError]
+
+# For the result of a bulk webhook upload
+class WebhookBulkResponse(BaseModel):
+    created: list[WebhookResponse]
+    errors: list[BulkRowError]
+
+# For deleting many sites or webhooks at once
+class BulkDelete(BaseModel):
+    ids: list[int] = Field(max_length=10000)
+
+# For the result of a bulk site deletion, 'missing' are the IDs that were not found
+class SiteBulkDeleteResponse(BaseModel):
+    deleted: list[SiteResponse]
+    missing: list[int]
+
+# For the result of a bulk webhook deletion
+class WebhookBulkDeleteResponse(BaseModel):
+    deleted: list[WebhookResponse]
+    missing: list[int]
+
+# For creating a new API key, 'read' allows GET requests, 'write' everything else on sites and webhooks, 'admin' everything
+class ApiKeyCreate(BaseModel):
+    name: str
+    scopes: list[Literal["read", "write", "admin"]] = ["read"]
+
+# For representing an API key in API responses, the key itself is never stored
+class ApiKeyResponse(BaseModel):
+    id: int
+    name: str
+    prefix: str
+    scopes: list[str]
+    created_at: datetime
+    revoked_at: datetime | None
+
+    class Config:
+        from_attributes = True
+
+# For the response to an API key creation, the only time the key is shown
+class ApiKeyCreatedResponse(ApiKeyResponse):
+    key: str
+
+# For representing the connection pool of one engine, counts are per API process
+class PoolStatsResponse(BaseModel):
+    pool: str
+    size: int | None = None
+    max_overflow: int | None = None
+    checked_out: int | None = None
+    checked_in: int | None = None
+    overflow: int | None = None
+    checkouts: int | None = None
+    wait_ms_avg: float | None = None
+    wait_ms_max: float | None = None
+    timeouts: int | None = None
+
 # For simple detail responses, used in error messages  
 class DetailResponse(BaseModel):
     detail: str
@@ -1,9 +1,16 @@
 import os
+import time
+import redis
 import requests
 import logging
+from app.celery_app import REDIS_URL, celery
 from app.database import Site, SiteStatusHistory, StatusType, Webhook
+from app.http_pool import get_session
+from app.metrics import NOTIFICATIONS, WEBHOOK_SEND_SECONDS
 
 DEFAULT_TIMEOUT_SECONDS = int(os.getenv("DEFAULT_TIMEOUT_SECONDS", "10"))
+NOTIFICATION_COALESCE_SECONDS = float(os.getenv("NOTIFICATION_COALESCE_SECONDS", "5")) # Alerts to the same webhook within this window are sent as one message
+DISCORD_MESSAGE_LIMIT = 2000 # Characters allowed in the content of one Discord message
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,14 +21,82 @@ def format_duration(duration_seconds: int):
     minutes, seconds = divmod(remainder, 60)
     return f"{int(hours)}h {int(minutes)}m {int(seconds)}s"
 
+redis_client = redis.StrictRedis.from_url(REDIS_URL)
+
+# Pending messages of a webhook, as a redis list, and the flag telling a flush is already scheduled for it
+def queue_key(webhook_url: str):
+    return f"notifications:{webhook_url}"
+
+def scheduled_key(webhook_url: str):
+    return f"notifications:scheduled:{webhook_url}"
+
 # Function to send a notification message to a Discord webhook URL
+# Returns the seconds to wait when Discord rate limits us (429), None otherwise
 def send_discord_notification(webhook_url: str, message: str):
+    start = time.perf_counter()
+    outcome = "failed"
     try:
         payload = {"content": message}
-        response = requests.post(webhook_url, json=payload, timeout=DEFAULT_TIMEOUT_SECONDS)
+        response = get_session().post(webhook_url, json=payload, timeout=DEFAULT_TIMEOUT_SECONDS) # Reuses the worker's pooled keep-alive connections
+        if response.status_code == 429:
+            outcome = "rate_limited"
+            try:
+                return float(response.json()["retry_after"])
+            except (ValueError, KeyError):
+                return float(response.headers.get("Retry-After", 1))
         response.raise_for_status() # Raise an HTTPError for bad responses
+        outcome = "sent"
     except requests.RequestException as e:
         logger.error(f"Error sending webhook to {webhook_url} : {e.strerror}")
+    finally:
+        WEBHOOK_SEND_SECONDS.labels(outcome).observe(time.perf_counter() - start)
+    return None
+
+# Function to pack queued messages into as few Discord messages as possible, a longer single message is truncated
+def coalesce_messages(messages: list[str]):
+    packed = []
+    for message in messages:
+        message = message[:DISCORD_MESSAGE_LIMIT]
+        if packed and len(packed[-1]) + 2 + len(message) <= DISCORD_MESSAGE_LIMIT:
+            packed[-1] += "\n\n" + message
+        else:
+            packed.append(message)
+    return packed
+
+# Function to schedule the flush of a webhook queue, unless one is already scheduled
+# The flag expires on its own, so a lost task only delays the queue until the next message
+def schedule_flush(webhook_url: str, delay: float):
+    if redis_client.set(scheduled_key(webhook_url), 1, nx=True, ex=int(delay) + 60):
+        flush_webhook.apply_async((webhook_url,), countdown=delay)
+
+# Function to queue a message for a webhook, it is sent by the notifications worker after the coalescing window
+def enqueue_notification(webhook_url: str, message: str):
+    try:
+        redis_client.rpush(queue_key(webhook_url), message)
+        schedule_flush(webhook_url, NOTIFICATION_COALESCE_SECONDS)
+    except redis.RedisError as e:
+        logger.error(f"Error queueing webhook to {webhook_url} : {e}")
+
+# Sends everything queued for one webhook, runs on the notifications queue
+# Webhooks are flushed by separate tasks, so a gevent worker sends to many of them in parallel
+@celery.task
+def flush_webhook(webhook_url: str):
+    redis_client.delete(scheduled_key(webhook_url)) # Cleared first, a message queued from now on schedules the next flush
+    with redis_client.pipeline() as pipe:
+        pipe.lrange(queue_key(webhook_url), 0, -1)
+        pipe.delete(queue_key(webhook_url))
+        messages, _ = pipe.execute()
+    if not messages:
+        return
+
+    packed = coalesce_messages([message.decode() for message in messages])
+    for index, message in enumerate(packed):
+        retry_after = send_discord_notification(webhook_url, message)
+        if retry_after is not None: # Rate limited, the rest goes back in front of the queue and is retried once Discord allows it
+            redis_client.lpush(queue_key(webhook_url), *reversed(packed[index:]))
+            schedule_flush(webhook_url, retry_after)
+            logger.warning(f"Webhook {webhook_url} rate limited, retrying {len(packed) - index} messages in {retry_after}s")
+            return
 
 # Function to generate and send status change notifications
 def notify_status_change(site: Site, webhooks: list[Webhook], history_entry: SiteStatusHistory):
@@ -43,6 +118,7 @@ def notify_status_change(site: Site, webhooks: list[Webhook], history_entry: Sit
     elif status == StatusType.END:
         message = f"🟡 **Website Monitoring End**\n**Site:** {name} ({url})\n**Status:** END\n**Time:** {last_checked}"
 
-    # Iterate through the list of webhooks associated with the site
+    # Iterate through the list of webhooks associated with the site, messages are only queued here and sent by the notifications worker
     for webhook in webhooks:
-        send_discord_notification(webhook.discord_webhook_url, message)
+        enqueue_notification(webhook.discord_webhook_url, message)
+    NOTIFICATIONS.labels(status.value).inc(len(webhooks))
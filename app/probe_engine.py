@@ -0,0 +1,198 @@
+import os
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import httpx
+from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+from app.database import ProbeMode
+from app.http_pool import RequestTiming, connect_only_async, create_async_client, measure_timing, trace_timing
+from app.metrics import PROBE_BUDGET_WAIT_SECONDS
+
+DEFAULT_TIMEOUT_SECONDS = int(os.getenv("DEFAULT_TIMEOUT_SECONDS", "10"))
+PROBE_MAX_CONCURRENCY = int(os.getenv("PROBE_MAX_CONCURRENCY", "1000")) # Checks in flight at once in one worker process
+PROBE_PER_HOST_CONCURRENCY = int(os.getenv("PROBE_PER_HOST_CONCURRENCY", "10")) # Checks in flight at once against a single host
+PROBE_MAX_PER_SECOND = float(os.getenv("PROBE_MAX_PER_SECOND", "0")) # Checks started per second at most by one worker process, 0 for no ceiling
+PROBE_BATCH_SIZE = int(os.getenv("PROBE_BATCH_SIZE", "500")) # Site IDs carried by one batch task
+PROBE_MAX_BODY_BYTES = int(os.getenv("PROBE_MAX_BODY_BYTES", "65536")) # Body read at most by a BODY mode check, unless the site sets its own
+
+HEAD_NOT_ALLOWED = (405, 501) # HEAD answers after which HEAD mode retries with a streamed GET
+
+logging.getLogger("httpx").setLevel(logging.WARNING) # httpx logs every request at INFO, far too noisy for thousands of probes
+
+# How a site is checked, built from its probe_mode, probe_keyword and probe_max_body_bytes
+# 'retry' is False for sites already DOWN, the second attempt is only there to confirm a site going down
+@dataclass(frozen=True)
+class ProbeSpec:
+    mode: ProbeMode = ProbeMode.GET
+    keyword: str | None = None
+    max_body_bytes: int = PROBE_MAX_BODY_BYTES
+    retry: bool = True
+
+    @classmethod
+    def of(cls, site, retry: bool = True):
+        return cls(ProbeMode(site.probe_mode or ProbeMode.GET), site.probe_keyword, site.probe_max_body_bytes or PROBE_MAX_BODY_BYTES, retry)
+
+DEFAULT_SPEC = ProbeSpec()
+
+# What one successful attempt got, status_code is None in TCP mode and keyword_found outside BODY mode
+@dataclass
+class ProbeResponse:
+    status_code: int | None
+    keyword_found: bool | None = None
+
+# Function to tell whether a probe means the site is up: it answered, with the expected status code (any in TCP mode) and the keyword when one was looked for
+def probe_passed(response: ProbeResponse | None, expected_status_code: int):
+    if response is None:
+        return False
+    if response.status_code is not None and response.status_code != expected_status_code:
+        return False
+    return response.keyword_found is not False
+
+# Looks for a keyword in a body fed chunk by chunk, keeping at most max_bytes of it
+class KeywordScanner:
+    def __init__(self, keyword: str, max_bytes: int):
+        self.keyword = keyword.encode()
+        self.max_bytes = max_bytes
+        self.body = bytearray()
+        self.found = False
+
+    # Returns True once reading more is useless, the keyword was found or max_bytes were read
+    def feed(self, chunk: bytes):
+        start = max(0, len(self.body) - len(self.keyword) + 1) # The keyword may straddle two chunks
+        self.body += chunk[:self.max_bytes - len(self.body)]
+        self.found = self.body.find(self.keyword, start) != -1
+        return self.found or len(self.body) >= self.max_bytes
+
+# Outcome of probing one site, response is None when every attempt failed
+# response_time_ms is the total time of the last attempt, 'attempts' has the timing breakdown of each attempt
+@dataclass
+class ProbeResult:
+    site_id: int
+    response: ProbeResponse | None
+    response_time_ms: int | None
+    started_at: datetime
+    attempts: list[RequestTiming] = field(default_factory=list)
+
+    @property
+    def status_code(self):
+        return self.response.status_code if self.response is not None else None
+
+    @property
+    def timing(self):
+        return self.attempts[-1] if self.attempts else None
+
+# Same retry policy as the synchronous get_website_response, before concluding that the site is really down
+# Each attempt appends its own timing to 'attempts', the wait between attempts is in none of them
+# A HEAD falling back to GET is one attempt, its time covers both requests
+@retry(stop=stop_after_attempt(2), wait=wait_fixed(2), retry=retry_if_exception_type(httpx.HTTPError), reraise=True)
+async def get_website_response_async(client: httpx.AsyncClient, url: str, attempts: list[RequestTiming] | None = None, spec: ProbeSpec = DEFAULT_SPEC):
+    with measure_timing() as timing:
+        if attempts is not None:
+            attempts.append(timing)
+        extensions = {"trace": trace_timing(timing)}
+        if spec.mode == ProbeMode.TCP:
+            await connect_only_async(url, client.timeout.connect)
+            return ProbeResponse(None)
+        if spec.mode == ProbeMode.GET:
+            return ProbeResponse((await client.get(url, extensions=extensions)).status_code)
+        if spec.mode == ProbeMode.HEAD:
+            response = await client.head(url, extensions=extensions)
+            if response.status_code not in HEAD_NOT_ALLOWED:
+                return ProbeResponse(response.status_code)
+        async with client.stream("GET", url, extensions=extensions) as response: # Leaving it unread closes the connection instead of downloading the body
+            if spec.mode != ProbeMode.BODY:
+                return ProbeResponse(response.status_code)
+            scanner = KeywordScanner(spec.keyword, spec.max_body_bytes)
+            async for chunk in response.aiter_bytes():
+                if scanner.feed(chunk):
+                    break
+            return ProbeResponse(response.status_code, scanner.found)
+
+# Single attempt, for sites already DOWN, a site still down then costs one timeout instead of two plus the wait
+get_website_response_once = get_website_response_async.retry_with(stop=stop_after_attempt(1))
+
+# Paces check starts to 'rate' per second, letting bursts of up to 'burst' checks through at once
+# Each caller reserves the next start time (GCRA, a token bucket without a refill task), only used from the probe loop so it needs no lock
+class ProbeBudget:
+    def __init__(self, rate: float, burst: int | None = None):
+        self.interval = 1 / rate
+        self.tolerance = (max(1, burst or int(rate)) - 1) * self.interval # How far ahead of the pace starts may run
+        self._next_start = 0.0
+
+    # Function to wait for the turn of one check, returns the seconds waited
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        start = max(self._next_start, now)
+        self._next_start = start + self.interval
+        delay = start - self.tolerance - now
+        if delay <= 0:
+            return 0.0
+        await asyncio.sleep(delay)
+        return delay
+
+# Runs many site checks concurrently on a single long-lived event loop
+# The global semaphore bounds the total checks in flight, the per host semaphores stop us from hammering one origin
+# With a probe budget, checks also start at most max_per_second times per second, whatever the number of batches
+# The pooled client, the semaphores and the budget are shared by every batch of the worker process, so keep-alive connections are reused
+class ProbeEngine:
+    def __init__(self, max_concurrency: int = PROBE_MAX_CONCURRENCY, per_host_concurrency: int = PROBE_PER_HOST_CONCURRENCY, timeout: int = DEFAULT_TIMEOUT_SECONDS, max_per_second: float = PROBE_MAX_PER_SECOND):
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout = timeout
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self._budget = ProbeBudget(max_per_second) if max_per_second > 0 else None
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+        self._client: httpx.AsyncClient | None = None
+
+    # The client is created lazily, from inside the loop that will use it
+    def _get_client(self):
+        if self._client is None:
+            self._client = create_async_client(self.timeout)
+        return self._client
+
+    # Probe one site, on any error we just report it as failed
+    async def _probe(self, site_id: int, url: str, spec: ProbeSpec = DEFAULT_SPEC):
+        if self._budget is not None:
+            PROBE_BUDGET_WAIT_SECONDS.inc(await self._budget.acquire())
+        host = urlparse(url).hostname or ""
+        host_limit = self._host_limits.setdefault(host, asyncio.Semaphore(self.per_host_concurrency))
+        probe = get_website_response_async if spec.retry else get_website_response_once
+        async with self._limit, host_limit:
+            started_at = datetime.now(timezone.utc)
+            attempts: list[RequestTiming] = []
+            try:
+                response = await probe(self._get_client(), url, attempts, spec)
+                return ProbeResult(site_id, response, attempts[-1].response_time_ms, started_at, attempts)
+            except httpx.HTTPError:
+                return ProbeResult(site_id, None, None, started_at, attempts)
+
+    # Probe all (site_id, url) or (site_id, url, spec) targets, results are returned in the same order
+    async def run(self, targets: list[tuple]):
+        return await asyncio.gather(*(self._probe(*target) for target in targets))
+
+_engine: ProbeEngine | None = None
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_pid: int | None = None
+_loop_lock = threading.Lock()
+
+# Function to get the event loop of this worker process, running forever in a daemon thread
+# Every batch task submits to it, so concurrent batches share one loop, one client and one set of limits
+def get_probe_loop():
+    global _engine, _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop, _loop_pid = asyncio.new_event_loop(), os.getpid()
+            _engine = ProbeEngine()
+            threading.Thread(target=_loop.run_forever, name="probe-loop", daemon=True).start()
+    return _loop
+
+# Blocking entry point used by the celery batch task
+def probe_sites(targets: list[tuple]):
+    loop = get_probe_loop()
+    return asyncio.run_coroutine_threadsafe(_engine.run(targets), loop).result()
+
+# Split site IDs into batches of at most PROBE_BATCH_SIZE
+def chunk_site_ids(site_ids: list[int], size: int = PROBE_BATCH_SIZE):
+    return [site_ids[i:i + size] for i in range(0, len(site_ids), size)]
@@ -0,0 +1,126 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+import redis
+from fastapi import Request, Response, status
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "60")) # Longest time a cached listing is served without the database, 0 disables the cache
+
+INVALIDATIONS_CHANNEL = "response_cache:invalidated" # Redis channel telling every API process to drop a cached listing
+SITES = "sites"
+WEBHOOKS = "webhooks"
+
+logger = logging.getLogger(__name__)
+
+# Serialized body of a listing with its ETag
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str
+    expires: float
+
+# In-process cache of the serialized GET /sites and GET /webhooks listings, keyed by listing name
+# Writes invalidate it and broadcast the invalidation over redis pub/sub to every API process, the TTL bounds staleness if a message is missed
+# Each invalidation bumps a generation, a body loaded before it is never stored, so a listing read during a write cannot outlive the write
+class ResponseCache:
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._entries: dict[str, CachedResponse] = {}
+        self._generations: dict[str, int] = {}
+        self._lock = threading.Lock() # The invalidation listener thread writes too
+        self._listener: threading.Thread | None = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.expires < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def generation(self, name: str):
+        with self._lock:
+            return self._generations.get(name, 0)
+
+    # Function to cache a body loaded at 'generation', returns the entry to serve whether it was stored or not
+    def set(self, name: str, body: bytes, generation: int):
+        entry = CachedResponse(body, etag_for(body), time.monotonic() + self.ttl)
+        with self._lock:
+            if self.ttl > 0 and self._generations.get(name, 0) == generation:
+                self._entries[name] = entry
+        return entry
+
+    def invalidate(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._entries):
+                self._entries.pop(name)
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+    # Listen for invalidations made by other processes, started once on first use
+    def listen(self, redis_url: str = REDIS_URL):
+        if self._listener is not None:
+            return
+        self._listener = threading.Thread(target=self._listen, args=(redis_url,), name="response-cache-invalidations", daemon=True)
+        self._listener.start()
+
+    def _listen(self, redis_url: str):
+        while True:
+            try:
+                pubsub = redis.StrictRedis.from_url(redis_url).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATIONS_CHANNEL)
+                for message in pubsub.listen():
+                    self.invalidate(message["data"].decode())
+            except redis.RedisError as e:
+                logger.warning(f"Response cache invalidation listener disconnected, cached listings expire after {self.ttl}s : {e}")
+                self.clear() # Invalidations may have been missed while disconnected
+                time.sleep(5)
+
+response_cache = ResponseCache()
+redis_client = redis.StrictRedis.from_url(REDIS_URL) # Publishes invalidations, its connection pool is reused by every call
+
+# Strong ETag of a body, quoted as HTTP wants it
+def etag_for(body: bytes):
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+# Function to tell whether an If-None-Match header matches an ETag, weak comparison as HTTP asks for GET
+def etag_matches(if_none_match: str | None, etag: str):
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+# Function to drop cached listings in this process and every other API process, the caller has already committed the change
+def invalidate_responses(*names: str):
+    for name in names:
+        response_cache.invalidate(name)
+    try:
+        for name in names:
+            redis_client.publish(INVALIDATIONS_CHANNEL, name)
+    except redis.RedisError as e:
+        logger.warning(f"Could not broadcast response cache invalidation, other processes drop it within {RESPONSE_CACHE_TTL_SECONDS}s : {e}")
+
+# Function to answer a listing request from the cache, 'load' serializes the listing on a miss
+# Clients sending back the ETag in If-None-Match get a bodyless 304 while the listing is unchanged
+async def cached_response(request: Request, name: str, load: Callable[[], Awaitable[bytes]]):
+    response_cache.listen()
+    entry = response_cache.get(name)
+    if entry is None:
+        generation = response_cache.generation(name)
+        entry = response_cache.set(name, await load(), generation)
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"} # Clients may keep the body but must revalidate it
+    if etag_matches(request.headers.get("If-None-Match"), entry.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
@@ -0,0 +1,342 @@
+import os
+import math
+import time
+import logging
+import threading
+from bisect import bisect_left
+from itertools import islice
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import bindparam, case, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from app.database import SessionLocal, SiteStatusRollup, StatusType, as_naive_utc, as_utc
+from app.metrics import ROLLUP_BUCKETS_DROPPED
+
+ROLLUP_FLUSH_SIZE = int(os.getenv("ROLLUP_FLUSH_SIZE", "1000")) # Buffered buckets that trigger a flush
+ROLLUP_FLUSH_SECONDS = float(os.getenv("ROLLUP_FLUSH_SECONDS", "5")) # Longest time a check waits before it shows up in the rollups
+ROLLUP_BUFFER_MAX_BUCKETS = int(os.getenv("ROLLUP_BUFFER_MAX_BUCKETS", "100000")) # Buckets kept at most while the database cannot be written, the oldest are dropped first
+
+GRANULARITIES = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000) # Upper bounds of the latency histogram, one more slot counts the slower checks
+AUTO_GRANULARITY = [(timedelta(hours=6), "minute"), (timedelta(days=14), "hour")] # Widest range served by each granularity, beyond that days are used
+UPSERT_INSERTS = {"sqlite": sqlite_insert, "postgresql": postgresql_insert} # INSERT ... ON CONFLICT of each supported database
+
+logger = logging.getLogger(__name__)
+
+# Function to truncate a timestamp to the start of its bucket, as naive UTC like every stored timestamp
+def bucket_start(value: datetime, granularity: str):
+    value = as_naive_utc(value)
+    if granularity == "minute":
+        return value.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return value.replace(minute=0, second=0, microsecond=0)
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+# Function to pick the finest granularity that keeps the number of buckets of a range small
+def choose_granularity(since: datetime, until: datetime):
+    for span, granularity in AUTO_GRANULARITY:
+        if until - since <= span:
+            return granularity
+    return "day"
+
+def empty_histogram():
+    return [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+def parse_histogram(value: str):
+    return [int(count) for count in value.split(",")] if value else empty_histogram()
+
+# Function to estimate a percentile from a latency histogram, the answer is the upper bound of the slot holding it
+# Bounded by the exact min and max, so a histogram with a single slot in use still gives a sensible value
+def histogram_percentile(histogram: list[int], quantile: float, minimum: int | None, maximum: int | None):
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = max(1, math.ceil(quantile * total))
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= rank:
+            value = LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else maximum
+            return max(minimum, min(value, maximum))
+    return maximum
+
+# Checks of one site folded into one bucket, added onto the stored row when flushed
+@dataclass
+class RollupDelta:
+    up_count: int = 0
+    down_count: int = 0
+    response_time_count: int = 0
+    response_time_sum: int = 0
+    response_time_min: int | None = None
+    response_time_max: int | None = None
+    histogram: list[int] = field(default_factory=empty_histogram)
+
+    def add(self, status: StatusType, response_time_ms: int | None):
+        if status == StatusType.UP:
+            self.up_count += 1
+        else:
+            self.down_count += 1
+        if response_time_ms is not None:
+            self.response_time_count += 1
+            self.response_time_sum += response_time_ms
+            self.response_time_min = response_time_ms if self.response_time_min is None else min(self.response_time_min, response_time_ms)
+            self.response_time_max = response_time_ms if self.response_time_max is None else max(self.response_time_max, response_time_ms)
+            self.histogram[bisect_left(LATENCY_BUCKETS_MS, response_time_ms)] += 1
+
+    def merge(self, other: "RollupDelta"):
+        self.up_count += other.up_count
+        self.down_count += other.down_count
+        self.response_time_count += other.response_time_count
+        self.response_time_sum += other.response_time_sum
+        self.response_time_min = min(value for value in (self.response_time_min, other.response_time_min) if value is not None) if self.response_time_count else None
+        self.response_time_max = max(value for value in (self.response_time_max, other.response_time_max) if value is not None) if self.response_time_count else None
+        self.histogram = [mine + theirs for mine, theirs in zip(self.histogram, other.histogram)]
+
+    @classmethod
+    def from_row(cls, row: SiteStatusRollup):
+        return cls(row.up_count, row.down_count, row.response_time_count, row.response_time_sum, row.response_time_min, row.response_time_max, parse_histogram(row.latency_histogram))
+
+    def apply_to(self, row: SiteStatusRollup):
+        stored = RollupDelta.from_row(row)
+        stored.merge(self)
+        row.up_count, row.down_count = stored.up_count, stored.down_count
+        row.response_time_count, row.response_time_sum = stored.response_time_count, stored.response_time_sum
+        row.response_time_min, row.response_time_max = stored.response_time_min, stored.response_time_max
+        row.latency_histogram = ",".join(str(count) for count in stored.histogram)
+
+# Write-behind aggregation of check results into SiteStatusRollup rows
+# Checks are folded in memory per (site, granularity, bucket), so a flush touches each bucket once however many checks it got
+# Flushes once ROLLUP_FLUSH_SIZE buckets are buffered or ROLLUP_FLUSH_SECONDS have passed, like the history writer
+# Also like it, buckets the database rejects are written one by one and the rejected ones dropped, and the buffer is capped at max_buckets
+class RollupWriter:
+    def __init__(self, session_factory=SessionLocal, flush_size: int = ROLLUP_FLUSH_SIZE, flush_seconds: float = ROLLUP_FLUSH_SECONDS, max_buckets: int = ROLLUP_BUFFER_MAX_BUCKETS):
+        self.session_factory = session_factory
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.max_buckets = max_buckets
+        self._deltas: dict[tuple[int, str, datetime], RollupDelta] = {}
+        self._lock = threading.Lock() # Guards the buffer
+        self._flush_lock = threading.Lock() # One flush at a time
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._thread_pid: int | None = None
+
+        # Counters
+        self.checks_added = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.buckets_written = 0
+        self.buckets_dropped = 0
+        self.last_flush_seconds = 0.0
+
+    # Fold one check result into its minute, hour and day buckets
+    def add(self, site_id: int, status: StatusType, response_time_ms: int | None, checked_at: datetime):
+        self._ensure_thread()
+        with self._lock:
+            for granularity in GRANULARITIES:
+                key = (site_id, granularity, bucket_start(checked_at, granularity))
+                self._deltas.setdefault(key, RollupDelta()).add(status, response_time_ms)
+            self.checks_added += 1
+            self._trim()
+            full = len(self._deltas) >= self.flush_size
+        if full:
+            self.flush()
+
+    # Add everything buffered onto the stored buckets in one transaction
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+            if not deltas:
+                return
+
+            start = time.perf_counter()
+            try:
+                written, left = self._write_all(deltas)
+            except Exception as e:
+                logger.error(f"Error flushing {len(deltas)} rollup buckets, they stay buffered : {e}")
+                written, left = 0, deltas
+            if left:
+                self.flush_errors += 1
+                with self._lock: # Back in front of the buckets added meanwhile, so the oldest are dropped first
+                    for key, delta in self._deltas.items():
+                        left.setdefault(key, RollupDelta()).merge(delta)
+                    self._deltas = left
+                    self._trim()
+            else:
+                self.flushes += 1
+                self.last_flush_seconds = time.perf_counter() - start
+            self.buckets_written += written
+
+    # Function to write the buckets in one transaction, or one transaction per bucket when the database rejects them, rejected buckets are dropped
+    # Returns the number of written buckets and the buckets left to write, raises when the batch fails for another reason
+    def _write_all(self, deltas: dict[tuple[int, str, datetime], RollupDelta]):
+        db = self.session_factory()
+        try:
+            try:
+                self._write(db, deltas)
+                return len(deltas), {}
+            except IntegrityError as e:
+                logger.warning(f"Rollup batch of {len(deltas)} buckets rejected, writing it bucket by bucket : {e}")
+
+            written = 0
+            keys = list(deltas)
+            for index, key in enumerate(keys):
+                try:
+                    self._write(db, {key: deltas[key]})
+                except IntegrityError as e:
+                    self._drop(1, "rejected")
+                    logger.error(f"Dropped the {key[1]} rollup bucket of site {key[0]}, rejected by the database : {e}")
+                    continue
+                except Exception as e:
+                    logger.error(f"Error writing rollup buckets one by one, {len(keys) - index} stay buffered : {e}")
+                    return written, {key: deltas[key] for key in keys[index:]}
+                written += 1
+            return written, {}
+        finally:
+            db.close()
+
+    # Drop the oldest buckets beyond max_buckets, called with the lock held
+    def _trim(self):
+        excess = len(self._deltas) - self.max_buckets
+        if excess <= 0:
+            return
+        for key in list(islice(self._deltas, excess)):
+            del self._deltas[key]
+        self._drop(excess, "overflow")
+        logger.error(f"Rollup buffer full, dropped its {excess} oldest buckets")
+
+    def _drop(self, count: int, reason: str):
+        self.buckets_dropped += count
+        ROLLUP_BUCKETS_DROPPED.labels(reason).inc(count)
+
+    # Add the buckets onto the stored rows in one transaction, safe with other workers flushing the same buckets at the same time
+    # Counters are added by the database in one upsert, which also locks each row until the commit (the whole database on SQLite)
+    # The histogram, stored as text, is then merged in Python from the value the upsert returned and written back under that lock
+    def _write(self, db: Session, deltas: dict[tuple[int, str, datetime], RollupDelta]):
+        try:
+            table = SiteStatusRollup.__table__
+            statement = UPSERT_INSERTS[db.get_bind().dialect.name](table)
+            stored, added = table.c, statement.excluded
+            statement = statement.on_conflict_do_update(
+                index_elements=[stored.site_id, stored.granularity, stored.bucket_start],
+                set_={
+                    "up_count": stored.up_count + added.up_count,
+                    "down_count": stored.down_count + added.down_count,
+                    "response_time_count": stored.response_time_count + added.response_time_count,
+                    "response_time_sum": stored.response_time_sum + added.response_time_sum,
+                    "response_time_min": case((stored.response_time_min.is_(None) | (added.response_time_min < stored.response_time_min), added.response_time_min), else_=stored.response_time_min),
+                    "response_time_max": case((stored.response_time_max.is_(None) | (added.response_time_max > stored.response_time_max), added.response_time_max), else_=stored.response_time_max),
+                },
+            ).returning(stored.id, stored.site_id, stored.granularity, stored.bucket_start, stored.latency_histogram)
+            keys = sorted(deltas) # Same locking order in every worker, so that two flushes cannot deadlock
+            rows = db.execute(statement, [{
+                "site_id": site_id, "granularity": granularity, "bucket_start": start,
+                "up_count": delta.up_count, "down_count": delta.down_count,
+                "response_time_count": delta.response_time_count, "response_time_sum": delta.response_time_sum,
+                "response_time_min": delta.response_time_min, "response_time_max": delta.response_time_max,
+                "latency_histogram": "",
+            } for site_id, granularity, start in keys for delta in [deltas[(site_id, granularity, start)]]]).all()
+
+            histograms = []
+            for row in rows:
+                delta = deltas[(row.site_id, row.granularity, row.bucket_start)]
+                if delta.response_time_count:
+                    merged = [mine + theirs for mine, theirs in zip(parse_histogram(row.latency_histogram), delta.histogram)]
+                    histograms.append({"row_id": row.id, "histogram": ",".join(str(count) for count in merged)})
+            if histograms:
+                db.execute(update(table).where(stored.id == bindparam("row_id")).values(latency_histogram=bindparam("histogram")), histograms)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    def stats(self):
+        return {
+            "queue_depth": len(self._deltas),
+            "checks_added": self.checks_added,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "buckets_written": self.buckets_written,
+            "buckets_dropped": self.buckets_dropped,
+            "last_flush_ms": round(self.last_flush_seconds * 1000, 3),
+        }
+
+    # Background flusher for the time threshold, started lazily and once per process
+    def _ensure_thread(self):
+        if self._thread is None or self._thread_pid != os.getpid():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="rollup-writer", daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    # Stop the flusher and write whatever is left, called on worker shutdown
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+# Function to summarise the rollups of a site over a time range, only reads the buckets of one granularity
+# Buckets are included whole, so the range is widened to the bucket boundaries around 'since'
+def get_site_stats(db: Session, site_id: int, since: datetime | None = None, until: datetime | None = None, granularity: str | None = None):
+    since, until, granularity = stats_range(since, until, granularity)
+    rows = db.scalars(site_stats_query(site_id, since, until, granularity)).all()
+    return site_stats(site_id, since, until, granularity, rows)
+
+# Function to resolve the time range and granularity of a stats request, defaulting to the last 24 hours
+def stats_range(since: datetime | None, until: datetime | None, granularity: str | None):
+    until = as_utc(until) if until else datetime.now(timezone.utc)
+    since = as_utc(since) if since else until - timedelta(days=1)
+    if since >= until:
+        raise ValueError("'since' must be before 'until'")
+    return since, until, granularity or choose_granularity(since, until)
+
+# Function to build the query of the rollup buckets of a site over a time range, shared by the sync and async (app/async_crud.py) stats
+def site_stats_query(site_id: int, since: datetime, until: datetime, granularity: str):
+    return select(SiteStatusRollup).where(
+        SiteStatusRollup.site_id == site_id,
+        SiteStatusRollup.granularity == granularity,
+        SiteStatusRollup.bucket_start >= bucket_start(since, granularity),
+        SiteStatusRollup.bucket_start < as_naive_utc(until),
+    ).order_by(SiteStatusRollup.bucket_start)
+
+# Function to merge the rollup buckets of a site into its stats
+def site_stats(site_id: int, since: datetime, until: datetime, granularity: str, rows: list[SiteStatusRollup]):
+    total = RollupDelta()
+    buckets = []
+    for row in rows:
+        delta = RollupDelta.from_row(row)
+        total.merge(delta)
+        buckets.append({
+            "bucket_start": as_utc(row.bucket_start),
+            "up_count": row.up_count,
+            "down_count": row.down_count,
+            "avg_response_time_ms": row.response_time_sum / row.response_time_count if row.response_time_count else None,
+            "min_response_time_ms": row.response_time_min,
+            "max_response_time_ms": row.response_time_max,
+        })
+
+    checks = total.up_count + total.down_count
+    return {
+        "site_id": site_id,
+        "granularity": granularity,
+        "since": since,
+        "until": until,
+        "checks": checks,
+        "up_count": total.up_count,
+        "down_count": total.down_count,
+        "uptime_percent": total.up_count * 100 / checks if checks else None,
+        "avg_response_time_ms": total.response_time_sum / total.response_time_count if total.response_time_count else None,
+        "min_response_time_ms": total.response_time_min,
+        "max_response_time_ms": total.response_time_max,
+        "p50_response_time_ms": histogram_percentile(total.histogram, 0.50, total.response_time_min, total.response_time_max),
+        "p95_response_time_ms": histogram_percentile(total.histogram, 0.95, total.response_time_min, total.response_time_max),
+        "p99_response_time_ms": histogram_percentile(total.histogram, 0.99, total.response_time_min, total.response_time_max),
+        "buckets": buckets,
+    }
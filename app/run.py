@@ -1,14 +1,14 @@
 import os
 import sys
 import signal
-from app.background_worker import check_website_status
-from app.crud import get_all_sites
-from app.middleware import RateLimiterMiddleware
+from functools import partial
+from app.middleware import MetricsMiddleware, RateLimiterMiddleware, TimingMiddleware
+from app.metrics import pool_collector, render_metrics
 from app.models import DetailResponse
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from app import sites
 from dotenv import load_dotenv
-from app.database import SessionLocal, Site, init_db
+from app.database import async_engine, engine, init_db, pool_stats
 
 load_dotenv() # Loads environment variables from the .env file
 
@@ -18,9 +18,16 @@ app.include_router(sites.router)
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 RATE_LIMIT = int(os.getenv("RATE_LIMIT", "100")) # Rate Limit of per window per user
 RATE_WINDOW = int(os.getenv("RATE_WINDOW", "20")) # Window Size
-OPTIMISATION = bool(os.getenv("RATE_WINDOW", True)) # If True, we perform optimisation of database 
+RATE_LIMIT_LOCAL_FRACTION = float(os.getenv("RATE_LIMIT_LOCAL_FRACTION", "0")) # Share of the limit a client well under it may use without a redis round-trip, 0 disables it
+RESPONSE_TIMING_HEADER = os.getenv("RESPONSE_TIMING_HEADER", "0") == "1" # Add X-Process-Time-Ms to every response
 
-app.add_middleware(RateLimiterMiddleware, redis_url=REDIS_URL, limit=RATE_LIMIT, window=RATE_WINDOW) # Adding RateLimiterMiddleware for rate limiting
+app.add_middleware(RateLimiterMiddleware, redis_url=REDIS_URL, limit=RATE_LIMIT, window=RATE_WINDOW, local_fraction=RATE_LIMIT_LOCAL_FRACTION) # Adding RateLimiterMiddleware for rate limiting
+if RESPONSE_TIMING_HEADER:
+    app.add_middleware(TimingMiddleware) # Added last so it runs first, and its time includes the rate limiter
+app.add_middleware(MetricsMiddleware) # Outermost, so rate limited requests are counted too
+
+pool_collector.track("sync", partial(pool_stats, engine))
+pool_collector.track("async", partial(pool_stats, async_engine))
 
 # Function to handle signals (CTRL+C) for graceful shutdown.
 def receive_signal(signal_number, _):
@@ -28,21 +35,22 @@ def receive_signal(signal_number, _):
     os.kill(os.getpid(), signal.SIGTERM)
     sys.exit(0)
     
-# On starting of app, if there are any sites present in database, we resume monitoring for them
-def resume_monitoring():
-    db = SessionLocal()
-    existing_sites = get_all_sites(db)
-    for site in existing_sites: # Fetches all existing sites from the database.
-        check_website_status.apply_async((site.id, OPTIMISATION), countdown=site.check_interval_seconds) # Schedules celery background worker for each
-    db.close()
-
 @app.on_event("startup")
-async def startup_event(): # On Start of app, we start database and resume monitoring
+async def startup_event(): # On Start of app, we start database. Monitoring is resumed by the scheduler process on its own start
     init_db()
     signal.signal(signal.SIGINT, receive_signal)
-    resume_monitoring()
+
+@app.on_event("shutdown")
+async def shutdown_event(): # Close the pooled async connections, each aiosqlite connection holds a thread that would keep the process alive
+    await async_engine.dispose()
 
 # Health check
 @app.get("/", response_model=DetailResponse)
 def root():
-    return {"detail": "WebMonitor is running"}
\ No newline at end of file
+    return {"detail": "WebMonitor is running"}
+
+# Prometheus metrics of this API process, unauthenticated like the health check so scrapers need no credentials
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    body, content_type = render_metrics(request.headers.get("Accept"))
+    return Response(content=body, media_type=content_type)
\ No newline at end of file
@@ -0,0 +1,284 @@
+import os
+import time
+import heapq
+import random
+import signal
+import logging
+import redis
+from dotenv import load_dotenv
+from app.background_worker import OUTCOMES_KEY, check_website_batch, compact_site_history
+from app.database import SessionLocal, Site, StatusType
+from app.probe_engine import chunk_site_ids
+from app.sharding import SHARDING_ENABLED, ShardRouter
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+OPTIMISATION = bool(os.getenv("OPTIMISATION", True)) # If True, we perform optimisation of database
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "1")) # Longest sleep between two dispatch rounds
+SCHEDULER_SYNC_SECONDS = int(os.getenv("SCHEDULER_SYNC_SECONDS", "60")) # Full resync with the sites table, as a safety net for missed events
+SCHEDULER_JITTER_RATIO = float(os.getenv("SCHEDULER_JITTER_RATIO", "0.1")) # Each interval is stretched or shrunk randomly by up to this fraction
+SCHEDULER_RECONFIRM_SECONDS = float(os.getenv("SCHEDULER_RECONFIRM_SECONDS", "30")) # A status change is checked again after at most this time, 0 disables it
+SCHEDULER_BACKOFF_MAX_SECONDS = float(os.getenv("SCHEDULER_BACKOFF_MAX_SECONDS", "600")) # Longest interval a site staying DOWN backs off to, 0 disables the backoff
+COMPACTION_INTERVAL_SECONDS = int(os.getenv("COMPACTION_INTERVAL_SECONDS", "3600")) # Time between two history compactions, 0 disables them
+
+DUE_KEY = "scheduler:due" # Redis hash, site_id -> next due time, used to recover after a restart
+EVENTS_KEY = "scheduler:events" # Redis list of site add/remove events pushed by the API
+COMPACTION_KEY = "scheduler:compaction" # Expiring redis key, set while the last compaction is recent enough
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Keeps exactly one live entry per site in a binary heap ordered by due time
+# Updated or removed sites leave stale heap entries behind, which are skipped when popped (lazy deletion)
+# Check outcomes reported by the workers adapt the intervals: a status change is checked again within reconfirm_seconds,
+# a site staying DOWN is checked twice less often after each check, up to backoff_max_seconds apart, until it changes again
+class CheckScheduler:
+    def __init__(self, jitter_ratio: float = SCHEDULER_JITTER_RATIO, reconfirm_seconds: float = SCHEDULER_RECONFIRM_SECONDS, backoff_max_seconds: float = SCHEDULER_BACKOFF_MAX_SECONDS):
+        self.jitter_ratio = jitter_ratio
+        self.reconfirm_seconds = reconfirm_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self._heap: list[tuple[float, int]] = []
+        self._due: dict[int, float] = {} # site_id -> due time of its live heap entry
+        self._intervals: dict[int, int] = {} # site_id -> check interval in seconds
+        self._down_checks: dict[int, int] = {} # site_id -> DOWN checks since the site went down, only for DOWN sites
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, site_id: int):
+        return site_id in self._due
+
+    def site_ids(self):
+        return list(self._due)
+
+    def interval_of(self, site_id: int):
+        return self._intervals.get(site_id)
+
+    # Add a site or move its entry, without a due time the first check is spread randomly over one interval
+    def schedule(self, site_id: int, interval: int, due: float | None = None, now: float | None = None):
+        now = time.time() if now is None else now
+        if due is None:
+            due = now + random.uniform(0, interval)
+        self._intervals[site_id] = interval
+        self._due[site_id] = due
+        heapq.heappush(self._heap, (due, site_id))
+        self._compact()
+
+    # Forget a site, its heap entry turns stale
+    def remove(self, site_id: int):
+        self._due.pop(site_id, None)
+        self._intervals.pop(site_id, None)
+        self._down_checks.pop(site_id, None)
+        self._compact()
+
+    # Interval with jitter, so checks of sites added together drift apart
+    def _next_interval(self, interval: float):
+        return interval * (1 + random.uniform(-self.jitter_ratio, self.jitter_ratio))
+
+    # Interval of a site, doubled for each check that found it still DOWN, capped at backoff_max_seconds (or its own interval when longer)
+    def _backoff_interval(self, site_id: int):
+        interval = self._intervals[site_id]
+        down_checks = self._down_checks.get(site_id, 0)
+        if down_checks == 0:
+            return interval
+        return min(interval * 2 ** min(down_checks, 32), max(interval, self.backoff_max_seconds))
+
+    # Move the next check of a site after the outcome of a check, returns its new due time or None when it keeps its due time
+    # 'changed' is True when the check found another status than the previous one
+    def record_outcome(self, site_id: int, status: StatusType, changed: bool, now: float | None = None):
+        if site_id not in self._due:
+            return None
+        now = time.time() if now is None else now
+        if changed:
+            self._down_checks.pop(site_id, None)
+            if status == StatusType.DOWN:
+                self._down_checks[site_id] = 0 # Backs off from the next DOWN check on
+            if self.reconfirm_seconds <= 0:
+                return None
+            due = now + min(self._intervals[site_id], self.reconfirm_seconds) # Confirms the change, or catches the flap, quickly
+        elif status == StatusType.DOWN:
+            self._down_checks[site_id] = self._down_checks.get(site_id, 0) + 1
+            due = now + self._next_interval(self._backoff_interval(site_id))
+        else:
+            self._down_checks.pop(site_id, None)
+            return None
+        self._due[site_id] = due
+        heapq.heappush(self._heap, (due, site_id))
+        self._compact()
+        return due
+
+    # Pop every site due at 'now' and push its next entry, returns the due site IDs
+    # 'due_times', when given, is filled with the due time each popped site had
+    def pop_due(self, now: float | None = None, due_times: dict[int, float] | None = None):
+        now = time.time() if now is None else now
+        due_site_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            due, site_id = heapq.heappop(self._heap)
+            if self._due.get(site_id) != due:
+                continue # Stale entry of an updated or removed site
+            interval = self._backoff_interval(site_id) # Already backed off for DOWN sites, before their outcome moves them
+            next_due = due + self._next_interval(interval)
+            if next_due <= now:
+                next_due = now + self._next_interval(interval) # We fell behind, do not try to catch up on missed checks
+            self._due[site_id] = next_due
+            heapq.heappush(self._heap, (next_due, site_id))
+            due_site_ids.append(site_id)
+            if due_times is not None:
+                due_times[site_id] = due
+        return due_site_ids
+
+    # Seconds until the earliest entry is due, None when nothing is scheduled
+    def next_due_in(self, now: float | None = None):
+        now = time.time() if now is None else now
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap) # Drop stale entries sitting on top
+        return max(0.0, self._heap[0][0] - now) if self._heap else None
+
+    # Due time of every live entry, as persisted in redis
+    def due_times(self, site_ids: list[int] | None = None):
+        site_ids = self._due.keys() if site_ids is None else site_ids
+        return {site_id: self._due[site_id] for site_id in site_ids if site_id in self._due}
+
+    # Rebuild the heap once stale entries outnumber live ones, so memory stays proportional to the number of sites
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._due) + 1024:
+            self._heap = [(due, site_id) for site_id, due in self._due.items()]
+            heapq.heapify(self._heap)
+
+# Function to push a site event for the scheduler process, so that it does not wait for the next full resync
+def announce_site_added(redis_client: redis.StrictRedis, site_id: int, interval: int):
+    redis_client.rpush(EVENTS_KEY, f"add:{site_id}:{interval}")
+
+def announce_site_removed(redis_client: redis.StrictRedis, site_id: int):
+    redis_client.rpush(EVENTS_KEY, f"remove:{site_id}")
+
+# Same for many sites at once, in one push, the scheduler spreads their first checks randomly over their interval
+def announce_sites_added(redis_client: redis.StrictRedis, sites: list[tuple[int, int]]):
+    if sites:
+        redis_client.rpush(EVENTS_KEY, *[f"add:{site_id}:{interval}" for site_id, interval in sites])
+
+def announce_sites_removed(redis_client: redis.StrictRedis, site_ids: list[int]):
+    if site_ids:
+        redis_client.rpush(EVENTS_KEY, *[f"remove:{site_id}" for site_id in site_ids])
+
+# Function to bring the scheduler in line with the sites table, only ID and interval are loaded
+# Due times stored in redis are reused, so that a restart does not reset every site's phase
+def sync_sites(scheduler: CheckScheduler, redis_client: redis.StrictRedis, saved_due: dict[int, float] | None = None):
+    db = SessionLocal()
+    try:
+        rows = db.query(Site.id, Site.check_interval_seconds).all()
+    finally:
+        db.close()
+
+    now = time.time()
+    saved_due = saved_due or {}
+    live_site_ids = set()
+    for site_id, interval in rows:
+        live_site_ids.add(site_id)
+        if scheduler.interval_of(site_id) == interval:
+            continue
+        due = saved_due.get(site_id)
+        if due is not None and due < now:
+            due = now + random.uniform(0, interval * scheduler.jitter_ratio) # Overdue after downtime, spread out instead of firing all at once
+        scheduler.schedule(site_id, interval, due, now)
+
+    removed_site_ids = {site_id for site_id in scheduler.site_ids() + list(saved_due) if site_id not in live_site_ids}
+    for site_id in removed_site_ids:
+        scheduler.remove(site_id)
+    if removed_site_ids:
+        redis_client.hdel(DUE_KEY, *removed_site_ids)
+
+# Function to apply the add/remove events pushed by the API since the last round
+def drain_events(scheduler: CheckScheduler, redis_client: redis.StrictRedis):
+    with redis_client.pipeline() as pipe:
+        pipe.lrange(EVENTS_KEY, 0, -1)
+        pipe.delete(EVENTS_KEY)
+        events, _ = pipe.execute()
+
+    for event in events:
+        kind, *fields = event.decode().split(":")
+        if kind == "add":
+            scheduler.schedule(int(fields[0]), int(fields[1]))
+        elif kind == "remove":
+            scheduler.remove(int(fields[0]))
+            redis_client.hdel(DUE_KEY, int(fields[0]))
+
+# Function to apply the check outcomes reported by the workers since the last round, and persist the due times they moved
+def drain_outcomes(scheduler: CheckScheduler, redis_client: redis.StrictRedis, now: float | None = None):
+    with redis_client.pipeline() as pipe:
+        pipe.lrange(OUTCOMES_KEY, 0, -1)
+        pipe.delete(OUTCOMES_KEY)
+        outcomes, _ = pipe.execute()
+
+    moved = {}
+    for outcome in outcomes:
+        site_id, status, changed = outcome.decode().split(":")
+        due = scheduler.record_outcome(int(site_id), StatusType(status), changed == "1", now)
+        if due is not None:
+            moved[int(site_id)] = due
+    if moved:
+        redis_client.hset(DUE_KEY, mapping=moved)
+    return moved
+
+# Function to dispatch due sites as batch tasks, and persist their next due times in a single round-trip
+# With a shard router, each batch only holds sites of one node and goes to that node's queue
+def dispatch_due(scheduler: CheckScheduler, redis_client: redis.StrictRedis, now: float | None = None, router: ShardRouter | None = None):
+    due_times: dict[int, float] = {}
+    due_site_ids = scheduler.pop_due(now, due_times)
+    routes = router.route(due_site_ids) if router is not None and due_site_ids else {None: due_site_ids}
+    for queue, site_ids in routes.items():
+        for batch in chunk_site_ids(site_ids):
+            scheduled_at = min(due_times[site_id] for site_id in batch) # Workers measure the check lag against it
+            check_website_batch.apply_async((batch, OPTIMISATION, scheduled_at), queue=queue) # None is the default queue
+    if due_site_ids:
+        redis_client.hset(DUE_KEY, mapping=scheduler.due_times(due_site_ids))
+    return due_site_ids
+
+# Function to dispatch the history compaction once per COMPACTION_INTERVAL_SECONDS
+# The interval is tracked by an expiring redis key, so restarting the scheduler does not trigger an extra run
+def dispatch_compaction(redis_client: redis.StrictRedis):
+    if COMPACTION_INTERVAL_SECONDS <= 0:
+        return False
+    if not redis_client.set(COMPACTION_KEY, int(time.time()), nx=True, ex=COMPACTION_INTERVAL_SECONDS):
+        return False
+    compact_site_history.apply_async(kwargs={"backfill": not OPTIMISATION}) # Optimised history only holds status changes, it cannot be counted into rollups
+    return True
+
+# Main loop of the scheduler process
+def run_scheduler():
+    redis_client = redis.StrictRedis.from_url(REDIS_URL)
+    scheduler = CheckScheduler()
+    router = ShardRouter(redis_client) if SHARDING_ENABLED else None
+    running = True
+
+    def stop(signal_number, _):
+        nonlocal running
+        logger.info(f"Scheduler shutting down... Signal: {signal.strsignal(signal_number)}")
+        running = False
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    saved_due = {int(site_id): float(due) for site_id, due in redis_client.hgetall(DUE_KEY).items()}
+    redis_client.delete(EVENTS_KEY, OUTCOMES_KEY) # The full sync below already covers anything announced while we were down, outcomes are stale
+    sync_sites(scheduler, redis_client, saved_due)
+    last_sync = time.monotonic()
+    logger.info(f"Scheduler started with {len(scheduler)} sites")
+
+    while running:
+        drain_events(scheduler, redis_client)
+        drain_outcomes(scheduler, redis_client)
+        if time.monotonic() - last_sync >= SCHEDULER_SYNC_SECONDS:
+            sync_sites(scheduler, redis_client)
+            last_sync = time.monotonic()
+        dispatch_due(scheduler, redis_client, router=router)
+        dispatch_compaction(redis_client)
+        next_due_in = scheduler.next_due_in()
+        time.sleep(SCHEDULER_TICK_SECONDS if next_due_in is None else min(next_due_in, SCHEDULER_TICK_SECONDS))
+
+    if len(scheduler):
+        redis_client.hset(DUE_KEY, mapping=scheduler.due_times()) # Persist the final phases for the next start
+
+if __name__ == "__main__": # Starting the scheduler directly, python -m app.scheduler
+    run_scheduler()
@@ -0,0 +1,103 @@
+import os
+import time
+import socket
+import hashlib
+import logging
+import threading
+from bisect import bisect
+import redis
+
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "0") == "1" # Route the checks of each site to the queue of one worker node
+SHARD_NODE_NAME = os.getenv("SHARD_NODE_NAME", socket.gethostname()) # Name of this worker node, unique across the fleet
+SHARD_HEARTBEAT_SECONDS = float(os.getenv("SHARD_HEARTBEAT_SECONDS", "10")) # How often a node says it is alive
+SHARD_NODE_TTL_SECONDS = float(os.getenv("SHARD_NODE_TTL_SECONDS", "30")) # A node silent for longer is considered gone and its sites move
+SHARD_VIRTUAL_NODES = int(os.getenv("SHARD_VIRTUAL_NODES", "100")) # Points of each node on the ring, more points spread the sites more evenly
+
+NODES_KEY = "shards:nodes" # Redis sorted set, node name -> time of its last heartbeat
+
+logger = logging.getLogger(__name__)
+
+# Function to get the queue consumed by one node
+def shard_queue(node: str):
+    return f"probes.{node}"
+
+def _ring_hash(key: str):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+# Consistent hash ring of worker nodes, each node owns the site IDs hashing between its points and the previous ones
+# When a node joins or leaves, only the sites of the arcs it takes or gives back change owner
+class HashRing:
+    def __init__(self, nodes: list[str], virtual_nodes: int = SHARD_VIRTUAL_NODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_ring_hash(f"{node}#{index}"), node) for node in self.nodes for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def __bool__(self):
+        return bool(self.nodes)
+
+    def node_for(self, site_id: int):
+        index = bisect(self._hashes, _ring_hash(str(site_id))) % len(self._hashes)
+        return self._owners[index]
+
+# Function to record that a node is alive
+def heartbeat(redis_client: redis.StrictRedis, node: str = SHARD_NODE_NAME):
+    redis_client.zadd(NODES_KEY, {node: time.time()})
+
+# Function to remove a node on a clean shutdown, so that its sites move at once instead of after SHARD_NODE_TTL_SECONDS
+def leave(redis_client: redis.StrictRedis, node: str = SHARD_NODE_NAME):
+    redis_client.zrem(NODES_KEY, node)
+
+# Function to keep announcing a node from a daemon thread, returns the event that stops it
+def start_heartbeat(redis_client: redis.StrictRedis, node: str = SHARD_NODE_NAME):
+    stop = threading.Event()
+
+    def run():
+        while True:
+            try:
+                heartbeat(redis_client, node)
+            except redis.RedisError as e:
+                logger.warning(f"Shard heartbeat of {node} failed : {e}")
+            if stop.wait(SHARD_HEARTBEAT_SECONDS):
+                return
+
+    threading.Thread(target=run, name="shard-heartbeat", daemon=True).start()
+    return stop
+
+# Function to list the nodes with a recent heartbeat, silent ones are dropped from the registry
+def live_nodes(redis_client: redis.StrictRedis, now: float | None = None):
+    cutoff = (time.time() if now is None else now) - SHARD_NODE_TTL_SECONDS
+    redis_client.zremrangebyscore(NODES_KEY, "-inf", cutoff)
+    return [node.decode() for node in redis_client.zrangebyscore(NODES_KEY, cutoff, "+inf")]
+
+# Splits due site IDs by owning node, used by the scheduler process
+# The ring is rebuilt from the registry at most once per heartbeat, and only when the set of nodes changed
+class ShardRouter:
+    def __init__(self, redis_client: redis.StrictRedis):
+        self.redis_client = redis_client
+        self.ring = HashRing([])
+        self._refreshed_at = float("-inf")
+
+    def refresh(self, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        if now - self._refreshed_at < SHARD_HEARTBEAT_SECONDS:
+            return
+        self._refreshed_at = now
+        nodes = live_nodes(self.redis_client)
+        if sorted(nodes) == self.ring.nodes:
+            return
+        gone = set(self.ring.nodes) - set(nodes)
+        if gone: # Batches still queued for a departed node would only run late, their sites are dispatched to the new owners anyway
+            self.redis_client.delete(*[shard_queue(node) for node in gone])
+        logger.info(f"Shard ring rebalanced: {len(nodes)} nodes {sorted(nodes)}, gone {sorted(gone)}")
+        self.ring = HashRing(nodes)
+
+    # Function to group site IDs by queue, everything goes to the default queue (None) while no node is registered
+    def route(self, site_ids: list[int]):
+        self.refresh()
+        if not self.ring:
+            return {None: site_ids}
+        routes: dict[str | None, list[int]] = {}
+        for site_id in site_ids:
+            routes.setdefault(shard_queue(self.ring.node_for(site_id)), []).append(site_id)
+        return routes
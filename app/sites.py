@@ -1,32 +1,38 @@
 import os
-from fastapi import APIRouter, Depends, Response, Security, status
+import redis
+from datetime import datetime
+from fastapi import APIRouter, Depends, Query, Request, Response, Security, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.background_worker import check_website_status
-from app.database import Site, SessionLocal
-from app.crud import create_webhook, get_all_webhooks, get_webhooks, initial_history, add_site, remove_site, get_site, get_all_sites, get_history, remove_webhook
-from app.models import SiteCreate, SiteResponse, DetailResponse, SiteStatusHistoryResponse, WebhookCreate, WebhookResponse
-from app.authetication import verify_credentials
+from app import async_crud
+from app.database import Site, StatusType, async_engine, engine, get_async_db, get_db, pool_stats
+from app.crud import add_sites_bulk, remove_sites_bulk, create_webhooks_bulk, remove_webhooks_bulk, create_api_key, revoke_api_key, create_webhook, initial_history, add_site, remove_site, remove_webhook
+from app.models import BulkDelete, SiteBulkDeleteResponse, SiteBulkResponse, WebhookBulkDeleteResponse, WebhookBulkResponse, ApiKeyCreate, ApiKeyCreatedResponse, ApiKeyResponse, PoolStatsResponse, SiteCreate, SiteResponse, DetailResponse, SiteStatsResponse, SiteStatusHistoryPage, WebhookCreate, WebhookResponse
+from app.authetication import broadcast_revocation, new_api_key, verify_credentials
+from app.export import EXPORT_MEDIA_TYPES, export_history
+from app.response_cache import SITES, WEBHOOKS, cached_response
+from app.bulk import parse_rows, validate_rows
+from app.scheduler import announce_site_added, announce_site_removed, announce_sites_added, announce_sites_removed
 from urllib.parse import urlparse
 
 # Control flows here after starting of server
 # All sites route are protected by Authentication
+# Read routes are async on the async engine, so slow reads wait without taking threadpool threads, writes stay sync (threadpool) on the engine shared with Celery
 # On some error, we send HTTP 400 error with details
 router = APIRouter()
-OPTIMISATION = bool(os.getenv("OPTIMISATION", True))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+redis_client = redis.StrictRedis.from_url(REDIS_URL) # Used to tell the scheduler process about added and removed sites
+site_list = TypeAdapter(list[SiteResponse]) # Serializes the cached listings straight to JSON bytes
+webhook_list = TypeAdapter(list[WebhookResponse])
 
-# Dependency function to get a database session
-def get_db():
-    db: Session = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-    
 # Endpoint to get details of a specific site by ID
 @router.get("/sites/{site_id}", response_model=SiteResponse | DetailResponse, dependencies=[Security(verify_credentials)])
-def get_each_site(site_id: int, response: Response, db: Session = Depends(get_db)):
+async def get_each_site(site_id: int, response: Response, db: AsyncSession = Depends(get_async_db)):
     try:
-        site = get_site(db, site_id) # Fetch site from database by ID
+        site = await async_crud.get_site(db, site_id) # Fetch site from database by ID
         if not site:
             raise Exception("Site not found") # Raise exception if site is not found
         return site
@@ -34,48 +40,96 @@ def get_each_site(site_id: int, response: Response, db: Session = Depends(get_db
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"detail": str(e)}
 
-# Endpoint to get a list of all sites
+# Endpoint to get a list of all sites, served from the response cache with an ETag (If-None-Match gets a 304 while unchanged)
 @router.get("/sites", response_model=list[SiteResponse] | DetailResponse, dependencies=[Security(verify_credentials)])
-def get_sites(response: Response, db: Session = Depends(get_db)):
+async def get_sites(request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
+    try:
+        async def load():
+            return site_list.dump_json(site_list.validate_python(await async_crud.get_all_sites(db), from_attributes=True)) # Fetch all sites from the database, only on a cache miss
+        return await cached_response(request, SITES, load)
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
+    
+# Endpoint to get the status history of a specific site, one page at a time, newest first
+# Optional filters: since/until (time range on last_checked) and status
+@router.get("/sites/{site_id}/history", response_model=SiteStatusHistoryPage | DetailResponse, dependencies=[Security(verify_credentials)])
+async def get_site_history(site_id: int, response: Response, limit: int = Query(100, ge=1, le=1000), cursor: str | None = None, since: datetime | None = None, until: datetime | None = None, status_filter: StatusType | None = Query(None, alias="status"), db: AsyncSession = Depends(get_async_db)):
     try:
-        sites = get_all_sites(db) # Fetch all sites from the database
-        return sites
+        site = await async_crud.get_site(db, site_id) # Fetch site from database by ID
+        if not site:
+            raise Exception("Site not found") # Raise exception if site is not found
+        history, next_cursor = await async_crud.get_history_page(db, site, limit, cursor, since, until, status_filter) # Fetch one page of history for the site from the database
+        return {"items": history, "next_cursor": next_cursor}
     except Exception as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"detail": str(e)}
     
-# Endpoint to get the status history of a specific site
-@router.get("/sites/{site_id}/history", response_model=list[SiteStatusHistoryResponse] | DetailResponse, dependencies=[Security(verify_credentials)])
-def get_site_history(site_id: int, response: Response, db: Session = Depends(get_db)):
+# Endpoint to get the uptime and response time of a specific site over a time range, served from the rollups
+# Defaults to the last 24 hours, the granularity of the buckets is picked from the range unless given
+@router.get("/sites/{site_id}/stats", response_model=SiteStatsResponse | DetailResponse, dependencies=[Security(verify_credentials)])
+async def get_site_stats_route(site_id: int, response: Response, since: datetime | None = None, until: datetime | None = None, granularity: str | None = Query(None, pattern="^(minute|hour|day)$"), db: AsyncSession = Depends(get_async_db)):
     try:
-        site = get_site(db, site_id) # Fetch site from database by ID
+        site = await async_crud.get_site(db, site_id) # Fetch site from database by ID
         if not site:
             raise Exception("Site not found") # Raise exception if site is not found
-        history = get_history(db, site) # Fetch history for the site from the database
-        return history
+        return await async_crud.get_site_stats(db, site.id, since, until, granularity)
     except Exception as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"detail": str(e)}
     
+# Endpoint to export the status history as NDJSON or CSV, streamed row by row with constant memory
+# Filters: site_id (repeatable, all sites when absent) and since/until (time range on last_checked)
+@router.get("/history/export", dependencies=[Security(verify_credentials)])
+async def export_site_history(export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"), site_id: list[int] = Query([]), since: datetime | None = None, until: datetime | None = None, db: AsyncSession = Depends(get_async_db)):
+    headers = {"Content-Disposition": f"attachment; filename=history.{export_format}"}
+    return StreamingResponse(export_history(db, site_id, since, until, export_format), media_type=EXPORT_MEDIA_TYPES[export_format], headers=headers)
+
 # Endpoint to create a new site
 @router.post("/sites", response_model=SiteResponse | DetailResponse, dependencies=[Security(verify_credentials)])
 def create_site(site: SiteCreate, response: Response, db: Session = Depends(get_db)):
     try:
         site = add_site(db, site) # Add the new site to the database
         initial_history(db, site) # Initialize the site's history in the database
-        check_website_status.apply_async((site.id, OPTIMISATION), countdown=site.check_interval_seconds) # Schedule background task to check website status
+        announce_site_added(redis_client, site.id, site.check_interval_seconds) # The scheduler process dispatches its checks from now on
         return site
     except Exception as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"detail": str(e)}
 
+# Endpoint to create many sites at once, from a JSON array or NDJSON (Content-Type: application/x-ndjson) of sites
+# Valid rows are inserted in one transaction, invalid or duplicate ones are reported in 'errors' with their position
+@router.post("/sites/bulk", response_model=SiteBulkResponse | DetailResponse, dependencies=[Security(verify_credentials)])
+async def create_sites_bulk(request: Request, response: Response, db: Session = Depends(get_db)):
+    try:
+        rows, errors = parse_rows(await request.body(), request.headers.get("content-type", "")) # Read the uploaded rows
+        valid, invalid = validate_rows(rows, SiteCreate)
+        sites, duplicates = await run_in_threadpool(add_sites_bulk, db, valid) # Insert all valid sites in one transaction
+        await run_in_threadpool(announce_sites_added, redis_client, [(site.id, site.check_interval_seconds) for site in sites]) # First checks are spread over each interval by the scheduler, the redis call must not block the event loop
+        return {"created": sites, "errors": sorted(errors + invalid + duplicates, key=lambda error: error["index"])}
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
+
+# Endpoint to delete many sites at once by ID
+@router.post("/sites/bulk-delete", response_model=SiteBulkDeleteResponse | DetailResponse, dependencies=[Security(verify_credentials)])
+def delete_sites_bulk(bulk: BulkDelete, response: Response, db: Session = Depends(get_db)):
+    try:
+        sites, missing = remove_sites_bulk(db, bulk.ids) # Remove the sites from the database in one transaction
+        announce_sites_removed(redis_client, [site.id for site in sites]) # Also removes them from the scheduler
+        return {"deleted": sites, "missing": missing}
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
+
 # Endpoint to delete a site by ID
 @router.delete("/sites/{site_id}", response_model=SiteResponse | DetailResponse, dependencies=[Security(verify_credentials)])
 def delete_site(site_id: int, response: Response, db: Session = Depends(get_db)):
     try:
-        site = remove_site(db, site_id) # Remove the site from the database, Also removes the background process
+        site = remove_site(db, site_id) # Remove the site from the database
         if not site:
             raise Exception("Site not found") # Raise exception if site is not found
+        announce_site_removed(redis_client, site_id) # Also removes it from the scheduler
         return site
     except Exception as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
@@ -83,20 +137,21 @@ def delete_site(site_id: int, response: Response, db: Session = Depends(get_db))
     
 # Endpoint to get webhooks for a specific site ID
 @router.get("/webhooks/{site_id}", response_model=list[WebhookResponse] | DetailResponse, dependencies=[Security(verify_credentials)])
-def get_sites(site_id: int, response: Response, db: Session = Depends(get_db)):
+async def get_sites(site_id: int, response: Response, db: AsyncSession = Depends(get_async_db)):
     try:
-        webhooks = get_webhooks(db, site_id) # Fetch webhooks for a given site ID from the database
+        webhooks = await async_crud.get_webhooks(db, site_id) # Fetch webhooks for a given site ID from the database
         return webhooks
     except Exception as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"detail": str(e)}
     
-# Endpoint to get a list of all webhooks
+# Endpoint to get a list of all webhooks, served from the response cache like GET /sites
 @router.get("/webhooks", response_model=list[WebhookResponse] | DetailResponse, dependencies=[Security(verify_credentials)])
-def get_sites(response: Response, db: Session = Depends(get_db)):
+async def get_sites(request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
     try:
-        webhooks = get_all_webhooks(db) # Fetch all webhooks from the database
-        return webhooks
+        async def load():
+            return webhook_list.dump_json(webhook_list.validate_python(await async_crud.get_all_webhooks(db), from_attributes=True)) # Fetch all webhooks from the database, only on a cache miss
+        return await cached_response(request, WEBHOOKS, load)
     except Exception as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"detail": str(e)}
@@ -111,6 +166,28 @@ def create_site(webhook: WebhookCreate, response: Response, db: Session = Depend
         response.status_code = status.HTTP_400_BAD_REQUEST
         return {"detail": str(e)}
    
+# Endpoint to create many webhooks at once, from a JSON array or NDJSON of webhooks
+@router.post("/webhooks/bulk", response_model=WebhookBulkResponse | DetailResponse, dependencies=[Security(verify_credentials)])
+async def create_webhooks_bulk_route(request: Request, response: Response, db: Session = Depends(get_db)):
+    try:
+        rows, errors = parse_rows(await request.body(), request.headers.get("content-type", "")) # Read the uploaded rows
+        valid, invalid = validate_rows(rows, WebhookCreate)
+        webhooks, duplicates = await run_in_threadpool(create_webhooks_bulk, db, valid) # Insert all valid webhooks in one transaction
+        return {"created": webhooks, "errors": sorted(errors + invalid + duplicates, key=lambda error: error["index"])}
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
+
+# Endpoint to delete many webhooks at once by ID
+@router.post("/webhooks/bulk-delete", response_model=WebhookBulkDeleteResponse | DetailResponse, dependencies=[Security(verify_credentials)])
+def delete_webhooks_bulk(bulk: BulkDelete, response: Response, db: Session = Depends(get_db)):
+    try:
+        webhooks, missing = remove_webhooks_bulk(db, bulk.ids) # Remove the webhooks from the database in one transaction
+        return {"deleted": webhooks, "missing": missing}
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
+
 # Endpoint to delete a webhook by ID 
 @router.delete("/webhooks/{webhook_id}", response_model=WebhookResponse | DetailResponse, dependencies=[Security(verify_credentials)])
 def delete_site(webhook_id: int, response: Response, db: Session = Depends(get_db)):
@@ -121,4 +198,50 @@ def delete_site(webhook_id: int, response: Response, db: Session = Depends(get_d
         return webhook
     except Exception as e:
         response.status_code = status.HTTP_400_BAD_REQUEST
-        return {"detail": str(e)}
\ No newline at end of file
+        return {"detail": str(e)}
+
+# Function to present an API key row, scopes are stored comma separated
+def api_key_response(api_key, **extra):
+    return {"id": api_key.id, "name": api_key.name, "prefix": api_key.prefix, "scopes": api_key.scopes.split(","), "created_at": api_key.created_at, "revoked_at": api_key.revoked_at} | extra
+
+# Endpoint to create an API key, the key is only ever shown in this response
+@router.post("/api-keys", response_model=ApiKeyCreatedResponse | DetailResponse, dependencies=[Security(verify_credentials, scopes=["admin"])])
+def create_key(api_key: ApiKeyCreate, response: Response, db: Session = Depends(get_db)):
+    try:
+        key, prefix, key_hash = new_api_key() # Generate the key, only its hash is stored
+        created = create_api_key(db, api_key.name, sorted(set(api_key.scopes)), prefix, key_hash)
+        return api_key_response(created, key=key)
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
+
+# Endpoint to get a list of all API keys, revoked ones included
+@router.get("/api-keys", response_model=list[ApiKeyResponse] | DetailResponse, dependencies=[Security(verify_credentials, scopes=["admin"])])
+async def get_keys(response: Response, db: AsyncSession = Depends(get_async_db)):
+    try:
+        return [api_key_response(api_key) for api_key in await async_crud.get_all_api_keys(db)]
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
+
+# Endpoint to revoke an API key by ID, it stops working in every API process at once
+@router.delete("/api-keys/{api_key_id}", response_model=ApiKeyResponse | DetailResponse, dependencies=[Security(verify_credentials, scopes=["admin"])])
+def revoke_key(api_key_id: int, response: Response, db: Session = Depends(get_db)):
+    try:
+        api_key = revoke_api_key(db, api_key_id) # Mark the key revoked in the database
+        if not api_key:
+            raise Exception("API key not found")
+        broadcast_revocation(api_key.key_hash) # Drop it from the verified key caches
+        return api_key_response(api_key)
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
+
+# Endpoint to get the state of the database connection pools of this API process, 'sync' for writes and 'async' for the read routes
+@router.get("/db-pool", response_model=dict[str, PoolStatsResponse] | DetailResponse, dependencies=[Security(verify_credentials, scopes=["admin"])])
+def get_db_pool(response: Response):
+    try:
+        return {"sync": pool_stats(engine), "async": pool_stats(async_engine)}
+    except Exception as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"detail": str(e)}
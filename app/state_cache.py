@@ -0,0 +1,99 @@
+import os
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+import redis
+from app.database import SiteStatusHistory, StatusType, as_utc
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+STATE_CACHE_TTL_SECONDS = int(os.getenv("STATE_CACHE_TTL_SECONDS", "86400")) # Idle sites fall out of the cache after this time
+
+logger = logging.getLogger(__name__)
+
+# The part of the last history entry needed to detect a status change
+@dataclass
+class LastState:
+    status: StatusType
+    last_checked: datetime
+    last_status_change: datetime
+
+    @classmethod
+    def from_entry(cls, entry: SiteStatusHistory):
+        return cls(StatusType(entry.status), as_utc(entry.last_checked), as_utc(entry.last_status_change))
+
+# Last state of every site, as one redis hash per site
+# Populated on every history write and read in O(1), on any redis error callers fall back to the database
+class StateCache:
+    def __init__(self, redis_client: redis.StrictRedis, ttl: int = STATE_CACHE_TTL_SECONDS):
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    @staticmethod
+    def key(site_id: int):
+        return f"site_state:{site_id}"
+
+    def get(self, site_id: int):
+        try:
+            state = self.redis_client.hgetall(self.key(site_id))
+        except redis.RedisError as e:
+            logger.warning(f"State cache read failed for site {site_id} : {e}")
+            return None
+        if not state:
+            return None
+        return LastState(StatusType(state[b"status"].decode()), datetime.fromisoformat(state[b"last_checked"].decode()), datetime.fromisoformat(state[b"last_status_change"].decode()))
+
+    # Last status of many sites in one round-trip, sites missing from the cache are left out, and all of them on a redis error
+    def get_statuses(self, site_ids: list[int]):
+        try:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                for site_id in site_ids:
+                    pipe.hget(self.key(site_id), "status")
+                statuses = pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"State cache read failed for {len(site_ids)} sites : {e}")
+            return {}
+        return {site_id: StatusType(status.decode()) for site_id, status in zip(site_ids, statuses) if status is not None}
+
+    def set(self, site_id: int, state: LastState):
+        try:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.hset(self.key(site_id), mapping={"status": state.status.value, "last_checked": as_utc(state.last_checked).isoformat(), "last_status_change": as_utc(state.last_status_change).isoformat()})
+                pipe.expire(self.key(site_id), self.ttl)
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"State cache write failed for site {site_id} : {e}")
+
+    # Same as set for many sites, in one round-trip
+    def set_many(self, states: dict[int, LastState]):
+        try:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                for site_id, state in states.items():
+                    pipe.hset(self.key(site_id), mapping={"status": state.status.value, "last_checked": as_utc(state.last_checked).isoformat(), "last_status_change": as_utc(state.last_status_change).isoformat()})
+                    pipe.expire(self.key(site_id), self.ttl)
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"State cache write failed for {len(states)} sites : {e}")
+
+    def delete(self, site_id: int):
+        try:
+            self.redis_client.delete(self.key(site_id))
+        except redis.RedisError as e:
+            logger.warning(f"State cache invalidation failed for site {site_id} : {e}")
+
+    def delete_many(self, site_ids: list[int]):
+        if not site_ids:
+            return
+        try:
+            self.redis_client.delete(*[self.key(site_id) for site_id in site_ids])
+        except redis.RedisError as e:
+            logger.warning(f"State cache invalidation failed for {len(site_ids)} sites : {e}")
+
+state_cache = StateCache(redis.StrictRedis.from_url(REDIS_URL))
+
+# Function to record a freshly written history entry as the last state of its site
+def remember_state(entry: SiteStatusHistory):
+    state_cache.set(entry.site_id, LastState.from_entry(entry))
+
+# Function to drop the cached state of a removed site
+def forget_state(site_id: int):
+    state_cache.delete(site_id)
@@ -0,0 +1,58 @@
+# Benchmark of site_status_history reads against table size, without and with the composite index
+# Usage: python -m benchmarks.bench_history_index [rows ...]
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.orm import sessionmaker
+from app.database import Base, Site, SiteStatusHistory, StatusType
+from app.migrations import apply_migrations
+
+SITES = 200
+REPEAT = 50
+INDEXES = ["ix_site_status_history_site_id_last_checked", "ix_site_status_history_last_checked"]
+
+# Function to fill a fresh database with 'rows' history rows spread over SITES sites, in random site order like real checks
+def build_database(path: str, rows: int):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    start = datetime.now(timezone.utc) - timedelta(seconds=rows)
+    with engine.begin() as connection:
+        connection.execute(insert(Site), [{"id": site_id, "url": f"https://site-{site_id}.test/", "name": f"site {site_id}"} for site_id in range(1, SITES + 1)])
+        for offset in range(0, rows, 50_000):
+            chunk = range(offset, min(rows, offset + 50_000))
+            connection.execute(insert(SiteStatusHistory), [{"site_id": random.randint(1, SITES), "status": StatusType.UP, "response_time_ms": 100, "last_checked": start + timedelta(seconds=i), "last_status_change": start} for i in chunk])
+    return engine
+
+# Function to time the two per-site reads of the API and the worker, in milliseconds per query
+def time_queries(engine):
+    session = sessionmaker(bind=engine)()
+    timings = {}
+    for name, limit in [("last_state", 1), ("history_page", 100)]:
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            site_id = random.randint(1, SITES)
+            session.query(SiteStatusHistory).filter(SiteStatusHistory.site_id == site_id).order_by(SiteStatusHistory.last_checked.desc(), SiteStatusHistory.id.desc()).limit(limit).all()
+        timings[name] = (time.perf_counter() - start) / REPEAT * 1000
+    session.close()
+    return timings
+
+def main(sizes: list[int]):
+    print(f"{'rows':>10} | {'last_state before':>17} | {'last_state after':>16} | {'page before':>11} | {'page after':>10}")
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = build_database(os.path.join(directory, "bench.db"), rows)
+            with engine.begin() as connection:
+                for index in INDEXES:
+                    connection.execute(text(f"DROP INDEX IF EXISTS {index}")) # Schema as it was before the migration
+            before = time_queries(engine)
+            apply_migrations(engine)
+            after = time_queries(engine)
+            engine.dispose()
+        print(f"{rows:>10} | {before['last_state']:>15.3f}ms | {after['last_state']:>14.3f}ms | {before['history_page']:>9.3f}ms | {after['history_page']:>8.3f}ms")
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -0,0 +1,115 @@
+# Load test of the routes of app/sites.py behind the rate limiter, as pure ASGI middleware and wrapped in BaseHTTPMiddleware
+# Needs a running redis (REDIS_URL), usage: python -m benchmarks.bench_middleware [requests] [concurrency]
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import statistics
+from datetime import datetime, timedelta, timezone
+import httpx
+import redis
+from fastapi import FastAPI
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse
+from app import sites
+from app.authetication import verify_credentials
+from app.database import Base, Site, SiteStatusHistory, StatusType
+from app.middleware import RateLimiterMiddleware
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SITES = 50
+HISTORY_ROWS = 20_000
+ROUTES = ["/sites", "/sites/1/history?limit=100", "/history/export?site_id=1"]
+
+# The rate limiter as it was before, on top of BaseHTTPMiddleware, same decision logic
+class BaseHTTPRateLimiter(BaseHTTPMiddleware):
+    def __init__(self, app, **kwargs):
+        super().__init__(app)
+        self.limiter = RateLimiterMiddleware(app, **kwargs)
+
+    async def dispatch(self, request, call_next):
+        allowed, remaining, reset_time = await self.limiter.hit(request.client.host)
+        if not allowed:
+            return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
+        response = await call_next(request)
+        response.headers["X-RateLimit-Limit"] = str(self.limiter.limit)
+        response.headers["X-RateLimit-Remaining"] = str(remaining)
+        response.headers["X-RateLimit-Reset"] = str(reset_time)
+        return response
+
+# Function to fill a fresh database with SITES sites and HISTORY_ROWS history rows
+def build_database(path: str):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    start = datetime.now(timezone.utc) - timedelta(seconds=HISTORY_ROWS)
+    with engine.begin() as connection:
+        connection.execute(insert(Site), [{"id": site_id, "url": f"https://site-{site_id}.test/", "name": f"site {site_id}"} for site_id in range(1, SITES + 1)])
+        connection.execute(insert(SiteStatusHistory), [{"site_id": i % SITES + 1, "status": StatusType.UP, "response_time_ms": 100, "last_checked": start + timedelta(seconds=i), "last_status_change": start} for i in range(HISTORY_ROWS)])
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Function to build the API with the given rate limiter middleware class
+def build_app(session_factory, middleware):
+    app = FastAPI()
+    app.include_router(sites.router)
+
+    def get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def get_async_db():
+        async with async_sessionmaker(async_engine, expire_on_commit=False)() as db:
+            yield db
+
+    # The async engine is made per event loop, its pool cannot be shared between them
+    async_engine = create_async_engine(str(session_factory.kw["bind"].url).replace("sqlite://", "sqlite+aiosqlite://"))
+    app.state.async_engine = async_engine
+    app.dependency_overrides[sites.get_db] = get_db
+    app.dependency_overrides[sites.get_async_db] = get_async_db
+    app.dependency_overrides[verify_credentials] = lambda: True
+    app.add_middleware(middleware, redis_url=REDIS_URL, limit=10**9, window=60)
+    return app
+
+# Function to send 'requests' requests to a route, 'concurrency' at a time, returns the latencies in milliseconds
+async def load(app: FastAPI, route: str, requests: int, concurrency: int):
+    latencies = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        await client.get(route) # Warm up
+
+        async def one():
+            start = time.perf_counter()
+            response = await client.get(route)
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        for _ in range(requests // concurrency):
+            await asyncio.gather(*[one() for _ in range(concurrency)])
+        throughput = len(latencies) / (time.perf_counter() - start)
+    await app.state.async_engine.dispose() # Each pooled aiosqlite connection holds a thread
+    return latencies, throughput
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    redis_client = redis.StrictRedis.from_url(REDIS_URL)
+    for key in redis_client.scan_iter("rate_limit:*"): # Counts left by earlier runs
+        redis_client.delete(key)
+
+    with tempfile.TemporaryDirectory() as directory:
+        session_factory = build_database(os.path.join(directory, "bench.db"))
+        print(f"{'route':<32}{'middleware':<16}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for route in ROUTES:
+            for name, middleware in [("BaseHTTP", BaseHTTPRateLimiter), ("pure ASGI", RateLimiterMiddleware)]:
+                latencies, throughput = asyncio.run(load(build_app(session_factory, middleware), route, requests, concurrency))
+                p99 = statistics.quantiles(latencies, n=100)[98]
+                print(f"{route:<32}{name:<16}{throughput:>10.0f}{statistics.median(latencies):>10.2f}{p99:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# Benchmark of the rate limiter overhead per request, against the same app without it
+# Needs a running redis (REDIS_URL), usage: python -m benchmarks.bench_rate_limiter [requests] [concurrency]
+import os
+import sys
+import time
+import asyncio
+import httpx
+import redis
+from fastapi import FastAPI
+from app.middleware import RateLimiterMiddleware
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Function to build a bare app, with the rate limiter when 'local_fraction' is given
+def build_app(local_fraction: float | None):
+    app = FastAPI()
+
+    @app.get("/")
+    def root():
+        return {"detail": "ok"}
+
+    if local_fraction is not None:
+        app.add_middleware(RateLimiterMiddleware, redis_url=REDIS_URL, limit=10**9, window=60, local_fraction=local_fraction)
+    return app
+
+# Function to time 'requests' requests sent 'concurrency' at a time, in microseconds per request
+async def time_requests(app: FastAPI, requests: int, concurrency: int):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        await client.get("/") # Warm up, connects to redis and loads the script
+        start = time.perf_counter()
+        for _ in range(requests // concurrency):
+            await asyncio.gather(*[client.get("/") for _ in range(concurrency)])
+        return (time.perf_counter() - start) / requests * 1_000_000
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    redis_client = redis.StrictRedis.from_url(REDIS_URL)
+    for key in redis_client.scan_iter("rate_limit:*"): # Counts left by earlier runs
+        redis_client.delete(key)
+
+    baseline = asyncio.run(time_requests(build_app(None), requests, concurrency))
+    print(f"{'variant':<28}{'us/request':>12}{'overhead':>12}")
+    print(f"{'no rate limiter':<28}{baseline:>12.1f}{'-':>12}")
+    for name, local_fraction in [("redis lua, every request", 0.0), ("local bucket 1% of limit", 0.01)]:
+        elapsed = asyncio.run(time_requests(build_app(local_fraction), requests, concurrency))
+        print(f"{name:<28}{elapsed:>12.1f}{elapsed - baseline:>12.1f}")
+
+if __name__ == "__main__":
+    main()
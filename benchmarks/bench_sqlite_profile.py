@@ -0,0 +1,109 @@
+# Benchmark of check throughput on SQLite, with the production profile (SQLITE_PRODUCTION) on and off
+# Several worker processes store check results concurrently, as the gevent workers and the API do, while another process reads history pages
+# usage: python -m benchmarks.bench_sqlite_profile [seconds] [processes] [threads]
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+import statistics
+import multiprocessing
+from datetime import datetime, timezone
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from app.crud import get_history_page, get_last_history_state
+from app.database import Base, Site, SiteStatusHistory, StatusType, configure_sqlite
+
+SITES = 1000
+
+# Function to open the database, on the production profile when asked
+def session_factory(path: str, production: bool):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    if production:
+        configure_sqlite(engine, writer_lock=threading.Lock()) # A lock per process, like sqlite_writer_lock
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Function to create the sites, each with its initial history row
+def build_database(path: str):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    now = datetime.now(timezone.utc)
+    with engine.begin() as connection:
+        connection.execute(insert(Site), [{"id": site_id, "url": f"https://site-{site_id}.test/", "name": f"site {site_id}"} for site_id in range(1, SITES + 1)])
+        connection.execute(insert(SiteStatusHistory), [{"site_id": site_id, "status": StatusType.INITIAL, "last_checked": now, "last_status_change": now} for site_id in range(1, SITES + 1)])
+    engine.dispose()
+
+# Stores check results for 'seconds' from 'threads' threads, the way record_status does: read the last state, then add a row and commit
+def store_checks(path: str, production: bool, seconds: float, threads: int, results):
+    Session = session_factory(path, production)
+    latencies, errors = [], [0]
+
+    def run():
+        db = Session()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            site_id = random.randint(1, SITES)
+            start = time.perf_counter()
+            try:
+                last_entry = get_last_history_state(db, Site(id=site_id))
+                now = datetime.now(timezone.utc)
+                db.add(SiteStatusHistory(site_id=site_id, status=StatusType.UP, response_time_ms=100, last_checked=now, last_status_change=last_entry.last_status_change))
+                db.commit()
+                latencies.append((time.perf_counter() - start) * 1000)
+            except OperationalError: # database is locked
+                db.rollback()
+                errors[0] += 1
+        db.close()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put((latencies, errors[0]))
+
+# Reads history pages for 'seconds', like API clients polling
+def read_history(path: str, production: bool, seconds: float, results):
+    Session = session_factory(path, production)
+    db = Session()
+    pages = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        get_history_page(db, Site(id=random.randint(1, SITES)), 100)
+        db.rollback()
+        pages += 1
+    db.close()
+    results.put(pages)
+
+def run(production: bool, seconds: float, processes: int, threads: int):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        build_database(path)
+        writes, reads = multiprocessing.Queue(), multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=store_checks, args=(path, production, seconds, threads, writes)) for _ in range(processes)]
+        reader = multiprocessing.Process(target=read_history, args=(path, production, seconds, reads))
+        for process in workers + [reader]:
+            process.start()
+        outcomes = [writes.get() for _ in workers]
+        pages = reads.get()
+        for process in workers + [reader]:
+            process.join()
+    latencies = [latency for process_latencies, _ in outcomes for latency in process_latencies]
+    errors = sum(process_errors for _, process_errors in outcomes)
+    p99 = statistics.quantiles(latencies, n=100)[98] if len(latencies) > 1 else float("nan")
+    return len(latencies) / seconds, errors, p99, pages / seconds
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    print(f"{processes} writer processes x {threads} threads, 1 reader process, {seconds:.0f}s each")
+    print(f"{'profile':<12}{'checks/s':>10}{'locked':>10}{'p99 ms':>10}{'reads/s':>10}")
+    for name, production in [("default", False), ("production", True)]:
+        throughput, errors, p99, reads = run(production, seconds, processes, threads)
+        print(f"{name:<12}{throughput:>10.0f}{errors:>10}{p99:>10.1f}{reads:>10.0f}")
+
+if __name__ == "__main__":
+    main()
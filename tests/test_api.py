@@ -3,18 +3,52 @@ import sys
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-import pytest
-from asyncio import sleep
+import json
+import time
+import socket
+import asyncio
+import logging
+import tempfile
+import threading
 import subprocess
+from asyncio import sleep
 from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import anyio
+import httpx
+import pytest
+import redis
+import requests
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func, inspect, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from app.database import Base
-from app.sites import get_db
-from app.run import app
-import logging
+from sqlalchemy.pool import NullPool
+from starlette.responses import PlainTextResponse
+from tenacity import stop_after_attempt
 
+from app.background_worker import OUTCOMES_KEY, get_website_response, record_status, report_outcomes
+from app.compaction import compact_history
+from app.crud import get_last_state
+from app.database import Base, InstrumentedQueuePool, ProbeMode, SchemaMigration, Site, SiteStatusHistory, SiteStatusRollup, StatusType, configure_sqlite, pool_stats
+from app.dns_cache import DnsCache
+from app.history_writer import HistoryWriter
+from app.http_pool import RequestTiming, create_async_client, decode_timings, encode_timings
+from app.metrics import observe_check
+from app.middleware import RateLimiterMiddleware
+from app.migrations import MIGRATIONS, apply_migrations
+from app.models import SiteStatusHistoryResponse
+from app.notification import DISCORD_MESSAGE_LIMIT, coalesce_messages, queue_key, redis_client
+from app.probe_engine import ProbeBudget, ProbeSpec, probe_passed, probe_sites
+from app.response_cache import response_cache
+from app.rollups import RollupWriter
+from app.run import REDIS_URL, app
+from app.scheduler import DUE_KEY, EVENTS_KEY, CheckScheduler, announce_site_added, announce_sites_removed, drain_events, drain_outcomes, sync_sites
+from app.sharding import HashRing
+from app.sites import get_async_db, get_db
+from app.state_cache import StateCache, remember_state, state_cache
 
 ### - Logging
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +63,8 @@ SQLALCHEMY_DATABASE_URL = "sqlite:///test_web_monitor.db"
 TEST_DB_PATH = "./test_web_monitor.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine("sqlite+aiosqlite:///test_web_monitor.db", poolclass=NullPool) # TestClient runs each request on its own event loop, so connections are not pooled
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 def override_get_db():
     db = TestingSessionLocal()
@@ -37,10 +73,18 @@ def override_get_db():
     finally:
         db.close()
 
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
 @pytest.fixture(scope="function")
 def client():
     Base.metadata.create_all(bind=engine)
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    response_cache.clear() # Each test starts on fresh tables
+    for key in redis_client.scan_iter("rate_limit:testclient*"): # And with the whole rate limit, whatever the tests before it sent
+        redis_client.delete(key)
     yield TestClient(app)
     Base.metadata.drop_all(bind=engine)
     
@@ -134,7 +178,7 @@ def create_multiple_webhooks(client, create_multiple_sites):
     assert response_2.status_code == 200
     return [response_1.json(), response_2.json()]
 
-### - Tests (10)
+### - Tests (38)
 # getting one site
 def test_get_site_by_id(client, create_site):
     headers = basic_auth_header(USERNAME, PASSWORD)
@@ -245,6 +289,754 @@ async def test_monitoring_start_between_end(client, start_celery_worker):
     response_3 = client.get(f"/sites/{site_id}/history", headers=headers)
     assert response_3.status_code == 200
     data = response_3.json()
-    assert data[0]["status"] == "INITIAL"
+    assert data["items"][0]["status"] == "INITIAL"
     response_4 = client.delete(f"/sites/{site_id}", headers=headers)
-    assert response_4.status_code == 200
\ No newline at end of file
+    assert response_4.status_code == 200
+    
+# paging through the history of a site, with filters
+def test_history_pagination(client, create_site):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    site_id = create_site["id"]
+    db = TestingSessionLocal()
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    db.add_all([SiteStatusHistory(site_id=site_id, status=StatusType.UP if i % 2 else StatusType.DOWN, response_time_ms=i, last_checked=start + timedelta(minutes=i), last_status_change=start) for i in range(25)])
+    db.commit()
+    db.close()
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 10, "until": "2026-01-01T00:00:00Z"} | ({"cursor": cursor} if cursor else {})
+        response = client.get(f"/sites/{site_id}/history", params=params, headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        seen += [item["response_time_ms"] for item in data["items"]]
+        cursor = data["next_cursor"]
+        if not cursor:
+            break
+    assert seen == list(range(24, -1, -1))
+    response = client.get(f"/sites/{site_id}/history", params={"status": "DOWN", "since": "2025-01-01T00:10:00Z", "limit": 100}, headers=headers)
+    assert [item["response_time_ms"] for item in response.json()["items"]] == list(range(24, 9, -2))
+    response = client.get(f"/sites/{site_id}/history", params={"cursor": "not-a-cursor"}, headers=headers)
+    assert response.status_code == 400
+
+# exporting the history of some sites as NDJSON and CSV
+def test_history_export(client, create_multiple_sites):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    site_id_1, site_id_2 = create_multiple_sites[0]["id"], create_multiple_sites[1]["id"]
+    db = TestingSessionLocal()
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    db.add_all([SiteStatusHistory(site_id=site_id_1 if i % 3 else site_id_2, status=StatusType.UP, response_time_ms=i, last_checked=start + timedelta(minutes=i), last_status_change=start) for i in range(30)])
+    db.commit()
+    db.close()
+    response = client.get("/history/export", params={"site_id": site_id_1, "until": "2026-01-01T00:00:00Z"}, headers=headers)
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["response_time_ms"] for row in rows] == [i for i in range(30) if i % 3]
+    response = client.get("/history/export", params={"format": "csv", "site_id": [site_id_1, site_id_2], "since": "2025-01-01T00:00:00Z", "until": "2026-01-01T00:00:00Z"}, headers=headers)
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0] == "site_id,status,response_time_ms,last_checked,last_status_change"
+    assert len(lines) == 31
+
+# uptime and latency stats of a site, served from the rollups
+def test_site_stats(client, create_site):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    site_id = create_site["id"]
+    writer = RollupWriter(session_factory=TestingSessionLocal)
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    for i in range(100):
+        writer.add(site_id, StatusType.DOWN if i % 10 == 0 else StatusType.UP, None if i % 10 == 0 else 40 + i, start + timedelta(seconds=30 * i))
+    writer.close()
+    params = {"since": "2025-01-01T00:00:00Z", "until": "2025-01-01T01:00:00Z"}
+    response = client.get(f"/sites/{site_id}/stats", params=params, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["granularity"] == "minute"
+    assert (data["checks"], data["up_count"], data["down_count"]) == (100, 90, 10)
+    assert data["uptime_percent"] == 90
+    assert (data["min_response_time_ms"], data["max_response_time_ms"]) == (41, 139)
+    assert data["p95_response_time_ms"] == 139
+    assert len(data["buckets"]) == 50
+    response = client.get(f"/sites/{site_id}/stats", params=params | {"granularity": "day"}, headers=headers)
+    assert [(bucket["up_count"], bucket["down_count"]) for bucket in response.json()["buckets"]] == [(90, 10)]
+
+# compacting the raw history of a site past its retention, expired rows are rolled into hour and day buckets
+def test_history_compaction(client):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    response = client.post("/sites", json=test_site_1 | {"retention_days": 2}, headers=headers)
+    assert response.status_code == 200
+    site_id = response.json()["id"]
+    db = TestingSessionLocal()
+    now = datetime(2025, 1, 10, 12, tzinfo=timezone.utc)
+    db.query(SiteStatusHistory).filter(SiteStatusHistory.site_id == site_id).delete()
+    db.add_all([SiteStatusHistory(site_id=site_id, status=StatusType.UP, response_time_ms=100, last_checked=now - timedelta(hours=i), last_status_change=now) for i in range(120)])
+    db.commit()
+    db.close()
+    report = compact_history(session_factory=TestingSessionLocal, dry_run=True, now=now)
+    assert (report["history_rows_deleted"], report["rollup_buckets_backfilled"]) == (59, 62)
+    report = compact_history(session_factory=TestingSessionLocal, now=now)
+    assert report["history_rows_deleted"] == 59
+    response = client.get(f"/sites/{site_id}/history", params={"limit": 1000, "until": "2026-01-01T00:00:00Z"}, headers=headers)
+    assert len(response.json()["items"]) == 61
+    response = client.get(f"/sites/{site_id}/stats", params={"since": "2025-01-05T00:00:00Z", "until": "2025-01-08T00:00:00Z", "granularity": "day"}, headers=headers)
+    assert [bucket["up_count"] for bucket in response.json()["buckets"]] == [11, 24, 24]
+
+# alerts of a site are queued per webhook and coalesced into as few Discord messages as possible
+def test_notification_coalescing(client, create_webhook):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    webhook_url = create_webhook["discord_webhook_url"]
+    redis_client.delete(queue_key(webhook_url))
+    response = client.delete(f"/sites/{create_webhook['site_id']}", headers=headers)
+    assert response.status_code == 200
+    assert [message.decode().split("\n")[0] for message in redis_client.lrange(queue_key(webhook_url), 0, -1)] == ["🟡 **Website Monitoring End**"]
+    redis_client.delete(queue_key(webhook_url))
+    packed = coalesce_messages(["a" * 900, "b" * 900, "c" * 900, "d" * 3000])
+    assert [len(message) for message in packed] == [1802, 900, DISCORD_MESSAGE_LIMIT]
+
+# sites are spread over the shard nodes, and a joining node only takes its own share of them
+def test_shard_ring_rebalance():
+    site_ids = range(1, 10001)
+    before = HashRing(["node-a", "node-b", "node-c"])
+    after = HashRing(["node-a", "node-b", "node-c", "node-d"])
+    owners = {site_id: before.node_for(site_id) for site_id in site_ids}
+    assert all(2500 < list(owners.values()).count(node) < 4200 for node in before.nodes)
+    moved = [site_id for site_id in site_ids if after.node_for(site_id) != owners[site_id]]
+    assert all(after.node_for(site_id) == "node-d" for site_id in moved)
+    assert 1500 < len(moved) < 3500
+
+# scoped API keys, sent as a bearer token or in X-API-Key, and revoked
+def test_api_keys(client):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    response = client.post("/api-keys", json={"name": "automation"}, headers=headers)
+    assert response.status_code == 200
+    created = response.json()
+    key_headers = {"Authorization": f"Bearer {created['key']}"}
+    assert created["scopes"] == ["read"] and created["key"].startswith(created["prefix"])
+    assert client.get("/sites", headers=key_headers).status_code == 200
+    assert client.get("/webhooks", headers={"X-API-Key": created["key"]}).status_code == 200
+    assert client.post("/sites", json=test_site_1, headers=key_headers).status_code == 403
+    assert client.get("/api-keys", headers=key_headers).status_code == 403
+    assert client.get("/sites", headers={"Authorization": "Bearer wm_not-a-key"}).status_code == 401
+    assert "key" not in client.get("/api-keys", headers=headers).json()[0]
+    response = client.delete(f"/api-keys/{created['id']}", headers=headers)
+    assert response.status_code == 200 and response.json()["revoked_at"] is not None
+    assert client.get("/sites", headers=key_headers).status_code == 401
+
+# importing and deleting many sites and webhooks at once, with per-row errors
+def test_bulk_sites_and_webhooks(client, create_site):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    sites = [{"url": f"https://bulk-{i}.example.com/", "name": f"Bulk {i}"} for i in range(50)]
+    rows = sites + [test_site_1, {"url": "not a url", "name": "Broken"}, sites[0]]
+    response = client.post("/sites/bulk", json=rows, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["created"]) == 50
+    assert [error["index"] for error in data["errors"]] == [50, 51, 52]
+    site_ids = [site["id"] for site in data["created"]]
+    history = client.get(f"/sites/{site_ids[0]}/history", headers=headers).json()
+    assert [item["status"] for item in history["items"]] == ["INITIAL"]
+    ndjson = "\n".join(json.dumps({"site_id": site_id, "discord_webhook_url": f"https://discord.test/{site_id}"}) for site_id in site_ids[:3]) + "\n{oops\n"
+    response = client.post("/webhooks/bulk", content=ndjson, headers=headers | {"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert len(response.json()["created"]) == 3 and response.json()["errors"][0]["index"] == 3
+    response = client.post("/sites/bulk-delete", json={"ids": site_ids + [999999]}, headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()["deleted"]) == 50 and response.json()["missing"] == [999999]
+    assert len(client.get("/sites", headers=headers).json()) == 1
+    webhook_ids = [webhook["id"] for webhook in client.get("/webhooks", headers=headers).json()]
+    response = client.post("/webhooks/bulk-delete", json={"ids": webhook_ids}, headers=headers)
+    assert len(response.json()["deleted"]) == 3
+
+# reads are served on the event loop, so they keep working while every threadpool thread is busy
+async def test_async_reads_without_threadpool(client, create_multiple_sites):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    total_tokens = limiter.total_tokens
+    limiter.total_tokens = 1
+    await limiter.acquire() # Hold the only thread, a sync route would now wait forever
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as async_client:
+            site_id = create_multiple_sites[0]["id"]
+            routes = ["/sites", f"/sites/{site_id}", f"/sites/{site_id}/history", "/webhooks"] * 10
+            with anyio.fail_after(10):
+                responses = await asyncio.gather(*[async_client.get(route, headers=headers) for route in routes])
+        assert all(response.status_code == 200 for response in responses)
+        assert responses[0].json() == create_multiple_sites
+    finally:
+        limiter.release()
+        limiter.total_tokens = total_tokens
+
+# listings are served from the response cache with an ETag, and writes invalidate them
+def test_listing_cache_etag(client, create_site):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    response = client.get("/sites", headers=headers)
+    assert response.status_code == 200 and response.json() == [create_site]
+    etag = response.headers["ETag"]
+    response = client.get("/sites", headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 304 and response.content == b""
+    hits = response_cache.hits
+    assert client.get("/sites", headers=headers).json() == [create_site]
+    assert response_cache.hits == hits + 1
+    site_2 = client.post("/sites", json=test_site_2, headers=headers).json()
+    response = client.get("/sites", headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 200 and response.json() == [create_site, site_2]
+    assert response.headers["ETag"] != etag
+    etag = client.get("/webhooks", headers=headers).headers["ETag"]
+    client.post("/webhooks", json=test_webhook_1 | {"site_id": site_2["id"]}, headers=headers)
+    response = client.get("/webhooks", headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 200 and len(response.json()) == 1
+
+# the SQLite production profile switches to WAL and lets concurrent writers of a process through one at a time
+def test_sqlite_production_profile():
+    with tempfile.TemporaryDirectory() as directory:
+        profile_engine = create_engine(f"sqlite:///{directory}/profile.db", connect_args={"check_same_thread": False})
+        writer_lock = threading.Lock()
+        configure_sqlite(profile_engine, writer_lock=writer_lock)
+        Base.metadata.create_all(bind=profile_engine)
+        ProfileSession = sessionmaker(autocommit=False, autoflush=False, bind=profile_engine)
+        with profile_engine.connect() as connection:
+            assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+
+        def write(worker):
+            db = ProfileSession()
+            for i in range(20):
+                db.query(Site).count() # Reads before the write, as the worker does
+                db.add(Site(url=f"https://{worker}-{i}.example.com/", name=f"{worker}-{i}"))
+                db.commit()
+            db.close()
+
+        threads = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db = ProfileSession()
+        assert db.query(Site).count() == 160 and not writer_lock.locked()
+        db.add(Site(url="https://held.example.com/", name="held"))
+        db.flush()
+        assert writer_lock.locked() # Held from the first write until the transaction ends
+        db.close()
+        assert not writer_lock.locked()
+        profile_engine.dispose()
+
+# pool stats count checkouts, overflow and waits, and timeouts once every connection is taken
+def test_db_pool_stats(client):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    response = client.get("/db-pool", headers=headers)
+    assert response.status_code == 200 and set(response.json()) == {"sync", "async"}
+    with tempfile.TemporaryDirectory() as directory:
+        pool_engine = create_engine(f"sqlite:///{directory}/pool.db", poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=1, pool_timeout=0.2)
+        first, second = pool_engine.connect(), pool_engine.connect()
+        stats = pool_stats(pool_engine)
+        assert stats["checked_out"] == 2 and stats["overflow"] == 1 and stats["checkouts"] == 2
+        with pytest.raises(Exception):
+            pool_engine.connect()
+        stats = pool_stats(pool_engine)
+        assert stats["timeouts"] == 1 and stats["wait_ms_max"] >= 200
+        first.close()
+        second.close()
+        assert pool_stats(pool_engine)["checked_out"] == 0
+        pool_engine.dispose()
+
+# A response slower than a second is timed in full, DNS, connect and TTFB apart, on the sync and async probe paths
+def test_probe_timing_breakdown():
+    class SlowHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(1.1)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://localhost:{server.server_port}/"
+    try:
+        attempts = []
+        assert get_website_response(url, timeout=5, attempts=attempts).status_code == 200
+        [result] = probe_sites([(1, url)])
+        assert result.status_code == 200 and result.response_time_ms >= 1100
+        for timing in attempts + result.attempts:
+            assert timing.dns_ms is not None and timing.connect_ms is not None and timing.tls_ms is None
+            assert timing.ttfb_ms >= 1100 and timing.total_ms >= timing.dns_ms + timing.connect_ms + timing.ttfb_ms
+        assert attempts[0].response_time_ms >= 1100 # Used to keep only the sub-second part
+    finally:
+        server.shutdown()
+
+    encoded = encode_timings(attempts + result.attempts)
+    assert encoded.count(";") == 1 and encode_timings(decode_timings(encoded)) == encoded
+    entry = SiteStatusHistory(status=StatusType.UP, response_time_ms=1100, probe_timings=encoded, last_checked=datetime.now(), last_status_change=datetime.now())
+    assert len(SiteStatusHistoryResponse.model_validate(entry).probe_timings) == 2
+
+# /metrics exposes request, check and pool metrics, requests are labelled by route template
+def test_metrics(client, create_site):
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    assert client.get(f"/sites/{create_site['id']}", headers=headers).status_code == 200
+    observe_check("UP", [RequestTiming(dns_ms=1.0, connect_ms=2.0, ttfb_ms=30.0, total_ms=40.0)], True)
+    response = client.get("/metrics")
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/plain")
+    assert 'webmonitor_http_request_seconds_count{method="GET",route="/sites/{site_id}",status="200"}' in response.text
+    assert 'webmonitor_checks_total{status="UP"}' in response.text and 'webmonitor_probe_phase_seconds_count{phase="dns"}' in response.text
+    assert 'webmonitor_db_pool_checkouts_total{engine="sync"}' in response.text and "webmonitor_db_commit_seconds_count" in response.text
+    response = client.get("/metrics", headers={"Accept": "application/openmetrics-text; version=1.0.0"})
+    assert response.headers["content-type"].startswith("application/openmetrics-text") and response.text.endswith("# EOF\n")
+
+# Each probe mode reaches the same verdict on the sync and async paths, HEAD falls back to GET when the server does not implement it
+def test_probe_modes(client):
+    class PageHandler(BaseHTTPRequestHandler): # No do_HEAD, HEAD gets a 501
+        def do_GET(self):
+            body = b"<html>" + b"x" * 100 + b"healthy" + b"y" * 1_000_000
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+    specs = {
+        "GET": (ProbeSpec(), True),
+        "HEAD": (ProbeSpec(ProbeMode.HEAD), True),
+        "STREAM": (ProbeSpec(ProbeMode.STREAM), True),
+        "BODY": (ProbeSpec(ProbeMode.BODY, "healthy"), True),
+        "BODY missing": (ProbeSpec(ProbeMode.BODY, "missing", 4096), False),
+        "TCP": (ProbeSpec(ProbeMode.TCP), True),
+    }
+    try:
+        results = probe_sites([(index, url, spec) for index, (spec, _) in enumerate(specs.values())])
+        for (name, (spec, up)), result in zip(specs.items(), results):
+            response = get_website_response(url, timeout=5, spec=spec)
+            assert probe_passed(response, 200) == up and probe_passed(result.response, 200) == up, name
+            assert response.status_code == result.status_code == (None if spec.mode == ProbeMode.TCP else 200), name
+    finally:
+        server.shutdown()
+        server.server_close()
+    with pytest.raises(requests.ConnectionError):
+        get_website_response.retry_with(stop=stop_after_attempt(1))(url, timeout=1, spec=ProbeSpec(ProbeMode.TCP))
+
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    site = {"url": "https://keyword.example.com/", "name": "Keyword", "probe_mode": "BODY"}
+    assert client.post("/sites", json=site, headers=headers).status_code == 422
+    response = client.post("/sites", json={**site, "probe_keyword": "healthy"}, headers=headers)
+    assert response.status_code == 200 and response.json()["probe_mode"] == "BODY" and response.json()["probe_max_body_bytes"] is None
+
+# The DNS cache answers repeated lookups without the resolver, shares concurrent async lookups, and falls back on expired entries while the resolver fails
+def test_dns_cache():
+    calls = []
+    failure = []
+
+    def resolver(host, port, family, type):
+        calls.append(host)
+        time.sleep(0.05)
+        if failure:
+            raise failure[0]
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 0)), (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 0))]
+
+    cache = DnsCache(ttl=0.2, stale=5, negative=5, resolver=resolver)
+    assert cache.resolve("a.example") == ["192.0.2.1"] and cache.resolve("a.example") == ["192.0.2.1"]
+    assert cache.resolve("192.0.2.7") == ["192.0.2.7"] and calls == ["a.example"]
+
+    async def many():
+        return await asyncio.gather(*[cache.resolve_async("b.example") for _ in range(20)])
+    assert asyncio.run(many()) == [["192.0.2.1"]] * 20 and calls.count("b.example") == 1
+
+    time.sleep(0.25) # Expired
+    failure.append(socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution"))
+    assert cache.resolve("a.example") == ["192.0.2.1"] # Served stale
+    failure[0] = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.resolve("gone.example")
+    assert calls.count("gone.example") == 1 # Remembered as missing
+    stats = cache.stats()
+    assert stats["hits"] == 21 and stats["stale_hits"] == 1 and stats["misses"] == 4
+
+# A site staying DOWN backs off up to the cap, status changes are checked again quickly, and the probe budget paces check starts
+def test_adaptive_scheduling():
+    scheduler = CheckScheduler(jitter_ratio=0, reconfirm_seconds=5, backoff_max_seconds=100)
+    scheduler.schedule(1, 30, due=0, now=0)
+    assert scheduler.record_outcome(1, StatusType.DOWN, True, now=10) == 15
+    assert [scheduler.record_outcome(1, StatusType.DOWN, False, now=0) for _ in range(4)] == [60, 100, 100, 100]
+    assert scheduler.pop_due(now=100) == [1] and scheduler.due_times() == {1: 200}
+    assert scheduler.record_outcome(1, StatusType.UP, True, now=200) == 205
+    assert scheduler.record_outcome(1, StatusType.UP, False, now=205) is None
+    assert scheduler.pop_due(now=205) == [1] and scheduler.due_times() == {1: 235}
+
+    redis_client.delete(OUTCOMES_KEY)
+    report_outcomes(redis_client, [(2, StatusType.DOWN, StatusType.UP), (3, StatusType.UP, StatusType.UP), (4, StatusType.DOWN, StatusType.INITIAL), (5, StatusType.UP, StatusType.DOWN)])
+    assert redis_client.lrange(OUTCOMES_KEY, 0, -1) == [b"2:DOWN:1", b"4:DOWN:0", b"5:UP:1"]
+    for site_id in (2, 3, 4, 5):
+        scheduler.schedule(site_id, 30, due=1000, now=0)
+    try:
+        assert drain_outcomes(scheduler, redis_client, now=300) == {2: 305, 4: 360, 5: 305}
+        assert redis_client.llen(OUTCOMES_KEY) == 0
+    finally:
+        redis_client.hdel(DUE_KEY, 2, 4, 5)
+
+    async def paced():
+        budget = ProbeBudget(50, burst=5)
+        start = time.perf_counter()
+        waits = await asyncio.gather(*[budget.acquire() for _ in range(15)])
+        return time.perf_counter() - start, waits
+    elapsed, waits = asyncio.run(paced())
+    assert waits[:5] == [0.0] * 5 and 0.18 < elapsed < 0.5
+
+# A site redirecting to its real page is UP in every HTTP probe mode, on the sync and async paths
+def test_probe_follows_redirects():
+    class RedirectHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/":
+                self.send_response(301)
+                self.send_header("Location", "/home")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_HEAD = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RedirectHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+    specs = [ProbeSpec(), ProbeSpec(ProbeMode.HEAD), ProbeSpec(ProbeMode.STREAM)]
+    try:
+        results = probe_sites([(index, url, spec) for index, spec in enumerate(specs)])
+        for spec, result in zip(specs, results):
+            assert get_website_response(url, timeout=5, spec=spec).status_code == 200, spec.mode
+            assert result.status_code == 200 and probe_passed(result.response, 200), spec.mode
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# Buffered history rows are committed before their callbacks run, a failed flush keeps them for the next one,
+# a row the database rejects is dropped without holding back the others, and the buffer is capped
+def test_history_writer_failures():
+    with tempfile.TemporaryDirectory() as directory:
+        writer_engine = create_engine(f"sqlite:///{directory}/writer.db")
+        event.listen(writer_engine, "connect", lambda connection, _: connection.execute("PRAGMA foreign_keys=ON"))
+        Session = sessionmaker(bind=writer_engine)
+        writer = HistoryWriter(session_factory=Session, flush_size=1000, flush_seconds=3600, max_rows=8)
+        now = datetime.now(timezone.utc)
+
+        def entry(site_id):
+            return SiteStatusHistory(site_id=site_id, status=StatusType.UP, response_time_ms=10, last_checked=now, last_status_change=now)
+
+        def count_rows():
+            with Session() as db:
+                return db.scalar(select(func.count()).select_from(SiteStatusHistory))
+
+        notified = []
+        writer.add(entry(1), lambda: notified.append(count_rows()))
+        writer.flush() # No tables yet, a transient error
+        assert writer.stats()["queue_depth"] == 1 and writer.flush_errors == 1 and notified == []
+
+        Base.metadata.create_all(bind=writer_engine)
+        with Session() as db:
+            db.add(Site(id=1, url="https://a.example/", name="a"))
+            db.commit()
+        writer.flush()
+        assert notified == [1] and writer.last_pending(1) is None # Committed before the callback ran
+
+        writer.add(entry(999), lambda: notified.append("deleted site")) # Site removed before the flush
+        for _ in range(5):
+            writer.add(entry(1), lambda: notified.append("ok"))
+        writer.flush()
+        stats = writer.stats()
+        assert stats["queue_depth"] == 0 and stats["rows_written"] == 6 and stats["rows_dropped"] == 1
+        assert notified[1:] == ["ok"] * 5 and count_rows() == 6
+
+        for _ in range(10):
+            writer.add(entry(1))
+        assert writer.stats()["queue_depth"] == 8 and writer.rows_dropped == 3
+        writer.close()
+        assert count_rows() == 14
+        writer_engine.dispose()
+
+# Rollup buckets of a deleted site are dropped without holding back the others, a failed flush keeps the buckets, and the buffer is capped
+def test_rollup_writer_failures():
+    with tempfile.TemporaryDirectory() as directory:
+        writer_engine = create_engine(f"sqlite:///{directory}/rollups.db")
+        event.listen(writer_engine, "connect", lambda connection, _: connection.execute("PRAGMA foreign_keys=ON"))
+        Session = sessionmaker(bind=writer_engine)
+        writer = RollupWriter(session_factory=Session, flush_size=1000, flush_seconds=3600, max_buckets=7)
+        now = datetime.now(timezone.utc)
+
+        def count_buckets():
+            with Session() as db:
+                return db.scalar(select(func.count()).select_from(SiteStatusRollup))
+
+        writer.add(1, StatusType.UP, 10, now)
+        writer.flush() # No tables yet
+        assert writer.stats()["queue_depth"] == 3 and writer.flush_errors == 1
+
+        Base.metadata.create_all(bind=writer_engine)
+        with Session() as db:
+            db.add(Site(id=1, url="https://a.example/", name="a"))
+            db.commit()
+        writer.add(999, StatusType.DOWN, None, now) # Site removed before the flush
+        writer.add(1, StatusType.UP, 20, now)
+        writer.flush()
+        stats = writer.stats()
+        assert stats["queue_depth"] == 0 and stats["buckets_written"] == 3 and stats["buckets_dropped"] == 3 and count_buckets() == 3
+        with Session() as db:
+            assert {row.up_count for row in db.query(SiteStatusRollup)} == {2}
+
+        for day in range(3):
+            writer.add(1, StatusType.UP, 10, now + timedelta(days=day + 1))
+        assert writer.stats()["queue_depth"] == 7 and writer.buckets_dropped == 5
+        writer.close()
+        writer_engine.dispose()
+
+# Workers flushing the same buckets at the same time add onto each other, no check and no histogram count is lost
+def test_rollup_writer_concurrent_flushes():
+    with tempfile.TemporaryDirectory() as directory:
+        writer_engine = create_engine(f"sqlite:///{directory}/rollups.db", connect_args={"timeout": 30})
+        Session = sessionmaker(bind=writer_engine)
+        Base.metadata.create_all(bind=writer_engine)
+        with Session() as db:
+            db.add(Site(id=1, url="https://a.example/", name="a"))
+            db.commit()
+        writers = [RollupWriter(session_factory=Session, flush_size=1000, flush_seconds=3600) for _ in range(4)]
+        checked_at = datetime.now(timezone.utc)
+        barrier = threading.Barrier(len(writers))
+
+        def work(writer, response_time):
+            for _ in range(25):
+                writer.add(1, StatusType.UP, response_time, checked_at)
+                writer.add(1, StatusType.DOWN, None, checked_at)
+                barrier.wait()
+                writer.flush()
+            writer.close()
+
+        threads = [threading.Thread(target=work, args=(writer, 10 * (index + 1))) for index, writer in enumerate(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with Session() as db:
+            rows = db.query(SiteStatusRollup).all()
+        assert len(rows) == 3 and all(writer.stats()["queue_depth"] == 0 for writer in writers)
+        for row in rows:
+            assert (row.up_count, row.down_count, row.response_time_count, row.response_time_sum) == (100, 100, 100, 25 * (10 + 20 + 30 + 40))
+            assert (row.response_time_min, row.response_time_max, row.latency_histogram) == (10, 40, "100,0,0,0,0,0,0,0,0")
+        writer_engine.dispose()
+
+BASELINE_SCHEMA = [ # Tables as the first release created them
+    "CREATE TABLE sites (id INTEGER PRIMARY KEY, url VARCHAR NOT NULL UNIQUE, name VARCHAR, check_interval_seconds INTEGER, expected_status_code INTEGER)",
+    "CREATE TABLE site_status_history (id INTEGER PRIMARY KEY, site_id INTEGER REFERENCES sites (id) ON DELETE CASCADE, status VARCHAR(7) NOT NULL, response_time_ms INTEGER, last_checked DATETIME, last_status_change DATETIME)",
+    "CREATE TABLE webhooks (id INTEGER PRIMARY KEY, site_id INTEGER NOT NULL, discord_webhook_url VARCHAR NOT NULL UNIQUE)",
+]
+
+# A database created by the first release is upgraded in place, and its sites keep the GET probe mode
+def test_migration_from_baseline():
+    with tempfile.TemporaryDirectory() as directory:
+        baseline_engine = create_engine(f"sqlite:///{directory}/baseline.db")
+        with baseline_engine.begin() as connection:
+            for statement in BASELINE_SCHEMA:
+                connection.exec_driver_sql(statement)
+            connection.exec_driver_sql("INSERT INTO sites (id, url, name, check_interval_seconds, expected_status_code) VALUES (1, 'https://a.example/', 'a', 60, 200)")
+        apply_migrations(baseline_engine)
+        columns = {column["name"] for column in inspect(baseline_engine).get_columns("sites")}
+        assert {"retention_days", "probe_mode", "probe_keyword", "probe_max_body_bytes"} <= columns
+        assert "probe_timings" in {column["name"] for column in inspect(baseline_engine).get_columns("site_status_history")}
+        with sessionmaker(bind=baseline_engine)() as db:
+            site = db.get(Site, 1)
+            assert site.probe_mode == ProbeMode.GET and ProbeSpec.of(site) == ProbeSpec()
+        baseline_engine.dispose()
+
+# Every migration is recorded once in schema_migrations, creates its indexes on a baseline database,
+# and running the migrations again, or on a database create_all already brought up to date, changes nothing
+def test_migrations_idempotent():
+    with tempfile.TemporaryDirectory() as directory:
+        for name, create in [("baseline", False), ("fresh", True)]:
+            migrated_engine = create_engine(f"sqlite:///{directory}/{name}.db")
+            if create:
+                Base.metadata.create_all(bind=migrated_engine)
+            else:
+                with migrated_engine.begin() as connection:
+                    for statement in BASELINE_SCHEMA:
+                        connection.exec_driver_sql(statement)
+            for _ in range(2):
+                apply_migrations(migrated_engine)
+            with migrated_engine.connect() as connection:
+                versions = [row.version for row in connection.execute(select(SchemaMigration).order_by(SchemaMigration.version))]
+            assert versions == [version for version, _, _ in MIGRATIONS], name
+            indexes = {index["name"] for table in ("site_status_history", "webhooks") for index in inspect(migrated_engine).get_indexes(table)}
+            assert {"ix_site_status_history_site_id_last_checked", "ix_site_status_history_last_checked", "ix_webhooks_site_id"} <= indexes, name
+            migrated_engine.dispose()
+
+# Function to send 'count' requests from one client IP through a rate limiter in front of a bare app, returns the responses
+async def limited_requests(limiter: RateLimiterMiddleware, client_ip: str, count: int):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=limiter, client=(client_ip, 123)), base_url="http://limited") as limited_client:
+        return [await limited_client.get("/") for _ in range(count)]
+
+# Function to build a rate limiter in front of an app answering 200, with fresh counts for 'client_ip'
+def rate_limiter(client_ip: str, **kwargs):
+    for key in redis_client.scan_iter(f"rate_limit:{client_ip}:*"):
+        redis_client.delete(key)
+    return RateLimiterMiddleware(PlainTextResponse("ok"), redis_url=REDIS_URL, **kwargs)
+
+# Exactly 'limit' requests go through, then a 429 with Retry-After, the client recovers once the window slid,
+# and requests let through by the local lease never add up to more than the limit
+def test_rate_limiter_window():
+    responses = asyncio.run(limited_requests(rate_limiter("192.0.2.10", limit=5, window=3600), "192.0.2.10", 7))
+    assert [response.status_code for response in responses] == [200] * 5 + [429] * 2
+    assert [response.headers["X-RateLimit-Remaining"] for response in responses[:5]] == ["4", "3", "2", "1", "0"]
+    assert int(responses[5].headers["Retry-After"]) > 0 and responses[5].json() == {"detail": "Rate limit exceeded"}
+
+    limiter = rate_limiter("192.0.2.11", limit=3, window=1)
+    responses = asyncio.run(limited_requests(limiter, "192.0.2.11", 8))
+    assert responses[-1].status_code == 429
+    time.sleep(int(responses[-1].headers["Retry-After"]) + 0.1) # The previous window still weighs on the count, a bit less every moment
+    assert asyncio.run(limited_requests(limiter, "192.0.2.11", 1))[0].status_code == 200
+
+    leased = rate_limiter("192.0.2.12", limit=100, window=3600, local_fraction=0.1)
+    responses = asyncio.run(limited_requests(leased, "192.0.2.12", 150))
+    assert [response.status_code for response in responses] == [200] * 100 + [429] * 50
+    assert min(int(response.headers["X-RateLimit-Remaining"]) for response in responses) == 0
+
+# The rate limiter passes responses through as the app sent them, each body chunk forwarded before the app sends the next one,
+# only adding its headers, and a rate limited request is answered without calling the app
+def test_rate_limiter_passthrough(client, create_site):
+    sent: list[dict] = []
+    calls = []
+
+    async def streaming_app(scope, receive, send):
+        calls.append(scope["path"])
+        await send({"type": "http.response.start", "status": 201, "headers": [(b"content-type", b"application/x-ndjson"), (b"x-custom", b"kept")]})
+        for index in range(3):
+            await send({"type": "http.response.body", "body": f'{{"row": {index}}}\n'.encode(), "more_body": True})
+            assert sent[-1]["body"] == f'{{"row": {index}}}\n'.encode() # Already forwarded, not buffered
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    for key in redis_client.scan_iter("rate_limit:192.0.2.20:*"):
+        redis_client.delete(key)
+    limiter = RateLimiterMiddleware(streaming_app, redis_url=REDIS_URL, limit=1, window=3600)
+    scope = {"type": "http", "method": "GET", "path": "/export", "headers": [], "client": ("192.0.2.20", 123)}
+    asyncio.run(limiter(scope, receive, send))
+    start, *body = sent
+    headers = dict(start["headers"])
+    assert start["status"] == 201 and headers[b"x-custom"] == b"kept" and headers[b"content-type"] == b"application/x-ndjson" and headers[b"x-ratelimit-remaining"] == b"0"
+    assert [message["body"] for message in body] == [b'{"row": 0}\n', b'{"row": 1}\n', b'{"row": 2}\n', b""]
+
+    sent.clear()
+    asyncio.run(limiter(scope, receive, send))
+    assert sent[0]["status"] == 429 and dict(sent[0]["headers"])[b"retry-after"] and calls == ["/export"] # The app was not called again
+
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    response = client.get(f"/history/export?format=csv&site_id={create_site['id']}", headers=headers)
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-disposition"] == "attachment; filename=history.csv" and "x-ratelimit-limit" in response.headers
+    assert len(response.text.strip().splitlines()) == 2 # Header and the INITIAL row
+
+# The scheduler pops sites in due order, skipping the stale entries of removed or moved sites,
+# resumes the due times saved in redis after a restart, and follows the sites added or removed through the event list
+def test_check_scheduler(create_multiple_sites, monkeypatch):
+    scheduler = CheckScheduler(jitter_ratio=0)
+    for site_id, due in [(1, 30), (2, 10), (3, 20)]:
+        scheduler.schedule(site_id, 60, due=due, now=0)
+    scheduler.remove(2)
+    scheduler.schedule(3, 60, due=5, now=0) # Moved earlier, its first entry turns stale
+    assert scheduler.next_due_in(now=0) == 5
+    assert scheduler.pop_due(now=25) == [3] and scheduler.pop_due(now=30) == [1]
+    assert len(scheduler) == 2 and scheduler.due_times() == {1: 90, 3: 65}
+
+    monkeypatch.setattr("app.scheduler.SessionLocal", TestingSessionLocal)
+    first, second = [site["id"] for site in create_multiple_sites]
+    now = time.time()
+    redis_client.hset(DUE_KEY, mapping={first: now + 50, second: now - 500, 999999: now})
+    try:
+        saved_due = {int(site_id): float(due) for site_id, due in redis_client.hgetall(DUE_KEY).items()} # As run_scheduler reads them
+        restarted = CheckScheduler()
+        sync_sites(restarted, redis_client, saved_due)
+        assert restarted.due_times([first])[first] == saved_due[first] # Phase kept across the restart
+        assert now <= restarted.due_times([second])[second] <= time.time() + 2 * restarted.jitter_ratio # Overdue, spread over the next moments
+        assert 999999 not in restarted and not redis_client.hexists(DUE_KEY, 999999)
+
+        redis_client.delete(EVENTS_KEY)
+        announce_site_added(redis_client, 999998, 60)
+        announce_sites_removed(redis_client, [first])
+        drain_events(restarted, redis_client)
+        assert restarted.interval_of(999998) == 60 and first not in restarted and second in restarted
+        assert redis_client.llen(EVENTS_KEY) == 0
+    finally:
+        redis_client.hdel(DUE_KEY, first, second, 999998)
+
+# The last state of a site is served by the redis cache, read from the history and cached again on a miss or a redis error,
+# replaced when a newer entry is written, and dropped when the site is removed
+def test_state_cache(client, create_multiple_sites, monkeypatch):
+    first, second = [site["id"] for site in create_multiple_sites]
+    db = TestingSessionLocal()
+    try:
+        site = db.get(Site, first)
+        assert state_cache.get(first).status == StatusType.INITIAL # Seeded when the site was created
+        state_cache.delete(first)
+        assert get_last_state(db, site).status == StatusType.INITIAL and state_cache.get(first) is not None # Read from the history, then cached
+
+        unreachable = StateCache(redis.StrictRedis(port=1, socket_connect_timeout=0.2))
+        assert unreachable.get(first) is None and unreachable.get_statuses([first]) == {}
+        monkeypatch.setattr("app.crud.state_cache", unreachable)
+        assert get_last_state(db, site).status == StatusType.INITIAL # Redis down, the history answers
+        monkeypatch.undo()
+
+        now = datetime.now(timezone.utc)
+        remember_state(SiteStatusHistory(site_id=first, status=StatusType.DOWN, last_checked=now, last_status_change=now))
+        assert get_last_state(db, site).status == StatusType.DOWN and state_cache.get_statuses([first, second]) == {first: StatusType.DOWN, second: StatusType.INITIAL}
+
+        writer = HistoryWriter(session_factory=TestingSessionLocal, flush_size=1000, flush_seconds=3600)
+        notified = []
+        monkeypatch.setattr("app.background_worker.history_writer", writer)
+        monkeypatch.setattr("app.background_worker.rollup_writer", RollupWriter(session_factory=TestingSessionLocal, flush_size=1000, flush_seconds=3600))
+        monkeypatch.setattr("app.background_worker.notify_status_change", lambda site, webhooks, entry: notified.append(state_cache.get(entry.site_id).status))
+        assert record_status(db, site, [], StatusType.UP, 10, now, False) == StatusType.DOWN
+        assert state_cache.get(first).status == StatusType.DOWN and notified == [] # Only buffered, the writer may still drop it
+        writer.close()
+        assert state_cache.get(first).status == StatusType.UP and notified == [StatusType.UP] # Cached once written, before the notification
+        monkeypatch.undo()
+    finally:
+        db.close()
+
+    headers = basic_auth_header(USERNAME, PASSWORD)
+    assert client.delete(f"/sites/{first}", headers=headers).status_code == 200
+    assert client.post("/sites/bulk-delete", json={"ids": [second]}, headers=headers).status_code == 200
+    assert state_cache.get(first) is None and state_cache.get(second) is None
+
+# The async client raises httpx exceptions for failures of its own connection pool, and an in-flight DNS lookup
+# finishing late does not drop a newer one for the same host
+def test_timed_transport_errors():
+    with socket.socket() as probe_socket: # A port nothing listens on
+        probe_socket.bind(("127.0.0.1", 0))
+        port = probe_socket.getsockname()[1]
+
+    async def fetch():
+        async with create_async_client(2) as async_client:
+            with pytest.raises(httpx.ConnectError):
+                await async_client.get(f"http://127.0.0.1:{port}/")
+    asyncio.run(fetch())
+
+    cache = DnsCache()
+    loop = asyncio.new_event_loop()
+    try:
+        older, newer = loop.create_future(), loop.create_future()
+        cache._inflight[("a.example", 0)] = newer
+        cache._lookup_done(("a.example", 0), older)
+        assert cache._inflight == {("a.example", 0): newer}
+        cache._lookup_done(("a.example", 0), newer)
+        assert cache._inflight == {}
+    finally:
+        loop.close()